@@ -0,0 +1,420 @@
+# -*- coding: utf-8 *-*
+
+"""
+Loopback benchmarks for SkyChat.
+
+Starts a number of Clients in this process, each with its own ports on
+127.0.0.1, and measures:
+
+	discovery				- Seconds until every client has found every other client
+	oneToOne				- Throughput and delivery latency from one client to another
+	fanOut					- Throughput and delivery latency from one client to all others
+	memory					- Bytes allocated per client, and resident memory per client
+	resources				- Thread and open file descriptor counts
+
+With --tls it also measures what TLS costs against plain TCP:
+
+	handshake				- Seconds from opening a connection to its first byte of data, over
+							  plain TCP, over TLS with a full handshake, and over TLS resuming
+							  the last session
+	oneToOne				- oneToOne above, with and without TLS
+
+Results are written as JSON so runs can be compared between releases:
+
+	python Benchmark.py --peers 20 --messages 5000 --output results.json
+	python Benchmark.py --peers 2 --tls
+
+
+
+Class Name: LoopbackNetwork
+	A set of Clients that discover each other over loopback.
+
+Functions:
+	start					- Creates the clients
+	waitForDiscovery		- Waits until every client knows every other one
+	sendAndWait				- Sends messages and waits until they have all arrived
+	close					- Logs every client out
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import Engine
+import Security
+import SkyChat
+
+
+PEERS = 10
+MESSAGES = 2000
+FANOUT_MESSAGES = 200
+MESSAGE_SIZE = 64
+TIMEOUT = 60.0
+FIRST_MAC = 1000
+HANDSHAKES = 200
+
+
+def freePorts(count, kind):
+    """Returns count ports that are free on 127.0.0.1."""
+    socks = []
+
+    try:
+        for i in range(count):
+            sock = socket.socket(socket.AF_INET, kind)
+            sock.bind(("127.0.0.1", 0))
+            socks.append(sock)
+
+        return [sock.getsockname()[1] for sock in socks]
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def threadCount():
+    return threading.active_count()
+
+
+def fdCount():
+    """Returns the number of open file descriptors, or None if unknown."""
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def residentBytes():
+    """Returns the resident memory of this process, or None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class LoopbackNetwork:
+
+    def __init__(self, count, dataDir, sharedEngine=True, tls=False):
+        self.__count = count
+        self.__dataDir = dataDir
+        self.__sharedEngine = sharedEngine
+        self.__tls = tls
+        self.__engine = None
+        self.__clients = []
+        self.__lock = threading.Lock()
+        self.__received = 0
+        self.__expected = 0
+        self.__latencies = []
+        self.__done = threading.Event()
+
+    def start(self):
+        alertPorts = freePorts(self.__count, socket.SOCK_DGRAM)
+        targets = [("127.0.0.1", port) for port in alertPorts]
+
+        if self.__sharedEngine:
+            self.__engine = Engine.Engine()
+
+        for i in range(self.__count):
+            contact = SkyChat.Contact(name="peer%d" % i, mac=FIRST_MAC + i)
+
+            self.__clients.append(SkyChat.Client(
+                contact,
+                lambda peer: None,
+                lambda peer: None,
+                lambda peer: None,
+                engine=self.__engine,
+                dataDir=self.__dataDir,
+                newMessage=self.__onMessage,
+                alertPort=alertPorts[i],
+                connectionPort=0,
+                discoveryTargets=targets,
+                tls=self.__tls))
+
+    def getClients(self):
+        return self.__clients
+
+    def waitForDiscovery(self, timeout=TIMEOUT):
+        """Wait until every client has found every other client. Returns
+        False on timeout."""
+        deadline = time.perf_counter() + timeout
+
+        while time.perf_counter() < deadline:
+            if all(len(c.getPeers()) == self.__count - 1 for c in self.__clients):
+                return True
+
+            time.sleep(0.005)
+
+        return False
+
+    def __onMessage(self, peer, message):
+        latency = time.perf_counter() - float(message.split("|", 1)[0])
+
+        with self.__lock:
+            self.__latencies.append(latency)
+            self.__received += 1
+
+            if self.__received >= self.__expected:
+                self.__done.set()
+
+    def sendAndWait(self, sender, receivers, messages, size,
+        timeout=TIMEOUT):
+        """Send messages messages of size characters from sender to every
+        client in receivers, and wait for them to arrive."""
+        client = self.__clients[sender]
+        peers = [client.findPeer(FIRST_MAC + r) for r in receivers]
+        padding = "x" * max(0, size - 20)
+
+        # Open the connections before timing anything
+        self.__reset(len(peers))
+        for peer in peers:
+            peer.sendMessage("%.9f|%s" % (time.perf_counter(), padding))
+        self.__done.wait(timeout)
+
+        self.__reset(len(peers) * messages)
+        start = time.perf_counter()
+
+        for i in range(messages):
+            for peer in peers:
+                peer.sendMessage("%.9f|%s" % (time.perf_counter(), padding))
+
+        completed = self.__done.wait(timeout)
+        elapsed = time.perf_counter() - start
+
+        with self.__lock:
+            latencies = self.__latencies
+            received = self.__received
+
+        return {
+            "messages": len(peers) * messages,
+            "received": received,
+            "completed": completed,
+            "seconds": elapsed,
+            "messagesPerSecond": received / elapsed if elapsed else None,
+            "bytesPerSecond": received * size / elapsed if elapsed else None,
+            "latencyP50": percentile(latencies, 0.50),
+            "latencyP99": percentile(latencies, 0.99)}
+
+    def __reset(self, expected):
+        with self.__lock:
+            self.__received = 0
+            self.__expected = expected
+            self.__latencies = []
+            self.__done.clear()
+
+    def close(self):
+        for client in self.__clients:
+            client.logout()
+
+        if self.__engine is not None:
+            self.__engine.stop()
+
+
+def timeHandshakes(engine, port, count, options, onConnected=None):
+    """Open count connections to port on 127.0.0.1, one at a time, and
+    return the seconds each took to deliver its first byte. options are
+    the TLS arguments of engine.connect."""
+    seconds = []
+    done = threading.Event()
+
+    def connected(connection, start):
+        def onData(data):
+            seconds.append(time.perf_counter() - start)
+            connection.setHandlers(lambda data: None, lambda: None)
+
+            if onConnected is not None:
+                onConnected(connection)
+
+            connection.close()
+            done.set()
+
+        connection.setHandlers(onData, done.set)
+
+    for i in range(count):
+        done.clear()
+        start = time.perf_counter()
+        engine.connect("127.0.0.1", port,
+            lambda connection, start=start: connected(connection, start),
+            lambda ex: done.set(),
+            TIMEOUT,
+            **options)
+        done.wait(TIMEOUT)
+
+    return {
+        "count": len(seconds),
+        "p50": percentile(seconds, 0.50),
+        "p99": percentile(seconds, 0.99)}
+
+
+def tlsCost(dataDir, messages=MESSAGES, size=MESSAGE_SIZE, handshakes=HANDSHAKES):
+    """Compare connection setup and one-to-one throughput over TLS with
+    plain TCP."""
+    engine = Engine.Engine()
+    engine.start()
+
+    server = Security.Tls(engine, os.path.join(dataDir, "server"), FIRST_MAC)
+    client = Security.Tls(engine, os.path.join(dataDir, "client"), FIRST_MAC + 1)
+
+    def serve(connection):
+        connection.setHandlers(lambda data: None, lambda: None)
+        connection.write(b"x")
+
+    plainListener = engine.listen(0, serve, "127.0.0.1")
+    tlsListener = engine.listen(0, serve, "127.0.0.1", server.getServerContext())
+    clientListener = engine.listen(0, serve, "127.0.0.1", client.getServerContext())
+
+    # Pin each end's certificate at the other, as discovery would
+    for tls, mac, port in ((client, FIRST_MAC, tlsListener.getPort()),
+            (server, FIRST_MAC + 1, clientListener.getPort())):
+        peer = SkyChat.Contact(mac=mac)
+        peer.setAddress("127.0.0.1")
+        peer.setPort(port)
+        engine.callSoon(tls.fetch, peer)
+
+        deadline = time.perf_counter() + TIMEOUT
+        while not tls.isPinned(mac) and time.perf_counter() < deadline:
+            time.sleep(0.001)
+
+    options = Security.connectOptions(client, FIRST_MAC)
+    resumed = []
+
+    def check(connection):
+        client.check(connection, FIRST_MAC)
+        resumed.append(connection.getTls().session_reused)
+
+    # No session is saved until the first check, so these are all full
+    results = {
+        "plain": timeHandshakes(engine, plainListener.getPort(), handshakes, {}),
+        "full": timeHandshakes(engine, tlsListener.getPort(), handshakes, options)}
+
+    timeHandshakes(engine, tlsListener.getPort(), 1, options, check)
+    resumed.clear()
+
+    results["resumed"] = timeHandshakes(
+        engine, tlsListener.getPort(), handshakes, options, check)
+    results["resumed"]["reused"] = sum(resumed)
+
+    for listener in (plainListener, tlsListener, clientListener):
+        listener.close()
+
+    engine.stop()
+
+    results = {"handshake": results}
+
+    for name, tls in (("plain", False), ("tls", True)):
+        network = LoopbackNetwork(2, os.path.join(dataDir, name), tls=tls)
+        network.start()
+
+        if network.waitForDiscovery():
+            results.setdefault("oneToOne", {})[name] = network.sendAndWait(
+                0, [1], messages, size)
+
+        network.close()
+
+    return results
+
+
+def run(peers=PEERS, messages=MESSAGES, fanOutMessages=FANOUT_MESSAGES,
+    size=MESSAGE_SIZE, sharedEngine=True, tls=False):
+    """Run every benchmark and return the results as a dictionary."""
+    results = {
+        "peers": peers,
+        "messageSize": size,
+        "sharedEngine": sharedEngine,
+        "skychatVersion": SkyChat.__version__,
+        "python": sys.version.split()[0]}
+
+    with tempfile.TemporaryDirectory() as dataDir:
+        threadsBefore = threadCount()
+        fdsBefore = fdCount()
+        residentBefore = residentBytes()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+
+        network = LoopbackNetwork(peers, dataDir, sharedEngine)
+        network.start()
+        started = time.perf_counter()
+
+        discovered = network.waitForDiscovery()
+        finished = time.perf_counter()
+
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        results["discovery"] = {
+            "completed": discovered,
+            "startSeconds": started - start,
+            "seconds": finished - start}
+
+        results["memory"] = {
+            "allocatedPerPeer": allocated / peers,
+            "residentPerPeer": None if residentBefore is None else
+                (residentBytes() - residentBefore) / peers}
+
+        if peers > 1:
+            results["oneToOne"] = network.sendAndWait(0, [1], messages, size)
+            results["fanOut"] = network.sendAndWait(
+                0, range(1, peers), fanOutMessages, size)
+
+        results["resources"] = {
+            "threads": threadCount() - threadsBefore,
+            "fds": None if fdsBefore is None else fdCount() - fdsBefore}
+
+        network.close()
+
+        if tls:
+            results["tls"] = tlsCost(dataDir, messages, size)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SkyChat loopback benchmarks")
+    parser.add_argument("--peers", type=int, default=PEERS,
+        help="number of clients to start")
+    parser.add_argument("--messages", type=int, default=MESSAGES,
+        help="messages sent one-to-one")
+    parser.add_argument("--fan-out-messages", type=int, default=FANOUT_MESSAGES,
+        help="messages sent to every peer in the fan-out test")
+    parser.add_argument("--size", type=int, default=MESSAGE_SIZE,
+        help="message size in characters")
+    parser.add_argument("--engine-per-client", action="store_true",
+        help="give every client its own engine thread")
+    parser.add_argument("--tls", action="store_true",
+        help="also measure what TLS costs against plain TCP")
+    parser.add_argument("--output", help="file to write the JSON results to")
+
+    args = parser.parse_args(argv)
+
+    results = run(
+        args.peers,
+        args.messages,
+        args.fan_out_messages,
+        args.size,
+        not args.engine_per_client,
+        args.tls)
+
+    text = json.dumps(results, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
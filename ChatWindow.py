@@ -2,75 +2,129 @@
 """
 Class Name: ChatWindow
 	This class allows the user to interact with another client
-	on the network.
+	on the network, or with a group of them.
+
+	The message callbacks are called on the engine thread. They post to
+	the UIQueue, and each burst of messages is added to the history view
+	in one update on the Tk thread.
+
+	The history view only holds a window of the conversation. Opening it
+	shows the last page of the history, so a long conversation opens as
+	fast as an empty one. Scrolling to the top loads the page before it,
+	and while the view follows new messages it is trimmed back to
+	MAX_RENDERED messages.
 
 Mutator Functions:
-	setContact		- Sets the contact this window communicates with.
+	setContact		- Sets the contact or Group this window communicates with.
 Accessor Functions:
-	getContact 		- Gets the contact this window communicates with.
+	getContact 		- Gets the contact or Group this window communicates with.
 	getIsOpen		- Gets a boolean value indicating if this window is still open.
+	isGroup			- Gets a boolean value indicating if this window shows a group.
 Functions:
+	sendFile		- Asks the user for a file and offers it to the contact.
+	offerFile		- Asks the user whether to accept a file the contact offered, and where to save it.
+	watchTransfer	- Shows the progress of a file transfer in the status bar.
+
 	sendMessage		- Sends the user's message and resets the entry field.
 	Input Params	- None
 	Output Params	- None
-	
-	send message to other client
+
+	send message to other client, or to every member of the group
 	add message to history view
 	clear message entry field
-	
-	messageCallback	- Receives a message from the remote client.
+
+	messageCallback	- Receives a message from the remote client. May be called from any thread.
 	Input Params
 		message		- The received message
 	Output Params	- None
-	
+
 	If this message is to close the conversation
-		add this event to the history view
+		queue this event for the history view
 	else
-		add user message to history view
-	
+		queue user message for the history view
+
+	groupCallback	- Receives a message sent to the group. May be called from any thread.
+	Input Params
+		name		- Name of the member that sent the message
+		message		- The received message
+		position	- Position of the message in the group's history
+	Output Params	- None
+
+	queue user message for the history view
+
 """
 
 from tkinter import *
+import tkinter.filedialog as filedialog
+import tkinter.messagebox as messagebox
+import collections
 from SkyChat import *
+import Groups
+import History
+import Transfers
+
 
+MAX_RENDERED = 500
 
 class ChatWindow(Toplevel):
 
-	__contact = None
-    __newContact = None
+    __contact = None
     __isOpen = True
+    __hasOlder = False
 
-    def __init__(self, contact, user):
+    def __init__(self, contact, user, ui):
         Toplevel.__init__(self)
 
         self.user = user
+        self.__ui = ui
 
         self.initUI()
 
         self.protocol("WM_DELETE_WINDOW", self.__onClose)
 
+        # File transfers shown in the status bar
+        self.__transfers = []
+
+        # (position, lines) for every message in the history view, oldest
+        # first. Messages that are not in the history have no position.
+        self.__rendered = collections.deque()
+        self.__generation = 0
+
         self.setContact(contact)
-        self.__setContact()
 
     def getContact(self):
         return self.__contact
 
     def setContact(self, contact):
-        self.__newContact = contact
+        """Show the conversation with contact. Must be called from the Tk
+        thread."""
+        if self.__contact is not None:
+            self.__contact.setMessageCallback(None)
 
+        self.__contact = contact
 
-    def __setContact(self):
+        self.txtChatHistory.delete("1.0", END)
+        self.__rendered.clear()
+        self.__hasOlder = False
 
-        if not (self.__newContact is None):
-            self.__contact = self.__newContact
-            self.__newContact = None
+        # Events queued for an earlier contact are dropped, since the new
+        # page holds the messages among them
+        self.__generation += 1
+        generation = self.__generation
 
-            self.title("SkyChat - " + self.__contact.getName())
-            self.txtChatHistory.delete("1.0", END)
+        def replay(entries):
+            self.__ui.post(self.__showPages, (generation, entries))
 
-            self.__contact.setMessageCallback(self.messageCallback)
+        if self.isGroup():
+            self.title("SkyChat - " + self.__contact.getName() +
+                " (" + str(len(self.__contact.getMembers())) + " members)")
+            self.__contact.setMessageCallback(self.groupCallback, replay)
+        else:
+            self.title("SkyChat - " + self.__contact.getName())
+            self.__contact.setMessageCallback(self.messageCallback, replay)
 
-        self.after(1000, self.__setContact)
+    def isGroup(self):
+        return isinstance(self.__contact, Groups.Group)
 
 
 
@@ -92,7 +146,7 @@ class ChatWindow(Toplevel):
 
 
         # Create the history view
-        self.txtChatHistory = Text(self, yscrollcommand=self.scrollChatHistory.set)
+        self.txtChatHistory = Text(self, yscrollcommand=self.__onScroll)
         self.txtChatHistory.grid(
             column=0,
             row=0,
@@ -104,8 +158,8 @@ class ChatWindow(Toplevel):
         # Create the new message entry field
         self.txtMessage = Entry(self)
         self.txtMessage.grid(column=0, row=1, sticky=(W, E))
-		
-		# Send a message when the user presses Return
+
+        # Send a message when the user presses Return
         self.txtMessage.bind('<Return>', self.__txtMessage_OnReturn)
 
         # Create the send message button
@@ -125,8 +179,8 @@ class ChatWindow(Toplevel):
 
 
     def __createFormatTags(self):
-		"""Create format tags for the conversation history."""
-		
+        """Create format tags for the conversation history."""
+
         self.txtChatHistory.tag_config("sender", font=('calibri', 11, 'bold'))
         self.txtChatHistory.tag_config("message_body", font=('calibri', 11), wrap=WORD)
 
@@ -135,55 +189,227 @@ class ChatWindow(Toplevel):
 
     def __onClose(self):
         """When the window is closing, let the other client know."""
-		
+
         self.__isOpen = False
+        self.__contact.detach()
         self.__contact.closeConnection()
+
+        for transfer in self.__transfers:
+            transfer.setListener(None)
+
         self.destroy()
 
     def getIsOpen(self):
         return self.__isOpen
 
     def sendMessage(self):
-		"""Send a message to the other client."""
-		
+        """Send a message to the other client."""
+
         msg = self.txtMessage.get()
         self.txtMessage.delete(0, END)
         self.__contact.sendMessage(msg)
-		
-		"""Add the sent message to the conversation history"""
-        self.txtChatHistory.insert(
-            END,
-            self.user.getName() + ":  ",
-            "sender")
-        self.txtChatHistory.insert(
-            END,
-            msg + "\n",
-            "message_body")
-
-    def messageCallback(self, message):
-		"""Handles messages received from the other client"""
+
+        # Add the sent message to the conversation history
+        self.__showMessages([(self.__generation, (None, self.user.getName(), msg))])
+
+    def messageCallback(self, message, position=None):
+        """Handles messages received from the other client"""
+        name = self.__contact.getName()
+
         if message == '<close />':
-            self.txtChatHistory.insert(
-                END,
-                self.__contact.getName() + " has left the chat.\n")
+            self.__post(None, None, name + " has left the chat.")
         else:
-            self.txtChatHistory.insert(
-                END,
-                self.__contact.getName() + ":  ",
-                "sender")
-            self.txtChatHistory.insert(
-                END,
-                message + "\n",
-                "message_body")
+            self.__post(position, name, message)
+
+    def groupCallback(self, name, message, position=None):
+        """Handles messages sent to the group by its members"""
+        self.__post(position, name, message)
+
+    def __post(self, position, name, message):
+        self.__ui.post(self.__showMessages,
+            (self.__generation, (position, name, message)))
+
+    def __named(self, entries):
+        """Returns history entries as (position, sender, message). Group
+        entries already name their sender."""
+        if self.isGroup():
+            return entries
+
+        name = self.__contact.getName()
+        return [(position, name, message) for position, message in entries]
+
+    def __format(self, messages):
+        """Returns the Text chunks for (position, sender, message) tuples,
+        and (position, lines) for each of them. Events without a sender are
+        shown untagged."""
+        chunks = []
+        rendered = []
+
+        for position, name, message in messages:
+            if name is None:
+                chunks += [message + "\n", ()]
+            else:
+                chunks += [name + ":  ", "sender", message + "\n", "message_body"]
+
+            rendered.append((position, message.count("\n") + 1))
+
+        return chunks, rendered
+
+    def __showPages(self, pages):
+        """Show the last page of the history when the window opens."""
+        if not self.__isOpen:
+            return
+
+        for generation, entries in pages:
+            if generation != self.__generation:
+                continue
+
+            messages = self.__named(entries)
+            self.__hasOlder = len(messages) == History.PAGE_SIZE
+
+            # Messages shown before the page arrived are newer than it
+            chunks, rendered = self.__format(messages)
+            if chunks:
+                self.txtChatHistory.insert("1.0", *chunks)
+            self.__rendered.extendleft(reversed(rendered))
+
+            self.txtChatHistory.see(END)
+
+    def __showMessages(self, events):
+        """Add (position, sender, message) tuples to the end of the history
+        view in one insert."""
+        messages = [message for generation, message in events
+            if generation == self.__generation]
+
+        if not self.__isOpen or not messages:
+            return
+
+        # Follow new messages only if the user is already at the bottom
+        following = self.txtChatHistory.yview()[1] >= 1.0
+
+        chunks, rendered = self.__format(messages)
+        self.txtChatHistory.insert(END, *chunks)
+        self.__rendered.extend(rendered)
+
+        if following:
+            self.__trim()
+            self.txtChatHistory.see(END)
+
+    def __trim(self):
+        """Remove the oldest messages above MAX_RENDERED from the view.
+        They can be loaded again by scrolling back."""
+        lines = 0
+        while len(self.__rendered) > MAX_RENDERED:
+            position, count = self.__rendered.popleft()
+            lines += count
+
+            if position is not None:
+                self.__hasOlder = True
+
+        if lines > 0:
+            self.txtChatHistory.delete("1.0", "%d.0" % (lines + 1))
+
+    def __oldestPosition(self):
+        for position, lines in self.__rendered:
+            if position is not None:
+                return position
+
+        return None
+
+    def __onScroll(self, first, last):
+        self.scrollChatHistory.set(first, last)
+
+        if float(first) <= 0.0 and self.__hasOlder and self.__isOpen:
+            self.__hasOlder = False
+            self.after_idle(self.__loadOlder)
+
+    def __loadOlder(self):
+        """Add the page before the oldest message to the top of the view,
+        without moving what the user is looking at."""
+        position = self.__oldestPosition()
+        if position is None or not self.__isOpen:
+            return
+
+        messages = self.__named(
+            self.__contact.readHistory(position, History.PAGE_SIZE))
+        self.__hasOlder = len(messages) == History.PAGE_SIZE
+
+        if not messages:
+            return
+
+        top = int(self.txtChatHistory.index("@0,0").split(".")[0])
+
+        chunks, rendered = self.__format(messages)
+        self.txtChatHistory.insert("1.0", *chunks)
+        self.__rendered.extendleft(reversed(rendered))
+
+        self.txtChatHistory.yview("%d.0" % (top + sum(lines for p, lines in rendered)))
+
+    def sendFile(self):
+        """Let the user pick a file and offer it to the contact."""
+        if self.isGroup():
+            return
+
+        path = filedialog.askopenfilename(parent=self)
+        if not path:
+            return
+
+        try:
+            self.watchTransfer(self.__contact.sendFile(path))
+        except OSError as ex:
+            messagebox.showerror("SkyChat", "Could not send " + path + ": " + str(ex), parent=self)
+
+    def offerFile(self, transfer):
+        """Ask the user whether to accept a file offered by the contact."""
+        question = "%s wants to send you %s (%d bytes). Accept it?" % (
+            transfer.getContact().getName(), transfer.getName(), transfer.getSize())
+
+        path = None
+        if messagebox.askyesno("SkyChat", question, parent=self):
+            path = filedialog.asksaveasfilename(
+                parent=self,
+                initialfile=transfer.getName())
+
+        if path:
+            transfer.accept(path)
+            self.watchTransfer(transfer)
+        else:
+            transfer.decline()
+
+    def watchTransfer(self, transfer):
+        """Show the progress of transfer in the status bar."""
+        self.__transfers.append(transfer)
+        transfer.setListener(lambda transfer: self.__ui.post(self.__showTransfers))
+        self.__showTransfers()
+
+    def __showTransfers(self, events=None):
+        """Show the progress of every file transfer in the status bar."""
+        if not self.__isOpen:
+            return
+
+        text = []
+
+        for transfer in self.__transfers:
+            if transfer.getState() in Transfers.FINISHED:
+                text.append(transfer.getName() + " " + transfer.getState())
+            elif transfer.getSize() > 0:
+                text.append("%s %d%%" % (transfer.getName(),
+                    100 * transfer.getTransferred() // transfer.getSize()))
+
+        self.lblStatus.config(text=", ".join(text) or "Ready.")
+
+        # Finished transfers are shown once
+        self.__transfers = [t for t in self.__transfers
+            if t.getState() not in Transfers.FINISHED]
 
     def createMenu(self):
         self.mnuBar = Menu(self)
         self.config(menu=self.mnuBar)
 
         self.mnuFile = Menu(self.mnuBar)
+        self.mnuFile.add_command(label="Send File...", command=self.sendFile)
         self.mnuFile.add_command(label="Exit", command=self.mnuFileExit_Click)
         self.mnuBar.add_cascade(label="File", menu=self.mnuFile)
 
     def mnuFileExit_Click(self):
-        self.destroy()
-
+        self.__onClose()
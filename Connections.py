@@ -0,0 +1,320 @@
+# -*- coding: utf-8 *-*
+
+"""
+Class Name: ConnectionManager
+	Opens and accepts the TCP connections between a client and its
+	peers. Nothing here blocks: connections are opened by the engine,
+	with a timeout, and messages wait in the contact's outbox until the
+	connection is up.
+
+	Both ends start a connection by sending a hello frame with their
+	MAC, so an accepted connection is matched to its peer by MAC rather
+	than by address. If both ends connect at the same time, the
+	connection opened by the end with the larger MAC is kept and the
+	other is closed. Both ends apply the same rule, so exactly one
+	connection per pair of peers survives. The rule only applies while
+	the open connection is still in its handshake: once the peer has
+	synced on it, or it has gone a handshake timeout without syncing, a
+	new hello from the peer replaces it. A peer that restarts while its
+	old connection still looks open here is not turned away.
+
+	A connection that fails while messages are waiting, or have not been
+	acknowledged by the peer, is retried with exponential back-off. After maxRetries failed attempts, or once the
+	peer has left, the waiting messages are given up on: the contact
+	moves them to its message store, if it has one, or drops them.
+
+	A connection whose hello is a file hello ("FILE <mac> <transfer ID>")
+	carries a file instead of messages. It is given to the file handler
+	with the bytes that followed the hello, and is never framed again.
+
+	With TLS, connections are opened and accepted over TLS, and once the
+	hello names the peer at the other end, its certificate must be the
+	one pinned to its MAC, or the connection is closed. See Security.py.
+
+	With a hub, connections are streams over this client's connection
+	to the hub instead of TCP connections to the peer. See Hub.py.
+
+Data:
+	__engine				- Engine that opens the connections and runs the timers
+	__myInfo				- This client's own contact
+	__peers					- Registry used to find the peer named in a hello
+	__newConversation		- Callback used when a peer opens a connection to this client
+	__connecting			- Peers that a connection is being opened to, keyed by MAC
+	__retries				- Number of failed attempts for each peer, keyed by MAC
+	__connectTimeout		- Seconds to wait for a connection to open
+	__handshakeTimeout		- Seconds to wait for the hello on a new connection
+	__maxRetries			- Failed attempts before waiting messages are given up on
+	__fileHandler			- Function called with (peer, connection, transfer ID, data) for file connections
+	__started				- Time each connection being opened was started, keyed by MAC
+	__handshakes			- Engine time each peer's current connection was set, keyed by MAC
+	__metrics				- ClientMetrics that connect times and failures are counted in
+	__tls					- Security.Tls that connections are secured with, or None for plain TCP
+	__hub					- Hub.HubLink that connections are opened through, or None to open them directly
+
+Functions:
+	connect					- Opens a connection to a peer unless one is open or opening
+	reconnect				- Opens a connection to a peer again after a delay, if it is still known
+	accept					- Starts the handshake on a connection accepted by the listener
+	getEngine				- Returns the engine
+	setFileHandler			- Sets the function that file connections are given to
+"""
+
+import logging
+
+import Framing
+import Metrics
+import Security
+
+
+CONNECT_TIMEOUT = 5.0
+HANDSHAKE_TIMEOUT = 5.0
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+MAX_RETRIES = 5
+
+HELLO = "HELLO "
+FILE_HELLO = "FILE "
+
+log = logging.getLogger("SkyChat.Connections")
+
+
+class ConnectionManager:
+
+    __fileHandler = None
+
+    def __init__(self, engine, myInfo, peers, newConversation,
+        connectTimeout=CONNECT_TIMEOUT, handshakeTimeout=HANDSHAKE_TIMEOUT,
+        maxRetries=MAX_RETRIES, metrics=Metrics.DISABLED, tls=None, hub=None):
+
+        self.__engine = engine
+        self.__myInfo = myInfo
+        self.__peers = peers
+        self.__newConversation = newConversation
+        self.__connectTimeout = connectTimeout
+        self.__handshakeTimeout = handshakeTimeout
+        self.__maxRetries = maxRetries
+        self.__connecting = {}
+        self.__retries = {}
+        self.__started = {}
+        self.__handshakes = {}
+        self.__metrics = metrics
+        self.__tls = tls
+        self.__hub = hub
+
+    def getEngine(self):
+        return self.__engine
+
+    def setFileHandler(self, handler):
+        self.__fileHandler = handler
+
+    def connect(self, peer):
+        """Open a connection to peer unless one is already open or being
+        opened. Must be called from the engine thread."""
+        connection = peer.getConnection()
+        if connection is not None and not connection.isClosed():
+            return
+
+        if peer.getMAC() in self.__connecting:
+            return
+
+        self.__connecting[peer.getMAC()] = peer
+        self.__started[peer.getMAC()] = Metrics.clock()
+
+        if self.__hub is not None:
+            self.__hub.connect(
+                peer.getMAC(),
+                lambda connection: self.__handshake(connection, peer),
+                lambda ex: self.__onFailed(peer, ex))
+            return
+
+        self.__engine.connect(
+            peer.getAddress(),
+            peer.getPort(),
+            lambda connection: self.__handshake(connection, peer),
+            lambda ex: self.__onFailed(peer, ex),
+            self.__connectTimeout,
+            **Security.connectOptions(self.__tls, peer.getMAC()))
+
+    def reconnect(self, peer):
+        """Connect to peer again after a delay, if it is still known. Used
+        when a connection closes before the peer acknowledged everything."""
+        if self.__peers.getByMAC(peer.getMAC()) is not peer:
+            return
+
+        retries = self.__retries.get(peer.getMAC(), 0)
+        self.__engine.callLater(
+            min(RETRY_DELAY * 2 ** retries, MAX_RETRY_DELAY),
+            self.__retry,
+            peer)
+
+    def accept(self, connection):
+        """Start the handshake on a connection accepted by the listener."""
+        self.__handshake(connection, None)
+
+    def __handshake(self, connection, peer):
+        """Send our hello and wait for the other end's. peer is the peer
+        that was connected to, or None for accepted connections."""
+        decoder = Framing.FrameDecoder(decode=Framing.decodeText)
+        timer = self.__engine.callLater(
+            self.__handshakeTimeout,
+            connection.close)
+
+        def onData(data):
+            try:
+                # Only the hello is framed on a file connection
+                frames = decoder.feed(data, 1)
+
+                if frames and not frames[0].startswith(FILE_HELLO):
+                    frames += decoder.feed(b"")
+
+            except (Framing.FrameError, UnicodeDecodeError):
+                connection.close()
+                return
+
+            if not frames:
+                return
+
+            timer.cancel()
+
+            if peer is None and frames[0].startswith(FILE_HELLO):
+                self.__onFileHello(connection, frames[0], decoder.takeRemainder())
+            else:
+                self.__onHello(connection, peer, decoder, frames)
+
+        def onClose():
+            timer.cancel()
+            if peer is not None:
+                self.__onFailed(peer, ConnectionError("closed during handshake"))
+
+        # Say hello first: setHandlers may deliver the other end's hello
+        # right away
+        connection.write(Framing.encodeText(HELLO + str(self.__myInfo.getMAC())))
+        connection.setHandlers(onData, onClose)
+
+    def __onHello(self, connection, expected, decoder, frames):
+        hello = frames[0]
+
+        try:
+            if not hello.startswith(HELLO):
+                raise ValueError(hello)
+            mac = int(hello[len(HELLO):])
+        except ValueError:
+            log.warning("Invalid hello from %s", connection.getPeerAddress())
+            connection.close()
+            return
+
+        peer = self.__peers.getByMAC(mac)
+
+        if expected is not None:
+            if peer is not expected:
+                log.warning("Wrong peer at %s", connection.getPeerAddress())
+                connection.setHandlers(lambda data: None, lambda: None)
+                connection.close()
+                self.__onFailed(expected, ConnectionError("wrong peer"))
+                return
+
+        elif peer is None:
+            log.info("Connection from unknown peer %s", mac)
+            connection.close()
+            return
+
+        if self.__tls is not None and not self.__tls.check(connection, mac):
+            connection.setHandlers(lambda data: None, lambda: None)
+            connection.close()
+            if expected is not None:
+                self.__onFailed(expected, ConnectionError("certificate does not match"))
+            return
+
+        if expected is not None:
+            self.__connecting.pop(mac, None)
+            self.__retries.pop(mac, None)
+
+            started = self.__started.pop(mac, None)
+            if started is not None:
+                self.__metrics.connectTime.observe(Metrics.clock() - started)
+
+        # If both ends connected at the same time, keep the connection
+        # opened by the end with the larger MAC
+        if self.__inHandshake(peer) and \
+                self.__opener(peer, peer.getConnection()) > self.__opener(peer, connection):
+            connection.setHandlers(lambda data: None, lambda: None)
+            connection.close()
+            return
+
+        if expected is None:
+            self.__newConversation(peer)
+
+        self.__handshakes[mac] = self.__engine.time()
+        peer.setConnection(connection, decoder, frames[1:])
+
+    def __onFileHello(self, connection, hello, data):
+        try:
+            mac, transferId = hello[len(FILE_HELLO):].split()
+            peer = self.__peers.getByMAC(int(mac))
+            transferId = int(transferId)
+        except ValueError:
+            log.warning("Invalid file hello from %s", connection.getPeerAddress())
+            connection.close()
+            return
+
+        if peer is None or self.__fileHandler is None:
+            log.info("File from unknown peer %s", mac)
+            connection.close()
+            return
+
+        if self.__tls is not None and not self.__tls.check(connection, peer.getMAC()):
+            connection.close()
+            return
+
+        self.__fileHandler(peer, connection, transferId, data)
+
+    def __inHandshake(self, peer):
+        """Returns True if peer's connection is open but the peer has not
+        synced on it yet, and the handshake has not timed out."""
+        current = peer.getConnection()
+        if current is None or current.isClosed() or peer.isSynced():
+            return False
+
+        started = self.__handshakes.get(peer.getMAC(), 0)
+        return self.__engine.time() - started < self.__handshakeTimeout
+
+    def __opener(self, peer, connection):
+        """Returns the MAC of the end that opened connection."""
+        if connection.isOutbound():
+            return self.__myInfo.getMAC()
+
+        return peer.getMAC()
+
+    def __onFailed(self, peer, ex):
+        mac = peer.getMAC()
+        if self.__connecting.pop(mac, None) is None:
+            return
+
+        self.__started.pop(mac, None)
+        self.__metrics.connectFailures.inc()
+
+        log.info("Could not connect to %s: %s", peer.getName(), ex)
+
+        retries = self.__retries.get(mac, 0) + 1
+
+        if retries > self.__maxRetries or not (peer.hasOutbox() or peer.hasUnacked()):
+            self.__retries.pop(mac, None)
+            peer.dropOutbox()
+            return
+
+        self.__retries[mac] = retries
+        self.__engine.callLater(
+            min(RETRY_DELAY * 2 ** (retries - 1), MAX_RETRY_DELAY),
+            self.__retry,
+            peer)
+
+    def __retry(self, peer):
+        # The peer may have logged out, or connected to us, while we waited
+        if self.__peers.getByMAC(peer.getMAC()) is not peer:
+            self.__retries.pop(peer.getMAC(), None)
+            self.__handshakes.pop(peer.getMAC(), None)
+            peer.dropOutbox()
+        elif peer.hasOutbox() or peer.hasUnacked():
+            self.connect(peer)
+        else:
+            self.__retries.pop(peer.getMAC(), None)
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 *-*
+
+"""
+Runs SkyChat without Tk, for servers and bots.
+
+	python -m SkyChat --headless --name bot1
+
+Without --headless the graphical client in __init__.py is started.
+
+
+
+Class Name: Session
+	A SkyChat client driven from code instead of a window. Everything
+	that happens on the network is reported as an Event, either through
+	the events() iterator or to listeners added with addListener.
+
+Data:
+	__contact				- This session's own contact
+	__client				- The SkyChat Client
+	__events				- Queue that events() reads from
+	__listeners				- Functions called with every Event on the engine thread
+	__dropped				- Number of events dropped because the queue was full
+
+Functions:
+
+	__init__				- Constructor
+
+	Input Params:
+		name				- Display name
+		status				- Status to announce. Default is "Online"
+		mac					- MAC to announce. Default is this machine's
+		queueSize			- Largest number of events held for events(). 0 turns the queue off
+		clientArgs			- Any other keyword arguments are passed to SkyChat.Client
+
+	events					- Iterates over events as they happen
+
+	Input Params:
+		timeout				- Seconds to wait for the next event. Default is to wait forever
+
+	Stops when the session is closed or when timeout passes without an event.
+
+	send					- Sends a message to the peer with the given MAC. Returns False if the peer is unknown
+	broadcast				- Sends a message to every known peer
+	setStatus				- Changes the status and announces it
+	getPeers				- Returns the list of known peers
+	addListener				- Adds a function called with every Event, on the engine thread
+	close					- Logs out and ends events()
+
+
+
+Class Name: ControlServer
+	Serves a Session on a local TCP socket so other programs can drive
+	it. Each request is one line of JSON and gets one line of JSON back:
+
+	{"command": "peers"}								- {"peers": [{"mac", "name", "status", "address"}, ...]}
+	{"command": "send", "mac": M, "message": T}			- {"ok": true}
+	{"command": "broadcast", "message": T}				- {"ok": true}
+	{"command": "status", "status": S}					- {"ok": true}
+	{"command": "subscribe"}							- {"ok": true}, then one line per Event
+
+	Errors are answered with {"error": "..."}.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import queue
+import signal
+import threading
+
+import SkyChat
+
+
+controlPort = 8498
+
+PEER_FOUND = "peer"
+PEER_UPDATED = "update"
+PEER_LEFT = "left"
+MESSAGE = "message"
+CONVERSATION = "conversation"
+
+QUEUE_SIZE = 10000
+
+log = logging.getLogger("SkyChat.Daemon")
+
+Event = collections.namedtuple("Event", ("kind", "peer", "message"))
+
+
+class Session:
+
+    __dropped = 0
+
+    def __init__(self, name, status="Online", mac=None, queueSize=QUEUE_SIZE,
+        **clientArgs):
+
+        self.__events = queue.Queue(queueSize) if queueSize > 0 else None
+        self.__listeners = []
+        self.__contact = SkyChat.Contact(name=name, status=status, mac=mac)
+
+        self.__client = SkyChat.Client(
+            self.__contact,
+            lambda peer: self.__emit(Event(PEER_FOUND, peer, None)),
+            lambda peer: self.__emit(Event(CONVERSATION, peer, None)),
+            lambda peer: self.__emit(Event(PEER_LEFT, peer, None)),
+            updatePeer=lambda peer: self.__emit(Event(PEER_UPDATED, peer, None)),
+            newMessage=lambda peer, message: self.__emit(
+                Event(MESSAGE, peer, message)),
+            **clientArgs)
+
+    def __emit(self, event):
+        for listener in self.__listeners:
+            listener(event)
+
+        if self.__events is None:
+            return
+
+        try:
+            self.__events.put_nowait(event)
+        except queue.Full:
+            self.__dropped += 1
+
+    def getClient(self):
+        return self.__client
+
+    def getContact(self):
+        return self.__contact
+
+    def getDropped(self):
+        return self.__dropped
+
+    def getPeers(self):
+        return self.__client.getPeers()
+
+    def addListener(self, listener):
+        """Add a function called with every Event on the engine thread."""
+        self.__listeners.append(listener)
+
+    def removeListener(self, listener):
+        if listener in self.__listeners:
+            self.__listeners.remove(listener)
+
+    def events(self, timeout=None):
+        """Iterate over events as they happen."""
+        if self.__events is None:
+            raise RuntimeError("events() needs a session with a queue")
+
+        while True:
+            try:
+                event = self.__events.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+            if event is _closed:
+                return
+
+            yield event
+
+    def send(self, mac, message):
+        """Send a message to the peer with the given MAC."""
+        peer = self.__client.findPeer(mac)
+        if peer is None:
+            return False
+
+        peer.sendMessage(message)
+        return True
+
+    def broadcast(self, message):
+        """Send a message to every known peer."""
+        for peer in self.__client.getPeers():
+            peer.sendMessage(message)
+
+    def setStatus(self, status):
+        self.__client.setStatus(status)
+
+    def close(self):
+        """Log out and end any events() iterators."""
+        self.__client.logout()
+
+        if self.__events is not None:
+            # Make room for the end marker if the queue is full
+            try:
+                self.__events.put_nowait(_closed)
+            except queue.Full:
+                self.__events.get_nowait()
+                self.__events.put_nowait(_closed)
+
+
+_closed = Event(None, None, None)
+
+
+def peerInfo(peer):
+    """Returns a dictionary describing a peer, for JSON."""
+    return {
+        "mac": peer.getMAC(),
+        "name": peer.getName(),
+        "status": peer.getStatus(),
+        "address": peer.getAddress()}
+
+
+def eventInfo(event):
+    """Returns a dictionary describing an Event, for JSON."""
+    info = {"event": event.kind, "peer": peerInfo(event.peer)}
+
+    if event.message is not None:
+        info["message"] = event.message
+
+    return info
+
+
+class ControlServer:
+
+    def __init__(self, session, port=None, host="127.0.0.1"):
+        if port is None:
+            port = controlPort
+
+        self.__session = session
+        self.__subscribers = set()
+        self.__engine = session.getClient().getEngine()
+        self.__listener = self.__engine.listen(port, self.__onConnection, host)
+
+        session.addListener(self.__onEvent)
+
+    def getPort(self):
+        return self.__listener.getPort()
+
+    def close(self):
+        self.__session.removeListener(self.__onEvent)
+        self.__listener.close()
+
+        for connection in list(self.__subscribers):
+            connection.close()
+
+    def __onConnection(self, connection):
+        buff = bytearray()
+
+        def onData(data):
+            buff.extend(data)
+
+            while True:
+                end = buff.find(b"\n")
+                if end < 0:
+                    return
+
+                line = bytes(buff[:end])
+                del buff[:end + 1]
+
+                if line.strip():
+                    self.__reply(connection, self.__handle(connection, line))
+
+        connection.setHandlers(
+            onData,
+            lambda: self.__subscribers.discard(connection))
+
+    def __reply(self, connection, response):
+        connection.write(json.dumps(response).encode("utf-8") + b"\n")
+
+    def __handle(self, connection, line):
+        try:
+            request = json.loads(line)
+            command = request["command"]
+
+            if command == "peers":
+                return {"peers": [
+                    peerInfo(p) for p in self.__session.getPeers()]}
+
+            if command == "send":
+                if not self.__session.send(
+                        int(request["mac"]),
+                        str(request["message"])):
+                    return {"error": "unknown peer"}
+
+            elif command == "broadcast":
+                self.__session.broadcast(str(request["message"]))
+
+            elif command == "status":
+                self.__session.setStatus(str(request["status"]))
+
+            elif command == "subscribe":
+                self.__subscribers.add(connection)
+
+            else:
+                return {"error": "unknown command " + str(command)}
+
+        except (ValueError, KeyError, TypeError) as ex:
+            return {"error": "bad request: " + str(ex)}
+
+        return {"ok": True}
+
+    def __onEvent(self, event):
+        if not self.__subscribers:
+            return
+
+        line = json.dumps(eventInfo(event)).encode("utf-8") + b"\n"
+        for connection in self.__subscribers:
+            connection.write(line)
+
+
+def _address(parser, option, value):
+    """Returns (host, port) from the HOST:PORT value of option, or None."""
+    if value is None:
+        return None
+
+    host, sep, port = value.rpartition(":")
+    if not sep or not port.isdigit():
+        parser.error(option + " must be HOST:PORT")
+
+    return host, int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="SkyChat")
+    parser.add_argument("--headless", action="store_true",
+        help="run without a window")
+    parser.add_argument("--name", help="display name to announce")
+    parser.add_argument("--status", default="Online",
+        help="status to announce")
+    parser.add_argument("--mac", type=int,
+        help="MAC to announce instead of this machine's")
+    parser.add_argument("--data-dir",
+        help="directory to save conversations in")
+    parser.add_argument("--control-port", type=int, default=controlPort,
+        help="local port for the JSON control socket, 0 to turn it off")
+    parser.add_argument("--metrics-port", type=int,
+        help="local port to serve Prometheus metrics on")
+    parser.add_argument("--directory", metavar="HOST:PORT",
+        help="directory server to register with and find peers in")
+    parser.add_argument("--tls", action="store_true",
+        help="connect to peers over TLS; every client on the network must use it")
+    parser.add_argument("--hub", metavar="HOST:PORT",
+        help="relay hub to reach peers through; every client on the network must use it")
+    parser.add_argument("--log-level", default="info",
+        choices=("debug", "info", "warning", "error"),
+        help="least severe log messages to show")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if not args.headless:
+        import os
+        import runpy
+
+        runpy.run_path(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "__init__.py"),
+            run_name="__main__")
+        return
+
+    if args.name is None:
+        parser.error("--name is required with --headless")
+
+    if args.tls and args.hub is not None:
+        parser.error("--tls cannot be used with --hub")
+
+    directory = _address(parser, "--directory", args.directory)
+    hub = _address(parser, "--hub", args.hub)
+
+    session = Session(
+        args.name,
+        args.status,
+        args.mac,
+        queueSize=0,
+        dataDir=args.data_dir,
+        metricsPort=args.metrics_port,
+        tls=args.tls,
+        directory=directory,
+        hub=hub)
+
+    control = None
+    if args.control_port:
+        control = ControlServer(session, args.control_port)
+        log.info("Control socket listening on port %d", control.getPort())
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    stop.wait()
+
+    log.info("Logging out")
+    if control is not None:
+        control.close()
+
+    session.close()
@@ -0,0 +1,467 @@
+# -*- coding: utf-8 *-*
+
+"""
+A directory of clients, for finding peers that discovery broadcasts
+cannot reach, such as those on other subnets.
+
+The directory is a small server that any client can register with. A
+client keeps one TCP connection open to it, registers on that
+connection, and stays listed for as long as the connection is open.
+
+Requests and answers are JSON objects, one per frame (see Framing.py):
+
+	{"k": "register", "mac": M, "name": N, "status": S, "port": P}
+											- Lists the sender, at the address its connection comes
+											  from unless "address" is given. Registering again
+											  updates the entry.
+	{"k": "query", "epoch": E, "since": V}		- Answers with one delta
+	{"k": "subscribe", "epoch": E, "since": V}	- Answers with a delta, then sends a new delta
+											  whenever the directory changes
+
+	{"k": "delta", "epoch": E, "version": V, "reset": R,
+		"peers": [{"mac", "name", "status", "address", "port"}, ...], "removed": [M, ...]}
+
+Every change to the directory gets the next version number. A delta
+holds only the peers that changed after the version "since", and the
+MACs of those that left, so a client that was up to date gets a few
+entries however large the directory is. "version" is the version the
+delta brings the client up to, to send as "since" next time.
+
+The epoch changes every time the directory starts. When a client's
+epoch is not the directory's, or the removals it missed have been
+forgotten, the delta is a reset: it lists every peer, and the client
+drops the peers it had that are not listed.
+
+The directory is plain text, like discovery. Run one with
+
+	python Directory.py --port 8500
+
+and give its address to Client as directory=(host, port).
+
+
+
+Class Name: DirectoryServer
+	Serves a directory on a port. All of its functions run on the engine
+	thread unless they say otherwise.
+
+	Changes are kept in an ordered dictionary by MAC, oldest first, so a
+	delta is read backwards from the newest change and stops at the
+	client's version. Removed peers are kept as tombstones so they can
+	be sent as removals, up to maxRemoved of them. Changes are sent to
+	subscribers once per turn of the engine, so a burst of changes is
+	one delta.
+
+Data:
+	__engine				- Engine that serves the connections
+	__listener				- Listener the directory accepts connections on
+	__epoch					- Random number that identifies this run of the directory
+	__version				- Version of the last change
+	__changes				- (version, entry or None if removed) keyed by MAC, oldest change first
+	__tombstones			- (version, MAC) of each removal, oldest first
+	__oldest				- Removals up to this version have been forgotten
+	__maxRemoved			- Most removals kept
+	__owners				- Connection that registered each MAC
+	__registered			- MAC registered on each connection
+	__subscribers			- Version sent to each subscribed connection
+	__flushing				- True once a send to subscribers is scheduled
+
+Functions:
+	getPort					- Returns the port that was bound (any thread)
+	getVersion				- Returns the version of the last change
+	getPeers				- Returns the entry of every listed peer
+	delta					- Returns the delta from a version
+	close					- Stops serving (any thread)
+
+
+
+Class Name: DirectoryClient
+	Keeps a client registered with a directory and subscribed to its
+	changes. The connection is opened again, with back-off, whenever it
+	is lost, and the subscription resumes from the last version
+	received. All of its functions run on the engine thread unless they
+	say otherwise.
+
+Data:
+	__engine				- Engine that opens the connection
+	__address				- (host, port) of the directory
+	__contact				- This client's own contact, which is registered
+	__onFound				- Function called with a Discovery.Packet for every peer listed or updated
+	__onLost				- Function called with the MAC of every peer that left
+	__connection			- Connection to the directory, or None
+	__epoch					- Epoch of the directory's last delta, or None
+	__version				- Version of the directory's last delta
+	__listed				- MACs of the peers the directory lists
+	__retries				- Failed connections in a row
+	__timer					- Timer for the next connection, or None
+	__stopped				- True once stop has been called
+
+Functions:
+	start					- Connects to the directory
+	update					- Registers this client again, after its name or status changed (any thread)
+	stop					- Closes the connection, which takes this client out of the directory
+"""
+
+import argparse
+import collections
+import json
+import logging
+import signal
+import threading
+
+import Discovery
+import Engine
+import Framing
+
+
+directoryPort = 8500
+
+MAX_REQUEST = 64 * 1024
+MAX_DELTA = 16 * 1024 * 1024
+MAX_REMOVED = 10000
+MAX_TEXT_SIZE = 255
+
+CONNECT_TIMEOUT = 5.0
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+REGISTER = "register"
+QUERY = "query"
+SUBSCRIBE = "subscribe"
+DELTA = "delta"
+
+log = logging.getLogger("SkyChat.Directory")
+
+
+def _encode(packet):
+    return Framing.encodeText(json.dumps(packet, separators=(",", ":")))
+
+
+class DirectoryServer:
+
+    __flushing = False
+
+    def __init__(self, engine, port=directoryPort, host='', maxRemoved=MAX_REMOVED):
+        self.__engine = engine
+        self.__epoch = engine.random().getrandbits(48)
+        self.__version = 0
+        self.__oldest = 0
+        self.__maxRemoved = maxRemoved
+        self.__changes = collections.OrderedDict()
+        self.__tombstones = collections.deque()
+        self.__owners = {}
+        self.__registered = {}
+        self.__subscribers = {}
+        self.__listener = engine.listen(port, self.__onConnection, host)
+
+    def getPort(self):
+        return self.__listener.getPort()
+
+    def getVersion(self):
+        return self.__version
+
+    def getPeers(self):
+        return [entry for version, entry in self.__changes.values() if entry is not None]
+
+    def close(self):
+        self.__listener.close()
+
+    def delta(self, since, epoch=None):
+        """Returns the delta that brings a client at version since of
+        epoch up to date."""
+        reset = epoch != self.__epoch or since < self.__oldest or since > self.__version
+
+        if reset:
+            peers = self.getPeers()
+            removed = []
+        else:
+            peers = []
+            removed = []
+
+            # Newest first, as far back as the client's version
+            for mac, (version, entry) in reversed(self.__changes.items()):
+                if version <= since:
+                    break
+
+                if entry is None:
+                    removed.append(mac)
+                else:
+                    peers.append(entry)
+
+        return {
+            "k": DELTA,
+            "epoch": self.__epoch,
+            "version": self.__version,
+            "reset": reset,
+            "peers": peers,
+            "removed": removed}
+
+    def __onConnection(self, connection):
+        decoder = Framing.FrameDecoder(MAX_REQUEST, Framing.decodeText)
+
+        def onData(data):
+            try:
+                for frame in decoder.feed(data):
+                    self.__onRequest(connection, json.loads(frame))
+            except (Framing.FrameError, UnicodeDecodeError, ValueError, TypeError,
+                    KeyError, AttributeError) as ex:
+                log.warning("Bad request from %s: %s", connection.getPeerAddress(), ex)
+                connection.close()
+
+        connection.setHandlers(onData, lambda: self.__onClose(connection))
+
+    def __onRequest(self, connection, request):
+        kind = request["k"]
+
+        if kind == REGISTER:
+            self.__register(connection, request)
+
+        elif kind == QUERY or kind == SUBSCRIBE:
+            delta = self.delta(int(request.get("since", 0)), request.get("epoch"))
+            connection.write(_encode(delta))
+
+            if kind == SUBSCRIBE:
+                self.__subscribers[connection] = delta["version"]
+
+        else:
+            raise ValueError("unknown request " + str(kind))
+
+    def __register(self, connection, request):
+        mac = int(request["mac"])
+        address = request.get("address") or connection.getPeerAddress()[0]
+
+        entry = {
+            "mac": mac,
+            "name": str(request.get("name", ""))[:MAX_TEXT_SIZE],
+            "status": str(request.get("status", ""))[:MAX_TEXT_SIZE],
+            "address": str(address),
+            "port": int(request["port"])}
+
+        # A connection lists one peer, and the newest registration of a
+        # MAC wins
+        previous = self.__registered.get(connection)
+        if previous is not None and previous != mac:
+            self.__unregister(connection)
+
+        self.__owners[mac] = connection
+        self.__registered[connection] = mac
+
+        current = self.__changes.get(mac)
+        if current is not None and current[1] == entry:
+            return
+
+        self.__change(mac, entry)
+
+    def __unregister(self, connection):
+        mac = self.__registered.pop(connection, None)
+
+        if mac is not None and self.__owners.get(mac) is connection:
+            del self.__owners[mac]
+            self.__change(mac, None)
+
+    def __onClose(self, connection):
+        self.__subscribers.pop(connection, None)
+        self.__unregister(connection)
+
+    def __change(self, mac, entry):
+        self.__version += 1
+        self.__changes.pop(mac, None)
+        self.__changes[mac] = (self.__version, entry)
+
+        if entry is None:
+            self.__tombstones.append((self.__version, mac))
+
+            # Clients older than a forgotten removal get a reset
+            while len(self.__tombstones) > self.__maxRemoved:
+                version, removed = self.__tombstones.popleft()
+                if self.__changes.get(removed, (None,))[0] == version:
+                    del self.__changes[removed]
+                self.__oldest = version
+
+        if self.__subscribers and not self.__flushing:
+            self.__flushing = True
+            self.__engine.callSoon(self.__flush)
+
+    def __flush(self):
+        self.__flushing = False
+
+        for connection, version in list(self.__subscribers.items()):
+            if version < self.__version:
+                delta = self.delta(version, self.__epoch)
+                connection.write(_encode(delta))
+                self.__subscribers[connection] = delta["version"]
+
+
+class DirectoryClient:
+
+    __connection = None
+    __epoch = None
+    __version = 0
+    __timer = None
+    __stopped = False
+
+    def __init__(self, engine, address, contact, onFound, onLost):
+        self.__engine = engine
+        self.__address = address
+        self.__contact = contact
+        self.__onFound = onFound
+        self.__onLost = onLost
+        self.__listed = set()
+        self.__retries = 0
+
+    def start(self):
+        self.__timer = None
+
+        if self.__stopped:
+            return
+
+        self.__engine.connect(
+            self.__address[0],
+            self.__address[1],
+            self.__onConnected,
+            self.__onFailed,
+            CONNECT_TIMEOUT)
+
+    def update(self):
+        """Register again with this client's current name and status."""
+        self.__engine.callSoon(self.__register)
+
+    def stop(self):
+        self.__stopped = True
+
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+        if self.__connection is not None:
+            self.__connection.close()
+
+    def __register(self):
+        if self.__connection is None:
+            return
+
+        self.__connection.write(_encode({
+            "k": REGISTER,
+            "mac": self.__contact.getMAC(),
+            "name": self.__contact.getName(),
+            "status": self.__contact.getStatus(),
+            "port": self.__contact.getPort()}))
+
+    def __onConnected(self, connection):
+        if self.__stopped:
+            connection.close()
+            return
+
+        decoder = Framing.FrameDecoder(MAX_DELTA, Framing.decodeText)
+
+        def onData(data):
+            try:
+                for frame in decoder.feed(data):
+                    self.__onDelta(json.loads(frame))
+            except (Framing.FrameError, UnicodeDecodeError, ValueError, TypeError,
+                    KeyError) as ex:
+                log.warning("Bad delta from the directory: %s", ex)
+                connection.close()
+
+        self.__connection = connection
+        self.__retries = 0
+        connection.setHandlers(onData, self.__onClose)
+
+        log.info("Connected to the directory at %s:%d", *self.__address)
+
+        self.__register()
+        connection.write(_encode({
+            "k": SUBSCRIBE,
+            "epoch": self.__epoch,
+            "since": self.__version}))
+
+    def __onDelta(self, delta):
+        if delta["k"] != DELTA:
+            return
+
+        mac = self.__contact.getMAC()
+        listed = set()
+
+        for entry in delta["peers"]:
+            packet = Discovery.Packet(
+                Discovery.ANNOUNCE,
+                int(entry["mac"]),
+                int(entry["port"]),
+                entry["name"],
+                entry["status"],
+                False,
+                entry["address"])
+
+            if packet.mac != mac:
+                listed.add(packet.mac)
+                self.__onFound(packet)
+
+        removed = set(int(mac) for mac in delta["removed"])
+
+        # A reset lists everyone, so whoever is missing has left
+        if delta["reset"]:
+            removed |= self.__listed - listed
+
+        self.__listed |= listed
+        self.__listed -= removed
+
+        for peer in removed:
+            self.__onLost(peer)
+
+        self.__epoch = delta["epoch"]
+        self.__version = delta["version"]
+
+    def __onFailed(self, ex):
+        log.info("Could not connect to the directory: %s", ex)
+        self.__retry()
+
+    def __onClose(self):
+        self.__connection = None
+
+        if not self.__stopped:
+            log.info("Lost the connection to the directory")
+            self.__retry()
+
+    def __retry(self):
+        if self.__stopped:
+            return
+
+        self.__timer = self.__engine.callLater(
+            min(RETRY_DELAY * 2 ** self.__retries, MAX_RETRY_DELAY),
+            self.start)
+        self.__retries += 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SkyChat directory server")
+    parser.add_argument("--port", type=int, default=directoryPort,
+        help="TCP port to serve the directory on")
+    parser.add_argument("--host", default="",
+        help="interface to bind to. Default is all interfaces")
+    parser.add_argument("--log-level", default="info",
+        choices=("debug", "info", "warning", "error"),
+        help="least severe log messages to show")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    engine = Engine.Engine()
+    engine.start()
+
+    server = DirectoryServer(engine, args.port, args.host)
+    log.info("Serving the directory on port %d", server.getPort())
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    stop.wait()
+
+    server.close()
+    engine.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,538 @@
+# -*- coding: utf-8 *-*
+
+"""
+Discovery and control packets sent over UDP.
+
+Packets use a compact binary format that is decoded in a single pass:
+
+	magic					- 2 bytes, always b"SK"
+	version					- 1 byte, PACKET_VERSION
+	kind					- 1 byte, one of ANNOUNCE, REPLY, LOGOUT, STATUS, PEERS, HEARTBEAT or PROBE
+	mac						- 8 bytes, the sender's MAC
+	port					- 2 bytes, port the sender accepts connections on
+	status					- 1 byte length followed by UTF-8 text
+	name					- 1 byte length followed by UTF-8 text
+
+All numbers are big-endian. LOGOUT packets end after the port.
+
+HEARTBEAT packets are sent every few seconds to show the sender is
+still there (see Presence.py). After the name they hold:
+
+	interval				- 2 bytes, seconds until the sender's next heartbeat, at most
+
+ANNOUNCE, REPLY and PROBE packets may hold the same interval after the
+name, so a peer that crashes before its first heartbeat is not given the
+longest interval. Older clients leave it out.
+
+PROBE packets are sent to one peer, by a client that found it in its
+peer cache (see PeerCache.py), and are answered at once with a REPLY.
+They hold the same fields as ANNOUNCE, so clients that do not know
+PROBE treat them as an announcement.
+
+PEERS packets pack the records of several known peers into one
+datagram, so a new client learns the whole segment in a few packets.
+After the port they hold a 1 byte record count, then for each record:
+
+	mac						- 8 bytes
+	address					- 4 bytes, IPv4 address. 0.0.0.0 means the packet's source address
+	port					- 2 bytes
+	status					- 1 byte length followed by UTF-8 text
+	name					- 1 byte length followed by UTF-8 text
+
+The first record is always the sender.
+
+Clients from before this format send XML. Their packets are still
+understood, and encodeLegacy builds the XML they expect. They decode
+every datagram on the port as UTF-8 and stop listening when that
+fails, and a client cannot know they are there before it has sent its
+first packets. So binary packets are always sent armored: ARMOR
+followed by the packet in base64. Old clients take that for text that
+is neither a contact nor a command, and ignore it. Unarmored packets
+are still understood.
+
+Functions:
+	encodePacket			- Returns the bytes of a packet
+	encodeLegacy			- Returns the XML version of a packet for old clients
+	armor					- Returns a binary packet in the text form that old clients ignore
+	encodePeers				- Returns the PEERS datagrams listing a sender and its known peers
+	decodePacket			- Returns the Packet held by a datagram, or None if it is not a packet
+
+
+
+Class Name: Packet
+	A decoded packet. A named tuple with the fields kind, mac, port,
+	name, status, legacy, address, peers and interval. legacy is True
+	when the packet was sent in the old XML format. For PEERS packets,
+	peers is a list with a Packet for every record, and address is the
+	record's address or None. interval is the sender's heartbeat
+	interval, or None if the packet did not hold one.
+
+
+
+Class Name: DiscoveryScheduler
+	Sends every discovery packet for a client on its one long-lived UDP
+	socket, and spreads replies out so that many clients starting at
+	once do not answer each other all at the same time.
+
+	Replies to new clients wait a random delay that grows with the size
+	of the segment. Every new client heard during that delay is answered
+	by the same reply. When the delay ends the reply is a PEERS broadcast
+	listing every known peer. Any client that hears a PEERS broadcast
+	listing itself drops its own pending reply, since everyone on the
+	segment has just learned about it. PEERS broadcasts back off
+	exponentially while the segment stays busy, and a client that hears
+	anyone's PEERS broadcast holds its own back for PEERS_INTERVAL, so a
+	crowd starting at once sends a few full lists rather than one each.
+	In between, new clients get a plain unicast REPLY.
+
+Data:
+	__engine				- Engine that runs the timers
+	__endpoint				- The shared UDP socket
+	__contact				- This client's own contact
+	__peers					- Registry of known peers
+	__targets				- (address, port) pairs that broadcasts are sent to
+	__legacyPort			- Port that old clients listen on
+	__pending				- Addresses waiting for a reply, as the keys of a dictionary so
+							  they are answered in the order they were heard
+	__pendingLegacy			- Addresses of old clients waiting for an XML reply, the same way
+	__timer					- Timer for the next reply, or None
+	__peersInterval			- Current back-off between PEERS broadcasts
+	__nextPeers				- Engine time at which the next PEERS broadcast is allowed
+	__interval				- Heartbeat interval last sent, or None
+	__heartbeat				- Timer for the next heartbeat, or None
+	__sent					- Counter of discovery datagrams sent
+
+Functions:
+	start					- Sends the first announcement after a random delay, and starts the heartbeats
+	stop					- Stops the heartbeats and any pending reply
+	send					- Sends one of this client's packets right away
+	replyTo					- Queues a reply to a new client
+	heard					- Tells the scheduler about a packet from another client
+	setLegacy				- Sets whether XML copies of broadcasts are sent for old clients
+"""
+
+import base64
+import binascii
+import collections
+import socket
+import struct
+import xml.etree.ElementTree as etree
+
+import Metrics
+import Presence
+
+
+MAGIC = b"SK"
+ARMOR = b"sk:"
+PACKET_VERSION = 1
+
+ANNOUNCE = 1
+REPLY = 2
+LOGOUT = 3
+STATUS = 4
+PEERS = 5
+HEARTBEAT = 6
+PROBE = 7
+
+# Kinds that may hold the sender's heartbeat interval
+TIMED = (ANNOUNCE, REPLY, PROBE)
+
+HEADER = struct.Struct("!2sBBQH")
+RECORD = struct.Struct("!Q4sH")
+INTERVAL = struct.Struct("!H")
+MAX_TEXT_SIZE = 255
+MAX_DATAGRAM_SIZE = 1400
+MAX_RECORDS = 255
+
+# Largest PEERS datagram that is still no larger than MAX_DATAGRAM_SIZE
+# once armored
+MAX_ARMORED_SIZE = (MAX_DATAGRAM_SIZE - len(ARMOR)) // 4 * 3
+
+# Longest random delay before a reply, for a segment with a single peer
+# and for a segment of any size
+REPLY_JITTER = 0.25
+MAX_REPLY_JITTER = 5.0
+
+# Peers on the segment for every extra REPLY_JITTER of delay
+PEERS_PER_JITTER = 20
+
+# Longest random delay before the first announcement
+ANNOUNCE_JITTER = 0.5
+
+# Back-off between PEERS broadcasts
+PEERS_INTERVAL = 1.0
+MAX_PEERS_INTERVAL = 60.0
+
+Packet = collections.namedtuple(
+    "Packet",
+    ("kind", "mac", "port", "name", "status", "legacy", "address", "peers",
+        "interval"),
+    defaults=(None, None, None))
+
+
+def _encodeText(text):
+    data = text.encode("utf-8")[:MAX_TEXT_SIZE]
+    return bytes((len(data),)) + data
+
+
+def encodePacket(kind, mac, port=0, name="", status="", interval=0):
+    """Returns the bytes of a binary packet. interval is always sent in
+    HEARTBEAT packets, and in ANNOUNCE, REPLY and PROBE packets if it is
+    not 0."""
+    header = HEADER.pack(MAGIC, PACKET_VERSION, kind, mac, port)
+
+    if kind == LOGOUT:
+        return header
+
+    packet = header + _encodeText(status) + _encodeText(name)
+
+    if kind == HEARTBEAT or (kind in TIMED and interval):
+        packet += INTERVAL.pack(interval)
+
+    return packet
+
+
+def encodePeers(sender, peers, maxSize=MAX_DATAGRAM_SIZE):
+    """Returns a list of PEERS datagrams that list sender and every peer
+    in peers. Both are contacts. No datagram is longer than maxSize."""
+    header = HEADER.pack(
+        MAGIC, PACKET_VERSION, PEERS, sender.getMAC(), sender.getPort())
+
+    first = _encodeRecord(sender, "0.0.0.0")
+    datagrams = []
+    records = [first]
+    size = HEADER.size + 1 + len(first)
+
+    for peer in peers:
+        record = _encodeRecord(peer, peer.getAddress())
+
+        if size + len(record) > maxSize or \
+                len(records) == MAX_RECORDS:
+            datagrams.append(header + bytes((len(records),)) + b"".join(records))
+            records = [first]
+            size = HEADER.size + 1 + len(first)
+
+        records.append(record)
+        size += len(record)
+
+    datagrams.append(header + bytes((len(records),)) + b"".join(records))
+    return datagrams
+
+
+def _encodeRecord(contact, address):
+    try:
+        address = socket.inet_aton(address)
+    except (OSError, TypeError):
+        address = bytes(4)
+
+    return RECORD.pack(contact.getMAC(), address, contact.getPort()) + \
+        _encodeText(contact.getStatus()) + \
+        _encodeText(contact.getName())
+
+
+def encodeLegacy(kind, mac, name="", status=""):
+    """Returns the XML that old clients expect for a packet."""
+    if kind == LOGOUT:
+        return str('<control sender="' +
+            str(mac) +
+            '" command="logout" />').encode()
+
+    root = etree.Element("Contact", attrib={
+        "Name": name,
+        "Status": status,
+        "MAC": str(mac)})
+
+    return etree.tostring(root)
+
+
+def armor(packet):
+    """Returns a binary packet as ASCII text that old clients ignore."""
+    return ARMOR + base64.b64encode(packet)
+
+
+def decodePacket(data, defaultPort=0):
+    """Decode a datagram. defaultPort is used for old clients, which do
+    not send their port. Returns None if data is not a packet."""
+    if data[:len(ARMOR)] == ARMOR:
+        try:
+            data = base64.b64decode(data[len(ARMOR):], validate=True)
+        except (binascii.Error, ValueError):
+            return None
+
+        return _decodeBinary(data) if data[:2] == MAGIC else None
+
+    if data[:2] == MAGIC:
+        return _decodeBinary(data)
+
+    if data[:1] == b"<":
+        return _decodeLegacy(data, defaultPort)
+
+    return None
+
+
+def _decodeBinary(data):
+    if len(data) < HEADER.size:
+        return None
+
+    magic, version, kind, mac, port = HEADER.unpack_from(data)
+
+    # Newer versions only ever add fields to the end of the packet
+    if version < 1:
+        return None
+
+    if kind == LOGOUT:
+        return Packet(kind, mac, port, None, None, False)
+
+    try:
+        if kind == PEERS:
+            return _decodePeers(data, mac, port)
+
+        status, offset = _decodeText(data, HEADER.size)
+        name, offset = _decodeText(data, offset)
+
+        interval = None
+        if kind == HEARTBEAT or \
+                (kind in TIMED and len(data) >= offset + INTERVAL.size):
+            interval, = INTERVAL.unpack_from(data, offset)
+    except (IndexError, struct.error):
+        return None
+
+    return Packet(kind, mac, port, name, status, False, None, None, interval)
+
+
+def _decodeText(data, offset):
+    """Returns the text at offset and the offset just past it."""
+    length = data[offset]
+    end = offset + 1 + length
+
+    if end > len(data):
+        raise IndexError("text runs past the end of the packet")
+
+    return str(data[offset + 1:end], "utf-8", "ignore"), end
+
+
+def _decodePeers(data, mac, port):
+    peers = []
+    count = data[HEADER.size]
+    offset = HEADER.size + 1
+
+    for i in range(count):
+        peerMAC, address, peerPort = RECORD.unpack_from(data, offset)
+        status, offset = _decodeText(data, offset + RECORD.size)
+        name, offset = _decodeText(data, offset)
+
+        address = socket.inet_ntoa(address)
+        if address == "0.0.0.0":
+            address = None
+
+        peers.append(Packet(
+            ANNOUNCE, peerMAC, peerPort, name, status, False, address))
+
+    return Packet(PEERS, mac, port, None, None, False, None, peers)
+
+
+def _decodeLegacy(data, defaultPort):
+    try:
+        root = etree.fromstring(data.decode())
+        if root.tag == "Contact":
+            return Packet(
+                ANNOUNCE,
+                int(root.get("MAC")),
+                defaultPort,
+                root.get("Name"),
+                root.get("Status"),
+                True)
+
+        if root.tag == "control" and root.get("command") == "logout":
+            return Packet(
+                LOGOUT,
+                int(root.get("sender")),
+                defaultPort,
+                None,
+                None,
+                True)
+
+    except (etree.ParseError, UnicodeDecodeError, TypeError, ValueError):
+        pass
+
+    return None
+
+
+class DiscoveryScheduler:
+
+    __timer = None
+    __nextPeers = 0
+    __interval = None
+    __heartbeat = None
+
+    def __init__(self, engine, endpoint, contact, peers, targets,
+        legacy=False, metrics=Metrics.DISABLED):
+
+        self.__engine = engine
+        self.__endpoint = endpoint
+        self.__contact = contact
+        self.__peers = peers
+        self.__targets = list(targets)
+        self.__legacyPort = self.__targets[0][1]
+        self.__legacy = legacy
+        self.__pending = {}
+        self.__pendingLegacy = {}
+        self.__peersInterval = PEERS_INTERVAL
+        self.__sent = metrics.discoverySent
+
+    def __sendto(self, data, target):
+        self.__endpoint.sendto(data, target)
+        self.__sent.inc()
+
+    def setLegacy(self, value):
+        self.__legacy = value
+
+    def start(self):
+        """Send the first announcement after a random delay, so clients
+        that start together do not announce together. Must be called from
+        the engine thread."""
+        self.__engine.callLater(
+            self.__engine.random().uniform(0, ANNOUNCE_JITTER),
+            self.send,
+            ANNOUNCE)
+
+        self.__heartbeat = self.__engine.callLater(
+            self.__engine.random().uniform(0, Presence.HEARTBEAT_INTERVAL),
+            self.__sendHeartbeat)
+
+    def stop(self):
+        """Stop sending heartbeats and replies. Must be called from the
+        engine thread."""
+        for timer in (self.__heartbeat, self.__timer):
+            if timer is not None:
+                timer.cancel()
+
+        self.__heartbeat = self.__timer = None
+
+    def __sendHeartbeat(self):
+        self.__interval = Presence.heartbeatInterval(
+            len(self.__peers),
+            self.__interval)
+
+        packet = encodePacket(
+            HEARTBEAT,
+            self.__contact.getMAC(),
+            self.__contact.getPort(),
+            self.__contact.getName(),
+            self.__contact.getStatus(),
+            self.__interval)
+
+        packet = armor(packet)
+
+        for target in self.__targets:
+            self.__sendto(packet, target)
+
+        # Beat a little early, so one late packet is not a missed beat
+        self.__heartbeat = self.__engine.callLater(
+            self.__interval * self.__engine.random().uniform(0.8, 1.0),
+            self.__sendHeartbeat)
+
+    def send(self, kind, addr=None, legacy=None):
+        """Send this client's packet of the given kind right away, to addr
+        or to every broadcast target."""
+        if legacy is None:
+            legacy = self.__legacy
+
+        targets = self.__targets if addr is None else (addr,)
+
+        packet = self.__contact.getPacket(kind)
+
+        # The contact's packets are cached, so the interval is added here.
+        # The first heartbeat is never more than HEARTBEAT_INTERVAL away.
+        if kind in TIMED:
+            packet += INTERVAL.pack(
+                self.__interval or Presence.HEARTBEAT_INTERVAL)
+
+        packet = armor(packet)
+
+        for target in targets:
+            self.__sendto(packet, target)
+
+            # Old clients only understand XML, and never send a STATUS
+            if legacy and kind != STATUS:
+                self.__sendto(self.__contact.getData(kind), target)
+
+    def replyTo(self, addr, legacy=False):
+        """Queue a reply to a new client. addr is the (address, port) the
+        client's packet came from. Must be called from the engine thread."""
+        if legacy:
+            # Old clients send from a throwaway socket
+            self.__pendingLegacy[addr[0]] = None
+        else:
+            self.__pending[addr] = None
+
+        if self.__timer is None:
+            self.__timer = self.__engine.callLater(
+                self.__replyDelay(),
+                self.__flush)
+
+    def heard(self, packet):
+        """Drop the pending reply once a PEERS broadcast has told the
+        segment about this client, and hold back our own PEERS broadcast
+        while another one has just gone out."""
+        if packet.kind != PEERS:
+            return
+
+        self.__nextPeers = max(self.__nextPeers, self.__engine.time() + PEERS_INTERVAL)
+
+        if not self.__pending:
+            return
+
+        mac = self.__contact.getMAC()
+        for record in packet.peers:
+            if record.mac == mac:
+                self.__pending.clear()
+                self.__cancelIfIdle()
+                return
+
+    def __replyDelay(self):
+        jitter = REPLY_JITTER * (1 + len(self.__peers) / PEERS_PER_JITTER)
+        return self.__engine.random().uniform(0, min(jitter, MAX_REPLY_JITTER))
+
+    def __cancelIfIdle(self):
+        if self.__timer is not None and not self.__pendingLegacy:
+            self.__timer.cancel()
+            self.__timer = None
+
+    def __flush(self):
+        self.__timer = None
+
+        pendingLegacy, self.__pendingLegacy = self.__pendingLegacy, {}
+        for addr in pendingLegacy:
+            self.__sendto(
+                self.__contact.getData(REPLY),
+                (addr, self.__legacyPort))
+
+        pending, self.__pending = self.__pending, {}
+        if not pending:
+            return
+
+        now = self.__engine.time()
+
+        if now < self.__nextPeers:
+            for addr in pending:
+                self.send(REPLY, addr, False)
+            return
+
+        # Back off while the segment stays busy, and start over once it
+        # has been quiet for a while
+        if now - self.__nextPeers < MAX_PEERS_INTERVAL:
+            self.__peersInterval = min(
+                self.__peersInterval * 2,
+                MAX_PEERS_INTERVAL)
+        else:
+            self.__peersInterval = PEERS_INTERVAL
+
+        self.__nextPeers = now + self.__peersInterval
+
+        datagrams = [armor(datagram) for datagram in
+            encodePeers(self.__contact, self.__peers, MAX_ARMORED_SIZE)]
+
+        for datagram in datagrams:
+            for target in self.__targets:
+                self.__sendto(datagram, target)
@@ -0,0 +1,558 @@
+# -*- coding: utf-8 *-*
+
+"""
+Class Name: Engine
+	The Transport for real sockets.
+
+	This class runs a single asyncio event loop on a background thread.
+	The TCP listener, the UDP discovery socket and every peer connection
+	are served by that one loop, so the number of threads no longer grows
+	with the number of contacts.
+
+	Everything that touches a socket runs on the engine thread. Functions
+	that may be called from other threads say so below.
+
+Data:
+	__loop					- The asyncio event loop
+	__thread				- Thread that the event loop runs on
+	__tasks					- Connect tasks that are still running
+	__connections			- Every connection that is currently open
+	__random				- Random number generator, seeded by the system
+
+Functions:
+	start					- Starts the event loop thread
+	stop					- Closes all connections and stops the event loop
+	inEngineThread			- Returns True when called from the engine thread
+	callSoon				- Runs a function on the engine thread (any thread)
+	callLater				- Runs a function on the engine thread after a delay
+	time					- Returns the current time of the engine clock
+	random					- Returns the engine's random.Random
+	run						- Runs a coroutine on the loop and waits for its result (any thread except the engine's)
+	listen					- Binds a TCP socket and serves it on the loop (any thread except the engine's)
+
+	Input Params:
+		port				- Port to listen on
+		onConnection		- Function called with a Connection for every accepted socket
+		host				- Interface to bind to. Default is all interfaces
+		tls					- SSLContext to serve TLS with. Default is plain TCP
+
+	Output Params:			- A Listener
+
+	openDatagram			- Binds a UDP socket and serves it on the loop (any thread except the engine's)
+
+	Input Params:
+		port				- Port to bind to
+		onDatagram			- Function called with (data, address) for every datagram
+		host				- Interface to bind to. Default is all interfaces
+		reuse				- Let other sockets bind the same port, as multicast receivers must
+
+	Output Params:			- A DatagramEndpoint
+
+	connect					- Opens a TCP connection without blocking the caller (any thread)
+
+	Input Params:
+		host, port			- Address to connect to
+		onConnected			- Function called with the new Connection
+		onFailed			- Function called with the error if the connection could not be made
+		timeout				- Seconds to wait before giving up. Default is to wait forever
+		tls					- SSLContext to open a TLS connection with. Default is plain TCP
+		serverName			- Server name sent in the TLS handshake
+
+	Output Params:			- None
+
+
+
+Class Name: Connection
+	A TCP stream served by the engine.
+
+	Everything written in one turn of the event loop is handed to the
+	socket at the end of the turn with one writelines, so a burst of
+	small messages costs one send instead of one each.
+
+	The socket's write buffer has a high water mark of HIGH_WATER
+	bytes. Once more than that is waiting, the connection is no longer
+	writable until the buffer drains below LOW_WATER. Data written in
+	this turn counts too. A connection that sends nothing for
+	STALL_TIMEOUT seconds while above the mark has a peer that stopped
+	reading, and is closed.
+
+Data:
+	__queued				- Data written in this turn of the loop, not yet given to the socket
+	__queuedSize			- Bytes in __queued
+	__writable				- False while the socket's write buffer is over the high water mark
+	__reported				- Whether the connection was writable when __onWritable was last called
+	__onWritable			- Function called with True or False when the connection stops or starts
+							  being writable, or None
+	__stallTimer			- Timer that checks the write buffer drains while it is full, or None
+	__buffered				- Size of the write buffer at the last check
+
+Functions:
+	setHandlers				- Sets the functions called when data arrives and when the stream closes.
+							  Data that arrived before the handlers were set is delivered immediately.
+	setWritableHandler		- Sets the function called with False when the write buffer goes over
+							  the high water mark, and with True when it drains below the low one
+	isWritable				- Returns False while the data waiting to be sent is over the high water mark
+	write					- Queues data to be sent (any thread)
+	sendfile				- Sends part of a file with os.sendfile where the platform has it (any thread)
+	close					- Closes the stream (any thread)
+	getPeerAddress			- Returns the (address, port) of the other end
+	getTls					- Returns the SSLObject of a TLS connection, or None
+	isOutbound				- Returns True if this end opened the connection
+	isClosed				- Returns True once the stream has been closed
+
+
+
+Class Name: DatagramEndpoint
+	A UDP socket served by the engine.
+
+Functions:
+	sendto					- Sends a datagram (any thread)
+	joinGroup				- Joins a multicast group on the default interface
+	leaveGroup				- Leaves a multicast group
+	close					- Closes the socket (any thread)
+	getPort					- Returns the port the socket is bound to
+
+
+
+Class Name: Listener
+	A listening TCP socket served by the engine.
+
+Functions:
+	close					- Stops accepting connections (any thread)
+	getPort					- Returns the port the socket is bound to
+"""
+
+import asyncio
+import logging
+import random
+import socket
+import threading
+
+import Transport
+
+
+HIGH_WATER = 1024 * 1024
+LOW_WATER = 256 * 1024
+STALL_TIMEOUT = 30.0
+
+log = logging.getLogger("SkyChat.Engine")
+
+
+class Engine(Transport.Transport):
+
+    __loop = None
+    __thread = None
+
+    def __init__(self):
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__tasks = set()
+        self.__connections = set()
+        self.__random = random.Random()
+
+    def __run(self):
+        asyncio.set_event_loop(self.__loop)
+        self.__loop.run_forever()
+
+        # Let cancelled tasks finish before the loop goes away
+        for task in asyncio.all_tasks(self.__loop):
+            task.cancel()
+
+        self.__loop.run_until_complete(asyncio.sleep(0))
+        self.__loop.close()
+
+    def start(self):
+        """Start the event loop thread if it is not running yet."""
+        if not self.__thread.is_alive() and not self.__loop.is_closed():
+            self.__thread.start()
+
+    def stop(self):
+        """Close every open connection and stop the event loop."""
+        if self.__loop.is_closed() or not self.__thread.is_alive():
+            return
+
+        self.callSoon(self.__stop)
+
+        if not self.inEngineThread():
+            self.__thread.join()
+
+    def __stop(self):
+        for connection in list(self.__connections):
+            connection.close()
+
+        self.__loop.stop()
+
+    def inEngineThread(self):
+        return threading.current_thread() is self.__thread
+
+    def callSoon(self, callback, *args):
+        """Run a function on the engine thread."""
+        if self.inEngineThread():
+            self.__loop.call_soon(callback, *args)
+        else:
+            self.__loop.call_soon_threadsafe(callback, *args)
+
+    def callLater(self, delay, callback, *args):
+        """Run a function on the engine thread after delay seconds. Must be
+        called from the engine thread. Returns a handle with a cancel()
+        method."""
+        return self.__loop.call_later(delay, callback, *args)
+
+    def time(self):
+        return self.__loop.time()
+
+    def random(self):
+        return self.__random
+
+    def run(self, coro):
+        """Run a coroutine on the event loop and wait for its result."""
+        if self.inEngineThread():
+            raise RuntimeError("Engine.run() cannot wait on the engine thread")
+
+        return asyncio.run_coroutine_threadsafe(coro, self.__loop).result()
+
+    def listen(self, port, onConnection, host='', tls=None):
+        """Bind a TCP socket and accept connections on the event loop."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+
+        try:
+            sock.bind((host, port))
+            sock.listen(128)
+            sock.setblocking(False)
+        except socket.error:
+            sock.close()
+            raise
+
+        server = self.run(self.__loop.create_server(
+            lambda: Connection(self, onConnection),
+            sock=sock,
+            ssl=tls))
+
+        return Listener(self, server, sock.getsockname()[1])
+
+    def openDatagram(self, port, onDatagram, host='', reuse=False):
+        """Bind a UDP socket and receive datagrams on the event loop."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
+
+        if reuse:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+            if hasattr(socket, "SO_REUSEPORT"):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
+
+        try:
+            sock.bind((host, port))
+            sock.setblocking(False)
+        except socket.error:
+            sock.close()
+            raise
+
+        transport, endpoint = self.run(
+            self.__loop.create_datagram_endpoint(
+                lambda: DatagramEndpoint(self, onDatagram),
+                sock=sock))
+
+        return endpoint
+
+    def connect(self, host, port, onConnected, onFailed=None, timeout=None, tls=None,
+        serverName=None):
+        """Open a TCP connection without blocking the caller."""
+        self.callSoon(self.__startConnect,
+            host, port, onConnected, onFailed, timeout, tls, serverName)
+
+    def __startConnect(self, host, port, onConnected, onFailed, timeout, tls, serverName):
+        self.__startTask(
+            self.__connect(host, port, onConnected, onFailed, timeout, tls, serverName))
+
+    def __startTask(self, coro):
+        task = self.__loop.create_task(coro)
+
+        # The loop only keeps weak references to its tasks
+        self.__tasks.add(task)
+        task.add_done_callback(self.__tasks.discard)
+
+    async def __connect(self, host, port, onConnected, onFailed, timeout, tls, serverName):
+        try:
+            transport, connection = await asyncio.wait_for(
+                self.__loop.create_connection(
+                    lambda: Connection(self, outbound=True), host, port,
+                    ssl=tls, server_hostname=serverName if tls is not None else None),
+                timeout)
+
+        except (OSError, asyncio.TimeoutError) as ex:
+            if onFailed is not None:
+                onFailed(ex)
+            return
+
+        onConnected(connection)
+
+    def _sendfile(self, transport, file, offset, count, onDone):
+        self.__startTask(self.__sendfile(transport, file, offset, count, onDone))
+
+    async def __sendfile(self, transport, file, offset, count, onDone):
+        try:
+            await self.__loop.sendfile(transport, file, offset, count)
+        except (OSError, RuntimeError) as ex:
+            onDone(ex)
+            return
+
+        onDone(None)
+
+    def _addConnection(self, connection):
+        self.__connections.add(connection)
+
+    def _removeConnection(self, connection):
+        self.__connections.discard(connection)
+
+
+class Connection(asyncio.Protocol, Transport.Connection):
+
+    __transport = None
+    __onData = None
+    __onClose = None
+    __onWritable = None
+    __stallTimer = None
+    __closed = False
+    __writable = True
+    __reported = True
+    __buffered = 0
+    __queuedSize = 0
+
+    def __init__(self, engine, onConnection=None, outbound=False):
+        self.__engine = engine
+        self.__onConnection = onConnection
+        self.__outbound = outbound
+        self.__pending = []
+        self.__queued = []
+
+    def connection_made(self, transport):
+        self.__transport = transport
+        self.__engine._addConnection(self)
+
+        transport.get_extra_info("socket").setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        transport.set_write_buffer_limits(HIGH_WATER, LOW_WATER)
+
+        if self.__onConnection is not None:
+            self.__onConnection(self)
+
+    def data_received(self, data):
+        if self.__onData is None:
+            self.__pending.append(data)
+        else:
+            self.__onData(data)
+
+    def connection_lost(self, exc):
+        self.__closed = True
+        self.__transport = None
+        self.__queued = []
+        self.__queuedSize = 0
+        self.__engine._removeConnection(self)
+
+        if self.__stallTimer is not None:
+            self.__stallTimer.cancel()
+            self.__stallTimer = None
+
+        if self.__onClose is not None:
+            self.__onClose()
+
+    def setHandlers(self, onData, onClose):
+        """Set the functions used when data arrives and when the connection
+        closes. Must be called from the engine thread."""
+        self.__onData = onData
+        self.__onClose = onClose
+
+        pending, self.__pending = self.__pending, []
+        for data in pending:
+            onData(data)
+
+        if self.__closed:
+            onClose()
+
+    def pause_writing(self):
+        self.__writable = False
+        self.__buffered = self.__transport.get_write_buffer_size()
+        self.__stallTimer = self.__engine.callLater(STALL_TIMEOUT, self.__checkStall)
+        self.__update()
+
+    def resume_writing(self):
+        self.__writable = True
+
+        if self.__stallTimer is not None:
+            self.__stallTimer.cancel()
+            self.__stallTimer = None
+
+        self.__update()
+
+    def __update(self):
+        """Tell the writable handler if the connection stopped or started
+        being writable."""
+        writable = self.isWritable()
+
+        if writable != self.__reported:
+            self.__reported = writable
+            if self.__onWritable is not None:
+                self.__onWritable(writable)
+
+    def __checkStall(self):
+        """Close the connection if nothing was sent since the last check.
+        A slow peer that is still reading is given more time."""
+        self.__stallTimer = None
+        if self.__transport is None:
+            return
+
+        buffered = self.__transport.get_write_buffer_size()
+
+        if buffered >= self.__buffered:
+            log.warning("Closing the connection to %s, which stopped reading",
+                self.getPeerAddress())
+            self.__transport.abort()
+            return
+
+        self.__buffered = buffered
+        self.__stallTimer = self.__engine.callLater(STALL_TIMEOUT, self.__checkStall)
+
+    def setWritableHandler(self, onWritable):
+        """Must be called from the engine thread."""
+        self.__onWritable = onWritable
+
+    def isWritable(self):
+        return self.__writable and self.__queuedSize <= HIGH_WATER
+
+    def getPeerAddress(self):
+        if self.__transport is None:
+            return None
+
+        return self.__transport.get_extra_info("peername")
+
+    def getTls(self):
+        if self.__transport is None:
+            return None
+
+        return self.__transport.get_extra_info("ssl_object")
+
+    def isClosed(self):
+        return self.__closed
+
+    def isOutbound(self):
+        return self.__outbound
+
+    def write(self, data):
+        """Queue data to be sent on this connection. data is sent at the
+        end of this turn of the loop, and must not change until then."""
+        if not self.__engine.inEngineThread():
+            self.__engine.callSoon(self.write, data)
+            return
+
+        if self.__transport is None:
+            return
+
+        # Everything written this turn goes out together
+        if not self.__queued:
+            self.__engine.callSoon(self.__flush)
+
+        self.__queued.append(data)
+        self.__queuedSize += len(data)
+        self.__update()
+
+    def __flush(self):
+        queued, self.__queued = self.__queued, []
+        self.__queuedSize = 0
+
+        if queued and self.__transport is not None:
+            self.__transport.writelines(queued)
+            self.__update()
+
+    def sendfile(self, file, offset, count, onDone):
+        """Send count bytes of file, starting at offset, then call onDone
+        with None, or with the error if sending failed."""
+        if not self.__engine.inEngineThread():
+            self.__engine.callSoon(self.sendfile, file, offset, count, onDone)
+            return
+
+        if self.__transport is None:
+            onDone(ConnectionError("connection is closed"))
+            return
+
+        self.__flush()
+        self.__engine._sendfile(self.__transport, file, offset, count, onDone)
+
+    def close(self):
+        """Close this connection."""
+        if not self.__engine.inEngineThread():
+            self.__engine.callSoon(self.close)
+            return
+
+        if self.__transport is not None:
+            self.__flush()
+            self.__transport.close()
+
+
+class DatagramEndpoint(asyncio.DatagramProtocol, Transport.DatagramEndpoint):
+
+    __transport = None
+
+    def __init__(self, engine, onDatagram):
+        self.__engine = engine
+        self.__onDatagram = onDatagram
+
+    def connection_made(self, transport):
+        self.__transport = transport
+
+    def datagram_received(self, data, addr):
+        self.__onDatagram(data, addr)
+
+    def error_received(self, exc):
+        log.warning("Datagram error: %s", exc)
+
+    def getPort(self):
+        return self.__transport.get_extra_info("sockname")[1]
+
+    def sendto(self, data, addr):
+        """Send a datagram to addr."""
+        if not self.__engine.inEngineThread():
+            self.__engine.callSoon(self.sendto, data, addr)
+            return
+
+        if self.__transport is not None and not self.__transport.is_closing():
+            self.__transport.sendto(data, addr)
+
+    def joinGroup(self, address):
+        """Receive datagrams sent to the multicast group address."""
+        self.__membership(socket.IP_ADD_MEMBERSHIP, address)
+
+    def leaveGroup(self, address):
+        self.__membership(socket.IP_DROP_MEMBERSHIP, address)
+
+    def __membership(self, option, address):
+        if self.__transport is None:
+            raise OSError("socket is closed")
+
+        self.__transport.get_extra_info("socket").setsockopt(
+            socket.IPPROTO_IP,
+            option,
+            socket.inet_aton(address) + socket.inet_aton("0.0.0.0"))
+
+    def close(self):
+        if not self.__engine.inEngineThread():
+            self.__engine.callSoon(self.close)
+            return
+
+        if self.__transport is not None:
+            self.__transport.close()
+
+
+class Listener(Transport.Listener):
+
+    def __init__(self, engine, server, port):
+        self.__engine = engine
+        self.__server = server
+        self.__port = port
+
+    def getPort(self):
+        return self.__port
+
+    def close(self):
+        """Stop accepting new connections."""
+        self.__engine.callSoon(self.__server.close)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 *-*
+
+"""
+Wire framing for messages sent between contacts.
+
+Every message is sent as a frame: a 4 byte big-endian payload length
+followed by the payload. A single chunk of received data may hold many
+frames, and a single frame may arrive split over many chunks.
+
+Text messages that start with CONTROL are control frames between
+clients, such as group packets, and are never shown to the user.
+
+Functions:
+	encodeFrame				- Returns the frame for a payload
+	encodeText				- Returns the frame for a text message
+	decodeText				- Decodes a frame payload into a text message
+
+
+
+Class Name: FrameDecoder
+	Splits a stream of received data back into frames.
+
+	Received data is copied into one receive buffer that is reused for
+	the life of the connection. The buffer grows when a frame does not
+	fit and shrinks back once a large frame has been consumed.
+
+Data:
+	__buffer				- The receive buffer
+	__start					- Offset of the first unread byte in __buffer
+	__end					- Offset just past the last received byte in __buffer
+	__maxFrameSize			- Largest payload that will be accepted
+	__decode				- Function used to turn a payload into a message
+
+Functions:
+
+	__init__				- Constructor
+
+	Input Params:
+		maxFrameSize		- Largest payload that will be accepted
+		decode				- Function called with a memoryview of each payload. Its result
+							  is returned by feed. It must not keep a reference to the view.
+							  Default is bytes.
+
+	feed					- Adds received data to the buffer
+
+	Input Params:
+		data				- The received data
+		limit				- Largest number of frames to return. The rest stay in the buffer
+							  for the next call. Default is no limit.
+
+	Output Params:			- A list with the decoded payload of every frame completed by data
+
+	Raises FrameError if a frame is larger than maxFrameSize.
+
+	takeRemainder			- Returns the buffered bytes that have not been returned as
+							  frames and empties the buffer, for streams that stop
+							  being framed
+"""
+
+import struct
+
+
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+INITIAL_BUFFER_SIZE = 4096
+MAX_IDLE_BUFFER_SIZE = 256 * 1024
+
+CONTROL = "\x00"
+
+
+class FrameError(ValueError):
+    """Raised when the received data is not a valid frame."""
+
+
+def encodeFrame(payload):
+    return HEADER.pack(len(payload)) + payload
+
+
+def encodeText(message):
+    return encodeFrame(message.encode("utf-8"))
+
+
+def decodeText(payload):
+    return str(payload, "utf-8")
+
+
+class FrameDecoder:
+
+    __start = 0
+    __end = 0
+
+    def __init__(self, maxFrameSize=MAX_FRAME_SIZE, decode=bytes):
+        self.__maxFrameSize = maxFrameSize
+        self.__decode = decode
+        self.__buffer = bytearray(INITIAL_BUFFER_SIZE)
+
+    def feed(self, data, limit=None):
+        """Add received data and return every frame that is now complete,
+        or the first limit of them."""
+        size = len(data)
+
+        if self.__end + size > len(self.__buffer):
+            self.__makeRoom(size)
+
+        self.__buffer[self.__end:self.__end + size] = data
+        self.__end += size
+
+        return self.__frames(limit)
+
+    def takeRemainder(self):
+        """Return the bytes not yet returned as frames and empty the
+        buffer."""
+        remainder = bytes(self.__buffer[self.__start:self.__end])
+        self.__start = self.__end = 0
+        return remainder
+
+    def __makeRoom(self, size):
+        """Make room for size more bytes at the end of the buffer."""
+        unread = self.__end - self.__start
+
+        # Move the unread bytes to the front of the buffer
+        if self.__start > 0:
+            self.__buffer[:unread] = self.__buffer[self.__start:self.__end]
+            self.__start = 0
+            self.__end = unread
+
+        capacity = len(self.__buffer)
+        while capacity < unread + size:
+            capacity *= 2
+
+        if capacity > len(self.__buffer):
+            self.__buffer.extend(bytes(capacity - len(self.__buffer)))
+
+    def __frames(self, limit):
+        frames = []
+        buff = self.__buffer
+        start = self.__start
+        end = self.__end
+
+        with memoryview(buff) as view:
+            while end - start >= HEADER.size and len(frames) != limit:
+                length, = HEADER.unpack_from(buff, start)
+
+                if length > self.__maxFrameSize:
+                    raise FrameError(
+                        "Frame of %d bytes is larger than %d bytes" %
+                        (length, self.__maxFrameSize))
+
+                begin = start + HEADER.size
+                if end - begin < length:
+                    break
+
+                frames.append(self.__decode(view[begin:begin + length]))
+                start = begin + length
+
+        if start == end:
+            start = end = 0
+
+            # Give back the memory used by an unusually large frame
+            if len(buff) > MAX_IDLE_BUFFER_SIZE:
+                self.__buffer = bytearray(INITIAL_BUFFER_SIZE)
+
+        self.__start = start
+        self.__end = end
+
+        return frames
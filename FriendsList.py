@@ -3,8 +3,19 @@
 from tkinter import *
 from tkinter import ttk
 import tkinter.simpledialog as simpledialog
+import logging
 import SkyChat
 import ChatWindow
+import FriendsModel
+import Groups
+import UIQueue
+
+
+ADDED = "added"
+REMOVED = "removed"
+UPDATED = "updated"
+
+log = logging.getLogger("SkyChat.FriendsList")
 
 
 class FriendsList(ttk.Frame):
@@ -12,12 +23,14 @@ class FriendsList(ttk.Frame):
     __client = None
     __contact = None
     __chatWindows = []
-    __newConvQueue = []
-    __offlineContactQueue = []
+    __ui = None
 
     def __init__(self, parent):
         Frame.__init__(self, parent)
 
+        # Sorted, searchable rows of lstFriends
+        self.__model = FriendsModel.FriendsModel()
+
         self.parent = parent
         self.initUI()
         self.parent.withdraw()
@@ -28,16 +41,21 @@ class FriendsList(ttk.Frame):
 
         self.__contact = SkyChat.Contact(name=userName)
 
-        self.__checkConversationQueue()
+        # Every client callback reaches the widgets through this queue
+        self.__ui = UIQueue.UIQueue(self.parent)
 
         self.__client = SkyChat.Client(
             self.__contact,
             self.newPeer,
             self.__newConversation,
-            self.removePeer)
+            self.removePeer,
+            updatePeer=self.updatePeer,
+            newGroup=self.__newConversation,
+            newTransfer=self.__newTransfer)
 
     def logout(self):
         self.__client.logout()
+        self.__ui.close()
 
     def initUI(self):
         """Create the friends list user interface."""
@@ -47,6 +65,12 @@ class FriendsList(ttk.Frame):
         self.parent.geometry("200x400+100+100")
         self.pack(fill=BOTH, expand=1)
 
+        # Filter the list as the user types
+        self.varSearch = StringVar()
+        self.varSearch.trace_add("write", self.__onSearch)
+        self.txtSearch = Entry(self, textvariable=self.varSearch)
+        self.txtSearch.pack(side=TOP, fill=X)
+
         # Create a scrollbar
         self.scrollFriends = Scrollbar(self, orient=VERTICAL)
 
@@ -74,60 +98,142 @@ class FriendsList(ttk.Frame):
         self.parent.config(menu=self.mnuBar)
 
         self.mnuFile = Menu(self.mnuBar)
+        self.mnuFile.add_command(label="New Group...", command=self.mnuFileNewGroup_Click)
         self.mnuFile.add_command(label="Exit", command=self.mnuFileExit_Click)
         self.mnuBar.add_cascade(label="File", menu=self.mnuFile)
 
 
-    def __checkConversationQueue(self):
-        """Open a conversation windonw from the main UI thread."""
-        if len(self.__newConvQueue) > 0:
-            print("Queue item available")
-            peer = self.__newConvQueue.pop()
-            wndChat = None
+    def __openConversations(self, peers):
+        """Open conversation windows from the main UI thread."""
+        for peer in peers:
+            self.__openConversation(peer)
 
-            # If a window is already open for this contact, attatch the
-            # connection to that window
-            for wnd in self.__chatWindows:
-                if (wnd.getContact().getMAC() == peer.getMAC()):
-                    if wnd.getIsOpen():
-                        wndChat = wnd
-                        wnd.setContact(peer)
-                    else:
-                        self.__chatWindows.remove(wnd)
-                    break
+    def __offerFiles(self, transfers):
+        """Ask the user about offered files in the sender's window."""
+        for transfer in transfers:
+            self.__openConversation(transfer.getContact()).offerFile(transfer)
 
-            # Open a new window if needed
-            if wndChat is None:
-                wndChat = ChatWindow.ChatWindow(
-                    contact=peer,
-                    user=self.__contact)
+    def __openConversation(self, peer):
+        """Returns the window for the conversation with peer, opening one
+        if needed."""
+        wndChat = None
 
-                self.__chatWindows.append(wndChat)
+        # If a window is already open for this contact, attatch the
+        # connection to that window
+        for wnd in self.__chatWindows:
+            if self.__isSameConversation(wnd, peer):
+                if wnd.getIsOpen():
+                    wndChat = wnd
+                    wnd.setContact(peer)
+                else:
+                    self.__chatWindows.remove(wnd)
+                break
 
-        # Check for new requests every 500 miliseconds
-        self.parent.after(500, self.__checkConversationQueue)
+        # Open a new window if needed
+        if wndChat is None:
+            wndChat = ChatWindow.ChatWindow(
+                contact=peer,
+                user=self.__contact,
+                ui=self.__ui)
 
-    def newPeer(self, peer):
-        """Callback function that is used whenever a new peer is discovered
-        by the client."""
+            self.__chatWindows.append(wndChat)
 
-        print("Found new peer", peer.getName())
-        self.lstFriends.insert(0, peer.getName())
+        return wndChat
 
-    def removePeer(self, index):
-        """Removes a peer from the friends list when they log out."""
-        print("Removing peer", str(index))
-        self.lstFriends.delete(index)
+    def __isSameConversation(self, wnd, peer):
+        """Returns True if wnd shows the conversation with peer, which is a
+        contact or a group."""
+        if isinstance(peer, Groups.Group):
+            return wnd.isGroup() and wnd.getContact().getId() == peer.getId()
+
+        return not wnd.isGroup() and wnd.getContact().getMAC() == peer.getMAC()
+
+    def newPeer(self, peer):
+        """Callback function that is used whenever a new peer is discovered
+        by the client. May be called from any thread."""
+
+        log.info("Found new peer %s", peer.getName())
+        self.__ui.post(self.__changePeers, (ADDED, peer))
+
+    def removePeer(self, peer):
+        """Removes a peer from the friends list when they log out. May be
+        called from any thread."""
+        log.info("Removing peer %s", peer.getName())
+        self.__ui.post(self.__changePeers, (REMOVED, peer))
+
+    def updatePeer(self, peer):
+        """Moves a peer that changed its name. May be called from any
+        thread."""
+        self.__ui.post(self.__changePeers, (UPDATED, peer))
+
+    def __changePeers(self, changes):
+        """Apply a batch of (kind, peer) changes to the list, keeping only
+        the last change of each peer."""
+        added = {}
+        removed = {}
+        updated = {}
+
+        for kind, peer in changes:
+            peerId = peer.getId()
+
+            if kind == ADDED:
+                added[peerId] = peer
+            elif kind == REMOVED:
+                updated.pop(peerId, None)
+                if added.pop(peerId, None) is None:
+                    removed[peerId] = peer
+            elif peerId not in added:
+                updated[peerId] = peer
+
+        self.__edit(self.__model.apply(
+            added.values(),
+            removed.values(),
+            updated.values()))
+
+    def __onSearch(self, *args):
+        self.__edit(self.__model.setFilter(self.varSearch.get()))
+
+    def __edit(self, edits):
+        """Apply the model's row edits to lstFriends."""
+        for edit in edits:
+            if edit[0] == "delete":
+                self.lstFriends.delete(edit[1], edit[2])
+            else:
+                self.lstFriends.insert(edit[1], *edit[2])
 
     def __newConversation(self, peer):
         """Queue the creation of a new conversation window."""
-        print("New conversation with", peer.getName())
-        self.__newConvQueue.append(peer)
+        log.info("New conversation with %s", peer.getName())
+        self.__ui.post(self.__openConversations, peer)
+
+    def __newTransfer(self, transfer):
+        """Queue a file offer to be shown to the user."""
+        log.info("File offered by %s", transfer.getContact().getName())
+        self.__ui.post(self.__offerFiles, transfer)
 
     def __openWindow(self, args):
         """Callback function to create a new conversation window."""
-        self.__newConversation(
-            self.__client.getPeers()[int(self.lstFriends.curselection()[0])])
+        selection = self.lstFriends.curselection()
+        if not selection:
+            return
+
+        peer = self.__client.getPeer(self.__model.getId(int(selection[0])))
+
+        if peer is not None:
+            self.__openConversation(peer)
+
+    def mnuFileNewGroup_Click(self):
+        """Start a group conversation with the selected friends"""
+        peers = [self.__client.getPeer(self.__model.getId(int(row)))
+            for row in self.lstFriends.curselection()]
+        peers = [peer for peer in peers if peer is not None]
+
+        if not peers:
+            return
+
+        name = simpledialog.askstring("New Group", "Group name")
+        if name:
+            self.__openConversation(self.__client.createGroup(name, peers))
 
     def mnuFileExit_Click(self):
         """Let the user exit"""
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 *-*
+
+"""
+Class Name: FriendsModel
+	The rows of the friends list, without any Tk. Peers are kept sorted
+	by name as they come and go, and the list can be filtered by a search
+	string as the user types.
+
+	Every peer has a sort key of (folded name, peer ID). The keys are kept
+	in a sorted list, so a peer is placed with a binary search instead of
+	sorting the whole list again. A large batch is merged with one sort.
+
+	Searching goes through an index from every piece of up to GRAM
+	characters of each name to the peers whose name holds it. A search of
+	up to GRAM characters is one lookup. A longer one intersects the sets
+	of its pieces and only checks the names left, so a search never reads
+	every name.
+
+	Changes are applied in batches. apply returns the edits that turn the
+	rows shown before into the rows shown after, as runs of neighbouring
+	rows, so the Listbox is updated with a few calls no matter how many
+	peers changed. When a batch touches too many runs, the edits replace
+	every row at once.
+
+	Peers read from the peer cache are shown with UNVERIFIED after their
+	name until they are heard from. Searches only look at the name.
+
+Data:
+	__keys					- Sort key of every peer, sorted
+	__byId					- Sort key of every peer, keyed by peer ID
+	__names					- Name shown for every peer, keyed by peer ID
+	__index					- Peer IDs keyed by every piece of their folded names
+	__filter				- Folded search string, or "" to show every peer
+	__visible				- Sort keys of the rows shown, sorted
+
+Functions:
+	apply					- Adds, removes and updates peers
+
+	Input Params:
+		added				- Peers that were found
+		removed				- Peers that left
+		updated				- Peers whose name changed, or that were verified
+
+	Output Params:			- List of edits to the rows shown, in order:
+							  ("delete", first, last) removes rows first to last
+							  ("insert", row, names) inserts names before row
+
+	setFilter				- Shows only the peers whose name holds a string, and returns
+							  the edits to the rows shown
+	search					- Returns the IDs of the peers whose name holds a string, by name
+	getId					- Returns the peer ID shown on a row
+	getNames				- Returns the names of the rows shown
+	__len__					- Returns the number of rows shown
+"""
+
+import bisect
+
+
+GRAM = 3
+MAX_RUNS = 64
+UNVERIFIED = " (unverified)"
+
+
+def fold(name):
+    """Returns the form of a name that is sorted and searched."""
+    return name.casefold()
+
+
+def label(peer):
+    """Returns the text shown for peer."""
+    if peer.isVerified():
+        return peer.getName()
+
+    return peer.getName() + UNVERIFIED
+
+
+def pieces(text):
+    """Returns every piece of text of up to GRAM characters."""
+    return set(text[i:i + n]
+        for n in range(1, GRAM + 1)
+        for i in range(len(text) - n + 1))
+
+
+class FriendsModel:
+
+    def __init__(self):
+        self.__keys = []
+        self.__byId = {}
+        self.__names = {}
+        self.__index = {}
+        self.__filter = ""
+        self.__visible = []
+
+    def __len__(self):
+        return len(self.__visible)
+
+    def getId(self, row):
+        return self.__visible[row][1]
+
+    def getNames(self):
+        return [self.__names[peerId] for key, peerId in self.__visible]
+
+    def apply(self, added=(), removed=(), updated=()):
+        """Apply a batch of changes and return the edits to the rows
+        shown."""
+        gone = set()
+        new = []
+
+        # Status changes do not move a peer
+        updated = [peer for peer in updated
+            if self.__names.get(peer.getId()) != label(peer)]
+
+        # An update moves a peer from its old key to its new one
+        for peer in list(removed) + list(updated):
+            key = self.__byId.pop(peer.getId(), None)
+            if key is not None:
+                self.__unindex(key)
+                gone.add(key)
+
+        for peer in list(added) + list(updated):
+            if peer.getId() in self.__byId:
+                continue
+
+            key = (fold(peer.getName()), peer.getId())
+            self.__byId[key[1]] = key
+            self.__names[key[1]] = label(peer)
+            self.__reindex(key)
+            new.append(key)
+
+        for key in gone:
+            if key[1] not in self.__byId:
+                self.__names.pop(key[1], None)
+
+        self.__keys = self.__merge(self.__keys, gone, new)
+
+        return self.__show(
+            gone,
+            [key for key in new if self.__matches(key)])
+
+    def setFilter(self, text):
+        """Show only the peers whose name holds text, and return the edits
+        to the rows shown."""
+        text = fold(text)
+        if text == self.__filter:
+            return []
+
+        self.__filter = text
+        old = len(self.__visible)
+
+        if text:
+            self.__visible = sorted(self.__byId[peerId] for peerId in self.__find(text))
+        else:
+            self.__visible = list(self.__keys)
+
+        return self.__reset(old)
+
+    def search(self, text):
+        """Returns the IDs of the peers whose name holds text, sorted by
+        name."""
+        text = fold(text)
+        if not text:
+            return [peerId for key, peerId in self.__keys]
+
+        return [peerId for key, peerId in
+            sorted(self.__byId[peerId] for peerId in self.__find(text))]
+
+    def __find(self, text):
+        """Returns the set of peer IDs whose folded name holds text."""
+        if len(text) <= GRAM:
+            return set(self.__index.get(text, ()))
+
+        # Start from the rarest piece, so the intersection stays small
+        grams = sorted(
+            (self.__index.get(text[i:i + GRAM], set())
+                for i in range(len(text) - GRAM + 1)),
+            key=len)
+
+        found = set(grams[0])
+        for ids in grams[1:]:
+            found &= ids
+            if not found:
+                break
+
+        return set(peerId for peerId in found if text in self.__byId[peerId][0])
+
+    def __matches(self, key):
+        return self.__filter in key[0]
+
+    def __reindex(self, key):
+        for piece in pieces(key[0]):
+            self.__index.setdefault(piece, set()).add(key[1])
+
+    def __unindex(self, key):
+        for piece in pieces(key[0]):
+            ids = self.__index.get(piece)
+            if ids is not None:
+                ids.discard(key[1])
+                if not ids:
+                    del self.__index[piece]
+
+    def __merge(self, keys, gone, new):
+        """Returns the sorted list keys without gone and with new."""
+        if gone:
+            if len(gone) * 8 > len(keys):
+                keys = [key for key in keys if key not in gone]
+            else:
+                for key in gone:
+                    i = bisect.bisect_left(keys, key)
+                    if i < len(keys) and keys[i] == key:
+                        del keys[i]
+
+        if len(new) * 8 > len(keys):
+            keys = sorted(keys + new)
+        else:
+            for key in new:
+                bisect.insort(keys, key)
+
+        return keys
+
+    def __show(self, gone, new):
+        """Update the rows shown and return the edits for them."""
+        old = self.__visible
+
+        deleted = []
+        for key in gone:
+            i = bisect.bisect_left(old, key)
+            if i < len(old) and old[i] == key:
+                deleted.append(i)
+
+        self.__visible = self.__merge(list(old), gone, new)
+
+        inserted = sorted(bisect.bisect_left(self.__visible, key) for key in new)
+
+        deleted = runs(sorted(deleted))
+        inserted = runs(inserted)
+
+        if len(deleted) + len(inserted) > MAX_RUNS:
+            return self.__reset(len(old))
+
+        edits = []
+
+        # Delete from the bottom up, so the rows above stay where they are
+        for first, last in reversed(deleted):
+            edits.append(("delete", first, last))
+
+        # Insert from the top down, at the rows they end up on
+        for first, last in inserted:
+            edits.append(("insert", first, [self.__names[peerId]
+                for key, peerId in self.__visible[first:last + 1]]))
+
+        return edits
+
+    def __reset(self, old):
+        """Returns the edits that replace all old rows with the rows shown."""
+        edits = []
+
+        if old > 0:
+            edits.append(("delete", 0, old - 1))
+
+        if self.__visible:
+            edits.append(("insert", 0, self.getNames()))
+
+        return edits
+
+
+def runs(rows):
+    """Returns (first, last) for every run of neighbouring sorted rows."""
+    result = []
+
+    for row in rows:
+        if result and result[-1][1] == row - 1:
+            result[-1] = (result[-1][0], row)
+        else:
+            result.append((row, row))
+
+    return result
@@ -0,0 +1,577 @@
+# -*- coding: utf-8 *-*
+
+"""
+Group conversations.
+
+A group is a named set of members, known by a random 63-bit ID. Group
+packets are JSON objects:
+
+	{"k": kind, "g": group ID, "id": packet ID, "from": MAC, "name": sender's name,
+		"s": sender's session, "n": messages the sender has sent to the group, ...}
+
+	invite					- "title" and "members": creates or updates the group at every member
+	join					- The sender receives the group's multicast. "reply" is set on answers.
+	leave					- The sender has left the group
+	msg						- "text": a message to the group. Its number is "n" - 1.
+	resend					- "numbers": asks the sender of those messages to send them again
+
+On peer connections a packet is sent as a control frame starting with
+GROUP. On the group socket it is a datagram starting with MAGIC.
+
+Every group has a multicast address. A member that can join it
+multicasts a join, and members hearing a join from someone new answer
+once with their own, so every member learns which others receive the
+group's multicast. A packet is sent as one multicast datagram for those
+members, and down a relay tree for the rest: the sender splits them
+into FANOUT parts and sends the packet over TCP to the first known
+member of each part, with the rest of the part as its route. Every
+relay does the same with its route, so sending to a 300 member group
+takes the sender one datagram and at most FANOUT frames.
+
+Packets that do not fit in a datagram go down the relay tree to every
+member. Multicast datagrams are best-effort, like discovery packets, so
+lost messages are repaired. Every packet holds the number of messages
+its sender has sent to the group since it started, which is its
+session. A member that finds numbers it has not received asks the
+sender over TCP for them with a resend, and the sender sends the last
+RESEND_SIZE messages it has kept straight to that member. A lost message
+is found when the next packet from its sender arrives. Recently seen
+packet IDs are dropped, so a packet that arrives by more than one path
+is shown once.
+
+
+
+Class Name: GroupManager
+	Sends and receives the packets of every group a client is in. All
+	of its functions run on the engine thread unless they say otherwise.
+
+Data:
+	__engine				- Engine that runs the groups
+	__myInfo				- This client's own contact
+	__peers					- Registry used to find the members to relay through
+	__endpoint				- Socket for group multicast, or None if multicast is not available
+	__port					- Port that group multicast is sent to
+	__groups				- Every group this client is in, keyed by ID
+	__session				- Random number sent in every packet, which changes when the client
+							  restarts
+	__seen					- IDs of recently received packets
+	__newGroup				- Callback used when this client is invited to a group
+
+Functions:
+	setEndpoint				- Sets the socket used for group multicast
+	createGroup				- Creates a group with the given peers and invites them (any thread)
+	getGroups				- Returns the list of groups
+	getGroup				- Returns the group with the given ID
+	onControl				- Handles a group packet received from a peer connection
+	onDatagram				- Handles a datagram received on the group socket
+
+
+
+Class Name: Group
+	A group conversation.
+
+Data:
+	__id					- Group ID
+	__name					- Display name of the group
+	__members				- MACs of every member, including this client
+	__multicast				- MACs of the members that receive the group's multicast
+	__history				- Recent messages, backed by a log on disk
+	__sent					- The last RESEND_SIZE message packets this client sent, by number
+	__count					- Number of messages this client has sent to the group
+	__heard					- (session, messages heard of) for every other member, keyed by MAC
+	__msgCallback			- Function called with (sender's name, message, position) for every message
+	__listener				- Function called with (group, sender's MAC, sender's name, message)
+
+Functions:
+	getId					- Returns the group ID
+	getName					- Returns the display name
+	getMembers				- Returns the sorted MACs of every member
+	getAddress				- Returns the group's multicast address
+	getHistory				- Returns the group's History
+	setMessageCallback		- Sets the function called for each message. If replay is given, it is
+							  first called on the engine thread with the last page of the history,
+							  as a list of (position, name, message)
+	readHistory				- Returns up to count (position, name, message) from before a position
+	setMessageListener		- Sets a function called with (group, MAC, name, message) for every message
+	sendMessage				- Sends a message to every member. Does not block.
+	invite					- Adds peers to the group. Does not block.
+	leave					- Leaves the group. Does not block.
+	closeConnection			- Stops calling the message callback
+	detach					- Stops calling the message callback
+"""
+
+import collections
+import json
+import os
+import logging
+
+import History
+
+
+GROUP = "group "
+MAGIC = b"SKG"
+
+INVITE = "invite"
+JOIN = "join"
+LEAVE = "leave"
+MESSAGE = "msg"
+RESEND = "resend"
+
+FANOUT = 4
+MAX_DATAGRAM = 1400
+SEEN_SIZE = 4096
+RESEND_SIZE = 256
+
+log = logging.getLogger("SkyChat.Groups")
+
+
+def groupAddress(groupId):
+    """Returns the multicast address of a group."""
+    return "239.255.%d.%d" % (groupId >> 8 & 255, groupId & 255)
+
+
+def split(route, parts):
+    """Split route into at most parts lists of nearly equal length."""
+    size = max(1, -(-len(route) // parts))
+    return [route[i:i + size] for i in range(0, len(route), size)]
+
+
+def _encode(packet):
+    return json.dumps(packet, separators=(",", ":"))
+
+
+class GroupManager:
+
+    __endpoint = None
+
+    def __init__(self, engine, myInfo, peers, port, dataDir, newGroup=None):
+        self.__engine = engine
+        self.__myInfo = myInfo
+        self.__peers = peers
+        self.__port = port
+        self.__dataDir = dataDir
+        self.__newGroup = newGroup
+        self.__groups = {}
+        self.__session = self.__engine.random().getrandbits(31)
+        self.__seen = set()
+        self.__seenOrder = collections.deque()
+
+    def setEndpoint(self, endpoint):
+        self.__endpoint = endpoint
+
+    def getEngine(self):
+        return self.__engine
+
+    def getGroups(self):
+        return list(self.__groups.values())
+
+    def getGroup(self, groupId):
+        return self.__groups.get(groupId)
+
+    def createGroup(self, name, peers):
+        """Create a group of this client and peers, and invite them. May be
+        called from any thread."""
+        members = [self.__myInfo.getMAC()] + [peer.getMAC() for peer in peers]
+        group = self.__makeGroup(self.__engine.random().getrandbits(63), name, members)
+
+        self.__engine.callSoon(self.__create, group)
+        return group
+
+    def __makeGroup(self, groupId, name, members):
+        return Group(self, groupId, name, members, History.History(os.path.join(
+            self.__dataDir,
+            "groups",
+            str(groupId) + ".log")))
+
+    def __create(self, group):
+        self.__add(group)
+        self.__send(group, INVITE,
+            title=group.getName(),
+            members=group.getMembers())
+
+    def __add(self, group):
+        self.__groups[group.getId()] = group
+
+        if self.__endpoint is None:
+            return
+
+        try:
+            self.__endpoint.joinGroup(group.getAddress())
+        except OSError as ex:
+            log.info("Multicast is not available for %s: %s", group.getName(), ex)
+            return
+
+        self.__send(group, JOIN)
+
+    def _sendMessage(self, group, message):
+        group._record(self.__myInfo.getMAC(), self.__myInfo.getName(), message)
+        self.__send(group, MESSAGE, text=message)
+
+    def _invite(self, group, peers):
+        group._setMembers(group.getMembers() + [peer.getMAC() for peer in peers])
+        self.__send(group, INVITE,
+            title=group.getName(),
+            members=group.getMembers())
+
+    def _leave(self, group):
+        if self.__groups.pop(group.getId(), None) is None:
+            return
+
+        self.__send(group, LEAVE)
+
+        if self.__endpoint is not None:
+            try:
+                self.__endpoint.leaveGroup(group.getAddress())
+            except OSError:
+                pass
+
+        group.getHistory().close()
+
+    def __send(self, group, kind, **fields):
+        packet = {
+            "k": kind,
+            "g": group.getId(),
+            "id": self.__engine.random().getrandbits(63),
+            "from": self.__myInfo.getMAC(),
+            "name": self.__myInfo.getName(),
+            "s": self.__session}
+        packet.update(fields)
+
+        # The kept copy has no route, which relays add
+        if kind == MESSAGE:
+            packet["n"] = group._count() + 1
+            group._sent(dict(packet))
+        else:
+            packet["n"] = group._count()
+
+        # Joins only mean something on the multicast address
+        if kind == JOIN:
+            self.__multicast(group, packet)
+            return
+
+        me = self.__myInfo.getMAC()
+        route = [mac for mac in group.getMembers() if mac != me]
+
+        if self.__endpoint is not None and group.hasMulticast():
+            data = MAGIC + _encode(packet).encode("utf-8")
+
+            if len(data) <= MAX_DATAGRAM:
+                self.__endpoint.sendto(data, (group.getAddress(), self.__port))
+                route = [mac for mac in route if not group.receivesMulticast(mac)]
+
+        self.__forward(packet, route)
+
+    def __resend(self, group, sender, numbers):
+        """Ask sender for the messages with the given numbers."""
+        contact = self.__peers.getByMAC(sender)
+        if contact is None:
+            log.info("Lost %d messages from %d in %s", len(numbers), sender, group.getName())
+            return
+
+        contact.sendControl(GROUP + _encode({
+            "k": RESEND,
+            "g": group.getId(),
+            "id": self.__engine.random().getrandbits(63),
+            "from": self.__myInfo.getMAC(),
+            "name": self.__myInfo.getName(),
+            "s": self.__session,
+            "n": group._count(),
+            "numbers": numbers}))
+
+    def __resent(self, group, sender, numbers):
+        """Send the messages with the given numbers to sender."""
+        contact = self.__peers.getByMAC(sender)
+        if contact is None:
+            return
+
+        for packet in group._getSent(numbers):
+            contact.sendControl(GROUP + _encode(packet))
+
+    def __multicast(self, group, packet):
+        if self.__endpoint is not None:
+            self.__endpoint.sendto(
+                MAGIC + _encode(packet).encode("utf-8"),
+                (group.getAddress(), self.__port))
+
+    def __forward(self, packet, route):
+        """Send packet down the relay tree to every MAC in route."""
+        for part in split(route, FANOUT):
+            for i, mac in enumerate(part):
+                child = self.__peers.getByMAC(mac)
+                if child is not None:
+                    break
+            else:
+                log.info("No route to %d group members", len(part))
+                continue
+
+            # Members before the child are not on the network, so only the
+            # rest of the part is passed on
+            packet["route"] = part[i + 1:]
+            child.sendControl(GROUP + _encode(packet))
+
+    def onControl(self, contact, payload):
+        """Handle a control frame received from a peer connection."""
+        if not payload.startswith(GROUP):
+            return
+
+        try:
+            packet = json.loads(payload[len(GROUP):])
+            route = [int(mac) for mac in packet.pop("route", ())]
+        except (ValueError, TypeError, AttributeError) as ex:
+            log.warning("Invalid group packet from %s: %s", contact.getName(), ex)
+            return
+
+        # Pass the packet on before handling it, so relays do not delay
+        # their subtrees
+        if route:
+            self.__forward(packet, route)
+
+        self.__receive(packet, False)
+
+    def onDatagram(self, data, addr):
+        """Handle a datagram received on the group socket."""
+        if not data.startswith(MAGIC):
+            return
+
+        try:
+            packet = json.loads(data[len(MAGIC):].decode("utf-8"))
+        except (ValueError, UnicodeDecodeError):
+            log.warning("Invalid group datagram from %s", addr)
+            return
+
+        self.__receive(packet, True)
+
+    def __receive(self, packet, multicast):
+        try:
+            kind = packet["k"]
+            group = self.__groups.get(int(packet["g"]))
+            packetId = int(packet["id"])
+            sender = int(packet["from"])
+            name = str(packet.get("name", sender))
+            session = int(packet.get("s", 0))
+            count = int(packet.get("n", 0))
+        except (KeyError, ValueError, TypeError) as ex:
+            log.warning("Invalid group packet: %s", ex)
+            return
+
+        if sender == self.__myInfo.getMAC() or self.__wasSeen(packetId):
+            return
+
+        if kind == INVITE:
+            self.__invited(packet, group)
+            return
+
+        if group is None:
+            return
+
+        if multicast:
+            isNew = not group.receivesMulticast(sender)
+            group._addMulticast(sender)
+
+            # Answer a new member's join once, so it learns about us too
+            if kind == JOIN and isNew and not packet.get("reply"):
+                self.__multicast(group, {
+                    "k": JOIN,
+                    "g": group.getId(),
+                    "id": self.__engine.random().getrandbits(63),
+                    "from": self.__myInfo.getMAC(),
+                    "name": self.__myInfo.getName(),
+                    "s": self.__session,
+                    "n": group._count(),
+                    "reply": True})
+
+        missing = group._heard(sender, session, count, kind == MESSAGE)
+        if missing:
+            self.__resend(group, sender, missing)
+
+        if kind == MESSAGE:
+            group._receive(sender, name, str(packet.get("text", "")))
+
+        elif kind == LEAVE:
+            group._setMembers(
+                [mac for mac in group.getMembers() if mac != sender])
+
+        elif kind == RESEND:
+            try:
+                numbers = [int(number) for number in packet["numbers"]]
+            except (KeyError, ValueError, TypeError) as ex:
+                log.warning("Invalid resend from %s: %s", name, ex)
+                return
+
+            self.__resent(group, sender, numbers)
+
+    def __invited(self, packet, group):
+        try:
+            title = str(packet["title"])
+            members = [int(mac) for mac in packet["members"]]
+            groupId = int(packet["g"])
+        except (KeyError, ValueError, TypeError) as ex:
+            log.warning("Invalid group invitation: %s", ex)
+            return
+
+        if self.__myInfo.getMAC() not in members:
+            return
+
+        if group is not None:
+            group._setMembers(members)
+            return
+
+        group = self.__makeGroup(groupId, title, members)
+        self.__add(group)
+
+        if self.__newGroup is not None:
+            self.__newGroup(group)
+
+    def __wasSeen(self, packetId):
+        if packetId in self.__seen:
+            return True
+
+        self.__seen.add(packetId)
+        self.__seenOrder.append(packetId)
+
+        if len(self.__seenOrder) > SEEN_SIZE:
+            self.__seen.discard(self.__seenOrder.popleft())
+
+        return False
+
+
+class Group:
+
+    __msgCallback = None
+    __listener = None
+    __count = 0
+
+    def __init__(self, manager, groupId, name, members, history):
+        self.__manager = manager
+        self.__id = groupId
+        self.__name = name
+        self.__address = groupAddress(groupId)
+        self.__members = sorted(set(members))
+        self.__multicast = set()
+        self.__history = history
+        self.__sent = collections.OrderedDict()
+        self.__heard = {}
+
+    def getId(self):
+        return self.__id
+
+    def getName(self):
+        return self.__name
+
+    def getMembers(self):
+        return self.__members
+
+    def getAddress(self):
+        return self.__address
+
+    def getHistory(self):
+        return self.__history
+
+    def hasMulticast(self):
+        """Returns True if any other member receives the group's multicast."""
+        return len(self.__multicast) > 0
+
+    def receivesMulticast(self, mac):
+        return mac in self.__multicast
+
+    def _addMulticast(self, mac):
+        self.__multicast.add(mac)
+
+    def _setMembers(self, members):
+        self.__members = sorted(set(members))
+        self.__multicast.intersection_update(self.__members)
+
+    def _count(self):
+        return self.__count
+
+    def _sent(self, packet):
+        """Keep a message packet this client sent, to send again if it is
+        lost."""
+        self.__sent[self.__count] = packet
+        self.__count += 1
+
+        if len(self.__sent) > RESEND_SIZE:
+            self.__sent.popitem(False)
+
+    def _getSent(self, numbers):
+        """Returns the kept packets of the messages with the given
+        numbers."""
+        return [self.__sent[number] for number in numbers if number in self.__sent]
+
+    def _heard(self, mac, session, count, isMessage):
+        """Note a packet from mac that says it has sent count messages.
+        Returns the numbers of its messages that were missed."""
+        heard = self.__heard.get(mac)
+
+        # Messages from before this client heard of the sender, or from an
+        # earlier session, are not asked for
+        if heard is None or heard[0] != session:
+            self.__heard[mac] = (session, count)
+            return []
+
+        if count <= heard[1]:
+            return []
+
+        self.__heard[mac] = (session, count)
+        last = count - 1 if isMessage else count
+        return list(range(max(heard[1], last - RESEND_SIZE), last))
+
+    def setMessageCallback(self, callback, replay=None, count=History.PAGE_SIZE):
+        if replay is None:
+            self.__msgCallback = callback
+        else:
+            self.__manager.getEngine().callSoon(
+                self.__replay, callback, replay, count)
+
+    def __replay(self, callback, replay, count):
+        replay(self.readHistory(None, count))
+        self.__msgCallback = callback
+
+    def readHistory(self, position=None, count=History.PAGE_SIZE):
+        entries = []
+
+        for position, entry in self.__history.readBefore(position, count):
+            mac, name, message = json.loads(entry)
+            entries.append((position, name, message))
+
+        return entries
+
+    def setMessageListener(self, listener):
+        """Set a function called with (group, MAC, name, message) for every
+        message received. Unlike the message callback it is never
+        cleared."""
+        self.__listener = listener
+
+    def closeConnection(self):
+        self.__msgCallback = None
+
+    def detach(self):
+        self.__msgCallback = None
+
+    def sendMessage(self, message):
+        """Send a message to every member without blocking the caller."""
+        self.__manager.getEngine().callSoon(
+            self.__manager._sendMessage, self, message)
+
+    def invite(self, peers):
+        """Add peers to the group without blocking the caller."""
+        self.__manager.getEngine().callSoon(
+            self.__manager._invite, self, list(peers))
+
+    def leave(self):
+        """Leave the group without blocking the caller."""
+        self.__manager.getEngine().callSoon(self.__manager._leave, self)
+
+    def _record(self, mac, name, message):
+        """Add a message to the history. Returns its position."""
+        return self.__history.append(json.dumps([mac, name, message]))
+
+    def _receive(self, mac, name, message):
+        log.debug("%s: %s: %s", self.__name, name, message)
+        position = self._record(mac, name, message)
+
+        if self.__msgCallback is not None:
+            self.__msgCallback(name, message, position)
+
+        if self.__listener is not None:
+            self.__listener(self, mac, name, message)
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 *-*
+
+"""
+Class Name: History
+	The message history of a single conversation. The most recent
+	messages are kept in a fixed-size ring buffer. Every message is also
+	appended to a ConversationLog on disk, so memory use stays flat no
+	matter how long the conversation runs.
+
+	The tail of the log is only read when the history is first used, so
+	known peers that are never talked to cost no disk reads.
+
+	Every message has a position: its offset in the log, or its number
+	when the history is only kept in memory. A history view reads one
+	page at a time, starting from the newest message and going back
+	through readBefore with the position of the oldest message it shows.
+
+Data:
+	__recent				- Ring buffer with the most recent messages
+	__log					- Log the messages are saved to. None keeps the history in memory only
+	__loaded				- True once the tail of the log has been read into __recent
+	__count					- Number of messages appended, when there is no log
+
+Functions:
+	append					- Adds a message to the history and the log, and returns its position
+	recent					- Returns a list with the most recent messages, oldest first
+	readBefore				- Returns up to count (position, message) pairs that come before
+							  a position, oldest first. None reads back from the newest message.
+	getLog					- Returns the ConversationLog, or None
+	close					- Closes the log file
+
+
+
+Class Name: ConversationLog
+	An append-only file with every message of one conversation.
+
+	Each record is the UTF-8 message framed by its length on both sides,
+	so the file can be walked backwards from the end. Reads go through a
+	read-only memory map, so only the pages holding the requested
+	records are read from disk.
+
+Functions:
+	append					- Appends a message to the end of the file and returns its offset
+	readRecords				- Like readBefore, but returns (offset, message) pairs
+	readBefore				- Reads messages that come before a file offset
+
+	Input Params:
+		offset				- File offset to read backwards from. None is the end of the file
+		count				- Largest number of messages to return
+
+	Output Params:			- (messages, offset) where messages is oldest first and
+							  offset is where the first returned message starts
+
+	readTail				- Returns the last count messages, oldest first
+	size					- Returns the size of the file in bytes
+	close					- Closes the file
+"""
+
+import collections
+import mmap
+import os
+import struct
+import threading
+
+
+HISTORY_SIZE = 200
+PAGE_SIZE = 100
+LENGTH = struct.Struct("!I")
+
+
+class History:
+
+    __log = None
+    __loaded = False
+    __count = 0
+
+    def __init__(self, path=None, size=HISTORY_SIZE):
+        self.__recent = collections.deque(maxlen=size)
+        self.__lock = threading.Lock()
+
+        if path is not None:
+            self.__log = ConversationLog(path)
+        else:
+            self.__loaded = True
+
+    def __load(self):
+        """Read the tail of the log into the ring buffer."""
+        if not self.__loaded:
+            self.__loaded = True
+            self.__recent.extend(self.__log.readTail(self.__recent.maxlen))
+
+    def append(self, message):
+        with self.__lock:
+            self.__load()
+            self.__recent.append(message)
+
+            if self.__log is not None:
+                return self.__log.append(message)
+
+            self.__count += 1
+            return self.__count - 1
+
+    def recent(self):
+        """Returns the most recent messages, oldest first."""
+        with self.__lock:
+            self.__load()
+            return list(self.__recent)
+
+    def readBefore(self, position=None, count=PAGE_SIZE):
+        """Returns up to count (position, message) pairs that come before
+        position, oldest first."""
+        with self.__lock:
+            if self.__log is not None:
+                return self.__log.readRecords(position, count)
+
+            # Only the messages still in the ring buffer can be read
+            first = self.__count - len(self.__recent)
+            end = self.__count if position is None else \
+                max(first, min(position, self.__count))
+            start = max(first, end - count)
+
+            messages = list(self.__recent)[start - first:end - first]
+            return list(enumerate(messages, start))
+
+    def getLog(self):
+        return self.__log
+
+    def close(self):
+        if self.__log is not None:
+            self.__log.close()
+
+
+class ConversationLog:
+
+    __file = None
+
+    def __init__(self, path):
+        self.__path = path
+
+    def __open(self):
+        """Open the file for appending, dropping any torn record left at
+        the end by a crash."""
+        os.makedirs(os.path.dirname(self.__path) or ".", exist_ok=True)
+        self.__file = open(self.__path, "ab")
+
+        end = self.__file.tell()
+        if end > 0:
+            with open(self.__path, "rb") as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                end = self.__validEnd(data, end)
+
+        if end < self.__file.tell():
+            self.__file.truncate(end)
+            self.__file.seek(end)
+
+    def __validEnd(self, data, size):
+        """Returns the offset just past the last complete record."""
+
+        # The common case: the last record is complete
+        if self.__recordBefore(data, size) is not None:
+            return size
+
+        # Otherwise walk forward to find the last complete record
+        offset = 0
+        while offset + LENGTH.size <= size:
+            length, = LENGTH.unpack_from(data, offset)
+            end = offset + 2 * LENGTH.size + length
+
+            if end > size or \
+                    LENGTH.unpack_from(data, end - LENGTH.size)[0] != length:
+                break
+
+            offset = end
+
+        return offset
+
+    def __recordBefore(self, data, offset):
+        """Returns the start of the record that ends at offset, or None if
+        the record is not valid."""
+        if offset < 2 * LENGTH.size:
+            return None
+
+        length, = LENGTH.unpack_from(data, offset - LENGTH.size)
+        start = offset - 2 * LENGTH.size - length
+
+        if start < 0 or LENGTH.unpack_from(data, start)[0] != length:
+            return None
+
+        return start
+
+    def size(self):
+        try:
+            return os.path.getsize(self.__path)
+        except OSError:
+            return 0
+
+    def append(self, message):
+        if self.__file is None:
+            self.__open()
+
+        payload = message.encode("utf-8")
+        header = LENGTH.pack(len(payload))
+
+        offset = self.__file.tell()
+        self.__file.write(header + payload + header)
+        self.__file.flush()
+
+        return offset
+
+    def readBefore(self, offset=None, count=HISTORY_SIZE):
+        """Read up to count messages that end at or before offset."""
+        records = self.readRecords(offset, count)
+
+        if not records:
+            return [], self.__clamp(offset)
+
+        return [message for start, message in records], records[0][0]
+
+    def __clamp(self, offset):
+        size = self.size()
+        if offset is not None and offset < size:
+            size = offset
+
+        return size
+
+    def readRecords(self, offset=None, count=HISTORY_SIZE):
+        """Read up to count (offset, message) pairs for the records that
+        end at or before offset."""
+        size = self.__clamp(offset)
+
+        if size == 0 or count <= 0:
+            return []
+
+        records = []
+
+        with open(self.__path, "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+
+            offset = size
+            if offset == len(data):
+                offset = self.__validEnd(data, offset)
+
+            while len(records) < count:
+                start = self.__recordBefore(data, offset)
+                if start is None:
+                    break
+
+                records.append((start, str(
+                    data[start + LENGTH.size:offset - LENGTH.size],
+                    "utf-8")))
+
+                offset = start
+
+        records.reverse()
+        return records
+
+    def readTail(self, count=HISTORY_SIZE):
+        return self.readBefore(None, count)[0]
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
@@ -0,0 +1,1067 @@
+# -*- coding: utf-8 *-*
+
+"""
+A relay hub, for networks too large for every client to connect to
+every peer it talks to, or with clients behind NAT that cannot accept
+connections.
+
+With a hub, a client keeps one TCP connection open to the hub instead
+of one to each peer. Each connection between two peers becomes a
+stream over their hub connections, and the hub routes the stream's
+data to the peer by MAC. A stream carries the same bytes a TCP
+connection between the peers would, hellos, syncs and acknowledgements
+included, so nothing above the ConnectionManager knows the difference.
+
+Everything on a hub connection is framed (see Framing.py). Each frame
+starts with a header
+
+	kind					- 1 byte, one of the kinds below
+	mac						- 8 bytes, the peer at the other end of the stream: the
+							  destination in frames sent to the hub, and the source in
+							  frames from it
+	stream					- 4 bytes, the stream ID
+
+followed by the data of the frame. The kinds are
+
+	REGISTER				- The first frame from a client. mac is its own MAC.
+	OPEN					- Opens a stream to the peer
+	DATA					- Bytes on a stream
+	CLOSE					- Closes a stream
+
+Stream IDs are chosen by the end that opens the stream. The other end
+sends its frames with the REPLY bit set in the ID, so each end can tell
+the streams it opened from those the peer opened. When a frame cannot
+be delivered because the peer is not connected to the hub, the hub
+answers with a CLOSE for the stream, and the connection fails as if the
+peer could not be reached. A client that gets data for a stream it does
+not know, after a restart, answers the same way.
+
+The hub runs several worker processes, one per core by default. Every
+worker has its own listening socket on the hub port, bound with
+SO_REUSEPORT, so the kernel spreads new clients over the workers, and
+serves its clients with one selectors loop (epoll on Linux). Which
+worker holds each MAC is kept in a RouteTable in shared memory, and a
+frame for a client of another worker is passed to that worker over a
+socket pair. Where SO_REUSEPORT is missing, the workers share one
+listening socket.
+
+A client that reads too slowly to keep up with what it is sent is
+disconnected once MAX_BUFFER bytes are waiting for it, so one stalled
+laptop cannot use up the hub's memory.
+
+A MAC is held by the first connection that registers it until that
+connection closes, and any other connection registering it meanwhile is
+turned away, so a client cannot take over the streams of a connected
+peer. A client whose connection was lost without closing gets its MAC
+back once TCP keepalives find the old connection dead.
+
+The hub does not look inside streams, and cannot be used with TLS. It
+needs a POSIX system. Run one with
+
+	python Hub.py --port 8501 --workers 4
+
+and give its address to Client as hub=(host, port). Serving tens of
+thousands of clients needs a limit on open files to match, which main
+raises as far as the system allows.
+
+Functions:
+	main					- Runs a hub from the command line
+
+
+
+Class Name: RouteTable
+	Which worker each registered MAC is connected to, in memory shared
+	by every worker. It is a hash table with open addressing, of a fixed
+	number of slots made when the hub starts. Changes are made under a
+	lock, and lookups take no lock: a slot's worker is written before
+	its MAC, so a lookup never sees a MAC with a worker it did not have.
+
+	Removed MACs leave a marker in their slot. Once markers fill a
+	quarter of the table it is rebuilt without them. A lookup that
+	overlaps a rebuild sees the version number change, and looks again
+	under the lock.
+
+	The MACs EMPTY and REMOVED mark free slots, and cannot be recorded.
+
+Data:
+	__memory				- The slots, in shared memory
+	__lock					- Lock held while the table changes
+	__removed				- Number of slots holding the REMOVED marker
+	__version				- Odd while the table is being rebuilt, and changed by every
+							  rebuild
+
+Functions:
+	get						- Returns the worker a MAC is connected to, or None
+	add						- Records the worker a MAC is connected to, unless it is
+							  already connected to a live worker
+	remove					- Forgets a MAC, if it is still connected to the given worker
+
+
+
+Class Name: Hub
+	Starts the worker processes of a hub and the sockets they share.
+
+Data:
+	__routes				- RouteTable shared by the workers
+	__port					- Port the hub listens on
+	__processes				- The worker processes
+
+Functions:
+	getPort					- Returns the port the hub listens on
+	getWorkers				- Returns the number of worker processes
+	close					- Stops every worker
+
+
+
+Class Name: HubWorker
+	Serves the clients that connect to one worker process.
+
+Data:
+	__index					- Number of this worker
+	__workers				- Number of workers in the hub
+	__listener				- Listening socket
+	__routes				- RouteTable shared by the workers
+	__selector				- Selector that every socket of this worker is registered with
+	__clients				- Session of every client registered with this worker, keyed by MAC.
+							  A MAC is only registered once, so a second client cannot take
+							  it over while the first is connected.
+	__links					- Session of the socket pair to each other worker, keyed by worker number
+
+Functions:
+	run						- Serves clients until the process is stopped
+
+
+
+Class Name: HubLink
+	Keeps a client connected to a hub, and runs its streams over that
+	connection. The connection is opened again, with back-off, whenever
+	it is lost. All of its functions run on the engine thread.
+
+Data:
+	__engine				- Engine that opens the connection
+	__address				- (host, port) of the hub
+	__contact				- This client's own contact
+	__onConnection			- Function called with a HubStream for every stream a peer opens
+	__connection			- Connection to the hub, or None
+	__streams				- Every open stream, keyed by (MAC, ID of the stream in received frames)
+	__nextStream			- ID of the last stream opened by this client
+	__retries				- Failed connections in a row
+	__timer					- Timer for the next connection, or None
+	__stopped				- True once stop has been called
+
+Functions:
+	start					- Connects to the hub
+	stop					- Closes every stream and the connection
+	connect					- Opens a stream to a peer, like Transport.connect
+	isConnected				- Returns True while the connection to the hub is open
+	isWritable				- Returns True unless the connection to the hub is over its high water mark
+	getAddress				- Returns the (host, port) of the hub
+
+
+
+Class Name: HubStream
+	A Transport.Connection to a peer that runs over a HubLink.
+	getPeerAddress returns the address of the hub, and getTls None.
+	Every stream of a link is writable while the connection to the hub
+	is. sendfile sends one block per turn of the engine, and waits for
+	the hub connection to drain when it is full.
+
+Data:
+	__sending				- (file, offset, count, onDone) of a sendfile waiting for the
+							  hub connection to drain, or None
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import struct
+import threading
+
+import Framing
+import Transport
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+hubPort = 8501
+
+HEADER = struct.Struct("!BQI")
+ROUTE = struct.Struct("!Q")
+SLOT = struct.Struct("=QQ")
+
+REGISTER = 1
+OPEN = 2
+DATA = 3
+CLOSE = 4
+
+REPLY = 0x80000000
+
+MAX_DATA = 64 * 1024
+MAX_FRAME = 1024 * 1024
+MAX_BUFFER = 8 * 1024 * 1024
+RECEIVE_SIZE = 256 * 1024
+ACCEPT_BATCH = 64
+BACKLOG = 4096
+SELECT_TIMEOUT = 1.0
+
+ROUTE_SLOTS = 1 << 18
+EMPTY = 0
+REMOVED = (1 << 64) - 1
+
+# Share of the route table that REMOVED markers may fill before it is
+# rebuilt
+MAX_REMOVED = 0.25
+
+# Clients that vanish without closing their connection are found by TCP
+# keepalives after about KEEPALIVE_IDLE + KEEPALIVE_INTERVAL *
+# KEEPALIVE_COUNT seconds, which frees their MAC for the next connection
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+CONNECT_TIMEOUT = 5.0
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+log = logging.getLogger("SkyChat.Hub")
+
+
+def _encode(kind, mac, stream, data=b""):
+    return b"".join((
+        Framing.HEADER.pack(HEADER.size + len(data)),
+        HEADER.pack(kind, mac, stream),
+        data))
+
+
+def _decode(view):
+    """Returns ((kind, mac, stream), data) from a frame payload."""
+    return HEADER.unpack_from(view), bytes(view[HEADER.size:])
+
+
+def _hash(mac):
+    return ((mac * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32
+
+
+class RouteTable:
+
+    __view = None
+
+    def __init__(self, slots=ROUTE_SLOTS):
+        if slots <= 0 or slots & (slots - 1):
+            raise ValueError("slots must be a power of two")
+
+        self.__slots = slots
+        self.__memory = multiprocessing.RawArray("B", slots * SLOT.size)
+        self.__lock = multiprocessing.Lock()
+        self.__removed = multiprocessing.RawValue("Q", 0)
+        self.__version = multiprocessing.RawValue("Q", 0)
+
+    def __getstate__(self):
+        # The view belongs to the process that made it
+        state = self.__dict__.copy()
+        state.pop("_RouteTable__view", None)
+        return state
+
+    def __getView(self):
+        if self.__view is None:
+            self.__view = memoryview(self.__memory).cast("B")
+
+        return self.__view
+
+    def __find(self, mac):
+        """Returns (offset of the slot holding mac or None, offset of the
+        first slot it could be put in or None)."""
+        view = self.__getView()
+        mask = self.__slots - 1
+        index = _hash(mac) & mask
+        free = None
+
+        for i in range(self.__slots):
+            offset = index * SLOT.size
+            key, worker = SLOT.unpack_from(view, offset)
+
+            if key == mac:
+                return offset, free
+
+            if key == EMPTY:
+                return None, offset if free is None else free
+
+            if key == REMOVED and free is None:
+                free = offset
+
+            index = (index + 1) & mask
+
+        return None, free
+
+    def __lookup(self, mac):
+        offset, free = self.__find(mac)
+        if offset is None:
+            return None
+
+        return SLOT.unpack_from(self.__getView(), offset)[1]
+
+    def get(self, mac):
+        if mac == EMPTY or mac == REMOVED:
+            return None
+
+        version = self.__version.value
+        worker = self.__lookup(mac)
+
+        if version & 1 or version != self.__version.value:
+            # The table was rebuilt under the lookup
+            with self.__lock:
+                worker = self.__lookup(mac)
+
+        return worker
+
+    def add(self, mac, worker, lost=()):
+        """Record that mac is connected to worker, unless it is connected
+        to a worker that is not in lost. Returns the worker mac is connected
+        to afterwards, or None if the table is full."""
+        if mac == EMPTY or mac == REMOVED:
+            raise ValueError("%d marks free slots" % mac)
+
+        view = self.__getView()
+
+        with self.__lock:
+            offset, free = self.__find(mac)
+
+            if offset is not None:
+                current = SLOT.unpack_from(view, offset)[1]
+                if current not in lost:
+                    return current
+
+                struct.pack_into("=Q", view, offset + 8, worker)
+                return worker
+
+            if free is None:
+                return None
+
+            if SLOT.unpack_from(view, free)[0] == REMOVED:
+                self.__removed.value -= 1
+
+            struct.pack_into("=Q", view, free + 8, worker)
+            struct.pack_into("=Q", view, free, mac)
+            return worker
+
+    def remove(self, mac, worker):
+        """Forget mac, unless it has since connected to another worker."""
+        view = self.__getView()
+
+        with self.__lock:
+            offset, free = self.__find(mac)
+
+            if offset is None or SLOT.unpack_from(view, offset)[1] != worker:
+                return
+
+            struct.pack_into("=Q", view, offset, REMOVED)
+            self.__removed.value += 1
+
+            if self.__removed.value > self.__slots * MAX_REMOVED:
+                self.__rehash()
+
+    def __rehash(self):
+        """Rebuild the table without REMOVED markers. Must be called with
+        the lock held."""
+        view = self.__getView()
+        entries = [(key, worker) for key, worker in SLOT.iter_unpack(view)
+            if key != EMPTY and key != REMOVED]
+
+        # Built aside and copied in at once, to keep lookups waiting short
+        table = bytearray(len(view))
+        mask = self.__slots - 1
+
+        for key, worker in entries:
+            index = _hash(key) & mask
+            while SLOT.unpack_from(table, index * SLOT.size)[0] != EMPTY:
+                index = (index + 1) & mask
+            SLOT.pack_into(table, index * SLOT.size, key, worker)
+
+        self.__version.value += 1
+        view[:] = table
+        self.__removed.value = 0
+        self.__version.value += 1
+
+        log.debug("Rebuilt the route table with %d MACs", len(entries))
+
+
+class Hub:
+
+    def __init__(self, port=hubPort, host='', workers=None, slots=ROUTE_SLOTS):
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        self.__routes = RouteTable(slots)
+        self.__processes = []
+
+        listeners = self.__listen(host, port, workers)
+        self.__port = listeners[0].getsockname()[1]
+
+        # One socket pair between every two workers
+        links = [{} for i in range(workers)]
+        for i in range(workers):
+            for j in range(i + 1, workers):
+                links[i][j], links[j][i] = socket.socketpair()
+
+        try:
+            for i in range(workers):
+                process = multiprocessing.Process(
+                    target=_serve,
+                    args=(i, listeners[i % len(listeners)], self.__routes, links[i]),
+                    name="SkyChat hub worker %d" % i,
+                    daemon=True)
+                process.start()
+                self.__processes.append(process)
+
+        except BaseException:
+            self.close()
+            raise
+
+        finally:
+            # The workers have their own copies
+            for sock in listeners:
+                sock.close()
+            for sockets in links:
+                for sock in sockets.values():
+                    sock.close()
+
+    def __listen(self, host, port, workers):
+        """Returns the listening sockets for the workers: one each, or one
+        for all of them without SO_REUSEPORT."""
+        shared = hasattr(socket, "SO_REUSEPORT")
+        listeners = []
+
+        try:
+            for i in range(workers if shared else 1):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listeners.append(sock)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+                if shared:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, True)
+
+                # Every socket after the first binds the port the first got
+                sock.bind((host, listeners[0].getsockname()[1] if i else port))
+                sock.listen(BACKLOG)
+
+        except OSError:
+            for sock in listeners:
+                sock.close()
+            raise
+
+        return listeners
+
+    def getPort(self):
+        return self.__port
+
+    def getWorkers(self):
+        return len(self.__processes)
+
+    def close(self):
+        for process in self.__processes:
+            process.terminate()
+
+        for process in self.__processes:
+            process.join()
+
+        self.__processes = []
+
+
+def _serve(index, listener, routes, links):
+    # The hub's process stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    HubWorker(index, listener, routes, links).run()
+
+
+class _Session:
+
+    __slots__ = ("sock", "decoder", "pending", "mac", "worker", "closed")
+
+    def __init__(self, sock, worker=None):
+        self.sock = sock
+        self.worker = worker
+        self.mac = None
+        self.closed = False
+        self.pending = bytearray()
+
+        if worker is None:
+            self.decoder = Framing.FrameDecoder(MAX_FRAME, bytearray)
+        else:
+            self.decoder = Framing.FrameDecoder(decode=bytes)
+
+
+class HubWorker:
+
+    def __init__(self, index, listener, routes, links):
+        self.__index = index
+        self.__workers = len(links) + 1
+        self.__listener = listener
+        self.__routes = routes
+        self.__clients = {}
+        self.__links = {}
+        self.__selector = selectors.DefaultSelector()
+
+        listener.setblocking(False)
+        self.__selector.register(listener, selectors.EVENT_READ, None)
+
+        for worker, sock in links.items():
+            sock.setblocking(False)
+            session = _Session(sock, worker)
+            self.__links[worker] = session
+            self.__selector.register(sock, selectors.EVENT_READ, session)
+
+    def run(self):
+        log.info("Hub worker %d serving", self.__index)
+
+        while True:
+            for key, events in self.__selector.select(SELECT_TIMEOUT):
+                session = key.data
+
+                if session is None:
+                    self.__accept()
+                    continue
+
+                if events & selectors.EVENT_READ:
+                    self.__read(session)
+
+                if events & selectors.EVENT_WRITE and not session.closed:
+                    self.__flush(session)
+
+    def __accept(self):
+        for i in range(ACCEPT_BATCH):
+            try:
+                sock, address = self.__listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as ex:
+                # Out of file descriptors, most likely
+                log.warning("Worker %d could not accept a client: %s", self.__index, ex)
+                return
+
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            self.__keepAlive(sock)
+            self.__selector.register(sock, selectors.EVENT_READ, _Session(sock))
+
+    def __keepAlive(self, sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, True)
+
+        # The timings can only be set on some systems
+        for option, value in (
+                ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+                ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def __read(self, session):
+        try:
+            data = session.sock.recv(RECEIVE_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self.__drop(session)
+            return
+
+        try:
+            frames = session.decoder.feed(data)
+        except Framing.FrameError as ex:
+            log.warning("Dropping client %s: %s", session.mac, ex)
+            self.__drop(session)
+            return
+
+        for frame in frames:
+            if session.closed:
+                return
+
+            if session.worker is None:
+                self.__fromClient(session, frame)
+            else:
+                self.__fromWorker(frame)
+
+    def __fromClient(self, session, frame):
+        try:
+            kind, mac, stream = HEADER.unpack_from(frame)
+        except struct.error:
+            self.__drop(session)
+            return
+
+        if session.mac is None:
+            if kind == REGISTER:
+                self.__register(session, mac)
+            else:
+                self.__drop(session)
+            return
+
+        if kind == REGISTER:
+            return
+
+        # The receiver sees the sender's MAC in place of its own
+        HEADER.pack_into(frame, 0, kind, session.mac, stream)
+        self.__route(mac, frame)
+
+    def __fromWorker(self, frame):
+        mac, = ROUTE.unpack_from(frame)
+        client = self.__clients.get(mac)
+
+        if client is not None:
+            self.__send(client, Framing.HEADER.pack(len(frame) - ROUTE.size),
+                memoryview(frame)[ROUTE.size:])
+        else:
+            self.__undeliverable(mac, frame, ROUTE.size)
+
+    def __route(self, mac, frame):
+        """Send a frame to the client with MAC mac, wherever it is
+        connected."""
+        client = self.__clients.get(mac)
+
+        if client is not None:
+            self.__send(client, Framing.HEADER.pack(len(frame)), frame)
+            return
+
+        worker = self.__routes.get(mac)
+        link = self.__links.get(worker)
+
+        if link is not None:
+            self.__send(link, Framing.HEADER.pack(ROUTE.size + len(frame)), ROUTE.pack(mac),
+                frame)
+        else:
+            self.__undeliverable(mac, frame, 0)
+
+    def __undeliverable(self, mac, frame, offset):
+        """Tell the sender of a frame for mac that its stream is closed."""
+        kind, source, stream = HEADER.unpack_from(frame, offset)
+
+        if kind != CLOSE:
+            self.__route(source, HEADER.pack(CLOSE, mac, stream ^ REPLY))
+
+    def __register(self, session, mac):
+        if mac == EMPTY or mac == REMOVED:
+            log.info("Turning away a client registering %d", mac)
+            self.__drop(session)
+            return
+
+        # A MAC is only taken over from a worker that has gone
+        lost = [i for i in range(self.__workers) if i != self.__index and i not in self.__links]
+        worker = self.__routes.add(mac, self.__index, lost)
+
+        if worker is None:
+            log.warning("The route table is full, turning away %s", mac)
+            self.__drop(session)
+            return
+
+        if worker != self.__index or mac in self.__clients:
+            log.info("Turning away %s, which is already connected", mac)
+            self.__drop(session)
+            return
+
+        session.mac = mac
+        self.__clients[mac] = session
+        log.debug("Worker %d registered %s", self.__index, mac)
+
+    def __send(self, session, *parts):
+        if session.closed:
+            return
+
+        if session.pending:
+            for part in parts:
+                session.pending += part
+        else:
+            # Header and data go out in one vectored write
+            try:
+                sent = session.sock.sendmsg(parts)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.__drop(session)
+                return
+
+            for part in parts:
+                if sent < len(part):
+                    session.pending += part[sent:]
+                sent = max(sent - len(part), 0)
+
+            if not session.pending:
+                return
+
+            self.__selector.modify(
+                session.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, session)
+
+        if session.worker is None and len(session.pending) > MAX_BUFFER:
+            log.info("Dropping client %s, which is not reading", session.mac)
+            self.__drop(session)
+
+    def __flush(self, session):
+        try:
+            sent = session.sock.send(session.pending)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.__drop(session)
+            return
+
+        del session.pending[:sent]
+
+        if not session.pending:
+            self.__selector.modify(session.sock, selectors.EVENT_READ, session)
+
+    def __drop(self, session):
+        if session.closed:
+            return
+
+        session.closed = True
+        session.pending = bytearray()
+        self.__selector.unregister(session.sock)
+        session.sock.close()
+
+        if session.worker is not None:
+            log.error("Worker %d lost its link to worker %d", self.__index, session.worker)
+            del self.__links[session.worker]
+
+        elif session.mac is not None and self.__clients.get(session.mac) is session:
+            del self.__clients[session.mac]
+            self.__routes.remove(session.mac, self.__index)
+
+
+class HubLink:
+
+    __connection = None
+    __timer = None
+    __stopped = False
+    __nextStream = 0
+
+    def __init__(self, engine, address, contact, onConnection):
+        self.__engine = engine
+        self.__address = address
+        self.__contact = contact
+        self.__onConnection = onConnection
+        self.__streams = {}
+        self.__retries = 0
+
+    def getAddress(self):
+        return self.__address
+
+    def isConnected(self):
+        return self.__connection is not None
+
+    def isWritable(self):
+        return self.__connection is None or self.__connection.isWritable()
+
+    def start(self):
+        self.__timer = None
+
+        if self.__stopped:
+            return
+
+        self.__engine.connect(
+            self.__address[0],
+            self.__address[1],
+            self.__onConnected,
+            self.__onFailed,
+            CONNECT_TIMEOUT)
+
+    def stop(self):
+        self.__stopped = True
+
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+        if self.__connection is not None:
+            self.__connection.close()
+
+    def connect(self, mac, onConnected, onFailed):
+        """Open a stream to the peer with MAC mac. onConnected is called
+        with the HubStream. If the peer is not connected to the hub, the
+        stream is closed soon after it opens."""
+        if self.__connection is None:
+            self.__engine.callSoon(onFailed, ConnectionError("not connected to the hub"))
+            return
+
+        self.__nextStream = (self.__nextStream + 1) % REPLY
+        stream = HubStream(self.__engine, self, mac, self.__nextStream, True)
+        self.__streams[(mac, self.__nextStream | REPLY)] = stream
+
+        self.__connection.write(_encode(OPEN, mac, self.__nextStream))
+        self.__engine.callSoon(onConnected, stream)
+
+    def _write(self, mac, stream, data):
+        if self.__connection is None:
+            return
+
+        with memoryview(data) as view:
+            for start in range(0, len(view), MAX_DATA):
+                self.__connection.write(_encode(DATA, mac, stream, view[start:start + MAX_DATA]))
+
+    def _close(self, mac, stream):
+        if self.__streams.pop((mac, stream ^ REPLY), None) is not None and \
+                self.__connection is not None:
+            self.__connection.write(_encode(CLOSE, mac, stream))
+
+    def __onConnected(self, connection):
+        if self.__stopped:
+            connection.close()
+            return
+
+        decoder = Framing.FrameDecoder(MAX_FRAME, _decode)
+
+        def onData(data):
+            try:
+                for header, data in decoder.feed(data):
+                    self.__onFrame(header, data)
+            except (Framing.FrameError, struct.error) as ex:
+                log.warning("Bad frame from the hub: %s", ex)
+                connection.close()
+
+        self.__connection = connection
+        self.__retries = 0
+        connection.write(_encode(REGISTER, self.__contact.getMAC(), 0))
+        connection.setHandlers(onData, self.__onClose)
+        connection.setWritableHandler(self.__onWritable)
+
+        log.info("Connected to the hub at %s:%d", *self.__address)
+
+    def __onFrame(self, header, data):
+        kind, mac, streamId = header
+        stream = self.__streams.get((mac, streamId))
+
+        if kind == DATA:
+            if stream is not None:
+                stream._receive(data)
+            else:
+                self.__connection.write(_encode(CLOSE, mac, streamId ^ REPLY))
+
+        elif kind == OPEN and not streamId & REPLY:
+            if stream is not None:
+                self.__streams.pop((mac, streamId))
+                stream._closed()
+
+            stream = HubStream(self.__engine, self, mac, streamId | REPLY, False)
+            self.__streams[(mac, streamId)] = stream
+            self.__onConnection(stream)
+
+        elif kind == CLOSE and stream is not None:
+            del self.__streams[(mac, streamId)]
+            stream._closed()
+
+    def __onWritable(self, writable):
+        for stream in list(self.__streams.values()):
+            stream._writable(writable)
+
+    def __onFailed(self, ex):
+        log.info("Could not connect to the hub: %s", ex)
+        self.__retry()
+
+    def __onClose(self):
+        self.__connection = None
+
+        streams, self.__streams = self.__streams, {}
+        for stream in streams.values():
+            stream._closed()
+
+        if not self.__stopped:
+            log.info("Lost the connection to the hub")
+            self.__retry()
+
+    def __retry(self):
+        if self.__stopped:
+            return
+
+        self.__timer = self.__engine.callLater(
+            min(RETRY_DELAY * 2 ** self.__retries, MAX_RETRY_DELAY),
+            self.start)
+        self.__retries += 1
+
+
+class HubStream(Transport.Connection):
+
+    __onData = None
+    __onClose = None
+    __onWritable = None
+    __sending = None
+    __closed = False
+
+    def __init__(self, engine, link, mac, streamId, outbound):
+        """streamId is the ID this end sends its frames with."""
+        self.__engine = engine
+        self.__link = link
+        self.__mac = mac
+        self.__streamId = streamId
+        self.__outbound = outbound
+        self.__pending = []
+
+    def _receive(self, data):
+        if self.__onData is None:
+            self.__pending.append(data)
+        else:
+            self.__onData(data)
+
+    def _closed(self):
+        if self.__closed:
+            return
+
+        self.__closed = True
+        self.__notifyClose()
+
+    def _writable(self, writable):
+        if self.__onWritable is not None:
+            self.__onWritable(writable)
+
+        if writable and self.__sending is not None:
+            sending, self.__sending = self.__sending, None
+            self.sendfile(*sending)
+
+    def __notifyClose(self):
+        sending, self.__sending = self.__sending, None
+        if sending is not None:
+            sending[3](ConnectionError("connection is closed"))
+
+        if self.__onClose is not None:
+            self.__onClose()
+
+    def setHandlers(self, onData, onClose):
+        """Must be called from the engine thread."""
+        self.__onData = onData
+        self.__onClose = onClose
+
+        pending, self.__pending = self.__pending, []
+        for data in pending:
+            onData(data)
+
+        if self.__closed:
+            onClose()
+
+    def setWritableHandler(self, onWritable):
+        self.__onWritable = onWritable
+
+    def isWritable(self):
+        return self.__link.isWritable()
+
+    def getPeerAddress(self):
+        return self.__link.getAddress()
+
+    def getTls(self):
+        return None
+
+    def isOutbound(self):
+        return self.__outbound
+
+    def isClosed(self):
+        return self.__closed
+
+    def write(self, data):
+        if not self.__engine.inEngineThread():
+            self.__engine.callSoon(self.write, data)
+            return
+
+        if not self.__closed:
+            self.__link._write(self.__mac, self.__streamId, data)
+
+    def sendfile(self, file, offset, count, onDone):
+        if not self.__engine.inEngineThread():
+            self.__engine.callSoon(self.sendfile, file, offset, count, onDone)
+            return
+
+        if self.__closed:
+            onDone(ConnectionError("connection is closed"))
+            return
+
+        if count <= 0:
+            onDone(None)
+            return
+
+        # Carry on once the hub connection has drained
+        if not self.__link.isWritable():
+            self.__sending = (file, offset, count, onDone)
+            return
+
+        try:
+            file.seek(offset)
+            data = file.read(min(count, MAX_DATA))
+        except OSError as ex:
+            onDone(ex)
+            return
+
+        if not data:
+            onDone(EOFError("file is shorter than expected"))
+            return
+
+        self.__link._write(self.__mac, self.__streamId, data)
+
+        # One block a turn, so the connection can say when it is full
+        self.__engine.callSoon(self.sendfile, file, offset + len(data), count - len(data), onDone)
+
+    def close(self):
+        if not self.__engine.inEngineThread():
+            self.__engine.callSoon(self.close)
+            return
+
+        if self.__closed:
+            return
+
+        self.__closed = True
+        self.__link._close(self.__mac, self.__streamId)
+
+        # Like a socket, the close handler runs after close returns
+        self.__engine.callSoon(self.__notifyClose)
+
+
+def _raiseFileLimit():
+    """Raise the limit on open files as far as the hard limit allows."""
+    if resource is None:
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as ex:
+            log.warning("Could not raise the open file limit: %s", ex)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SkyChat relay hub")
+    parser.add_argument("--port", type=int, default=hubPort,
+        help="TCP port to serve the hub on")
+    parser.add_argument("--host", default="",
+        help="interface to bind to. Default is all interfaces")
+    parser.add_argument("--workers", type=int, default=None,
+        help="worker processes. Default is one per core")
+    parser.add_argument("--log-level", default="info",
+        choices=("debug", "info", "warning", "error"),
+        help="least severe log messages to show")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, args.log_level.upper()),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # The workers inherit the limit
+    _raiseFileLimit()
+
+    hub = Hub(args.port, args.host, args.workers)
+    log.info("Serving the hub on port %d with %d workers", hub.getPort(), hub.getWorkers())
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    stop.wait()
+
+    hub.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 *-*
+
+"""
+Class Name: MessageStore
+	Keeps messages for peers that cannot be reached, on disk, until they
+	are found again. All of its functions run on the engine thread.
+
+	Each peer has its own queue file, named after its MAC. A queue is a
+	list of records, each one a header followed by the UTF-8 message:
+
+		length				- 4 bytes, length of the message
+		crc					- 4 bytes, CRC-32 of the message
+		expires				- 8 bytes, time after which the message is dropped, in seconds
+							  since the epoch, as a double
+
+	All numbers are big-endian. Messages are only ever appended, and a
+	queue is read and deleted as a whole when its peer is found again.
+	Every append is flushed and synced to disk before it returns, as is a
+	rewritten queue before and after it replaces the old one, along with
+	the directory when a queue file is created or replaced.
+
+	On start only the names of the queue files are read. A queue is
+	scanned the first time it is added to, by reading the headers alone,
+	and a record cut short by a crash is cut off the end of the file.
+	Records whose CRC does not match are skipped when the queue is read.
+
+	A queue holds at most maxMessages messages and maxBytes bytes. When
+	an append goes over either limit, the queue is rewritten without its
+	expired messages and, if it is still over, with only its newest
+	messages down to three quarters of the limits, so a full queue is not
+	rewritten on every append.
+
+	The store does not retry anything itself: numbered messages are
+	resent from the Sync sent log of their conversation. The same TTL and
+	limits are applied to those resends through countDropped, so a
+	message the store would have dropped is not resent either.
+
+Data:
+	__directory				- Directory the queue files are kept in
+	__queued				- MACs that have a queue file
+	__sizes					- (messages, bytes) of each scanned queue, keyed by MAC
+	__maxMessages			- Largest number of messages in one queue
+	__maxBytes				- Largest size of one queue file
+	__ttl					- Seconds a message is kept for
+
+Functions:
+	append					- Appends messages to a peer's queue and returns how many were kept
+	has						- Returns True if messages are waiting for a peer
+	take					- Returns the messages waiting for a peer that have not expired,
+							  oldest first, and deletes the queue
+	getPeers				- Returns the MACs that messages are waiting for
+	countDropped			- Returns how many of the oldest of some sent messages a queue
+							  would drop
+"""
+
+import logging
+import os
+import struct
+import time
+import zlib
+
+
+MAX_MESSAGES = 1000
+MAX_BYTES = 1024 * 1024
+MESSAGE_TTL = 7 * 24 * 60 * 60
+
+HEADER = struct.Struct("!IId")
+SUFFIX = ".queue"
+
+log = logging.getLogger("SkyChat.MessageStore")
+
+
+class MessageStore:
+
+    def __init__(self, directory, maxMessages=MAX_MESSAGES, maxBytes=MAX_BYTES,
+        ttl=MESSAGE_TTL):
+
+        self.__directory = directory
+        self.__maxMessages = maxMessages
+        self.__maxBytes = maxBytes
+        self.__ttl = ttl
+        self.__sizes = {}
+        self.__queued = set()
+
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            names = []
+
+        for name in names:
+            if name.endswith(SUFFIX):
+                try:
+                    self.__queued.add(int(name[:-len(SUFFIX)]))
+                except ValueError:
+                    pass
+
+    def __path(self, mac):
+        return os.path.join(self.__directory, str(mac) + SUFFIX)
+
+    def has(self, mac):
+        return mac in self.__queued
+
+    def getPeers(self):
+        return list(self.__queued)
+
+    def append(self, mac, messages):
+        """Append messages to the queue of the peer with the given MAC.
+        Returns the number of messages that were kept."""
+        if not messages:
+            return 0
+
+        expires = time.time() + self.__ttl
+        records = [self.__encode(message, expires) for message in messages]
+
+        count, size = self.__scan(mac)
+        path = self.__path(mac)
+
+        try:
+            os.makedirs(self.__directory, exist_ok=True)
+            created = not os.path.exists(path)
+
+            with open(path, "ab") as f:
+                f.write(b"".join(records))
+                f.flush()
+                os.fsync(f.fileno())
+
+            # A new file is only durable once its directory entry is
+            if created:
+                self.__syncDirectory()
+        except OSError as ex:
+            log.warning("Could not store %d messages for %s: %s", len(records), mac, ex)
+            return 0
+
+        self.__queued.add(mac)
+        count += len(records)
+        size += sum(len(record) for record in records)
+        self.__sizes[mac] = (count, size)
+
+        if count > self.__maxMessages or size > self.__maxBytes:
+            count = self.__compact(mac)
+
+        return min(len(records), count)
+
+    def take(self, mac):
+        """Return the messages waiting for the peer with the given MAC, and
+        delete its queue."""
+        if mac not in self.__queued:
+            return []
+
+        messages = [message for expires, message in self.__read(mac)
+            if expires > time.time()]
+
+        self.__delete(mac)
+        return messages
+
+    def countDropped(self, messages):
+        """Takes (sent, message) pairs, oldest first, where sent is the time
+        the message was first sent in seconds since the epoch. Returns how
+        many of the oldest ones this store would not keep."""
+        return self.__countDropped([(sent + self.__ttl, message) for sent, message in messages])
+
+    def __countDropped(self, records):
+        """Returns how many of the oldest (expires, message) records a
+        queue would drop: the expired ones, and when the rest go over
+        either limit, the oldest down to three quarters of the limits."""
+        now = time.time()
+        expired = 0
+
+        for index, (expires, message) in enumerate(records):
+            if expires <= now:
+                expired = index + 1
+
+        sizes = [HEADER.size + len(message.encode("utf-8")) for expires, message in
+            records[expired:]]
+
+        if len(sizes) <= self.__maxMessages and sum(sizes) <= self.__maxBytes:
+            return expired
+
+        maxMessages = self.__maxMessages * 3 // 4
+        maxBytes = self.__maxBytes * 3 // 4
+        kept = 0
+        size = 0
+
+        for length in reversed(sizes):
+            if kept >= maxMessages or size + length > maxBytes:
+                break
+
+            kept += 1
+            size += length
+
+        return len(records) - kept
+
+    def __encode(self, message, expires):
+        payload = message.encode("utf-8")
+        return HEADER.pack(len(payload), zlib.crc32(payload), expires) + payload
+
+    def __scan(self, mac):
+        """Returns the (messages, bytes) of a queue, reading only the
+        headers, and cuts off a torn record at the end."""
+        size = self.__sizes.get(mac)
+        if size is not None:
+            return size
+
+        count = 0
+        offset = 0
+
+        try:
+            with open(self.__path(mac), "r+b") as f:
+                end = os.fstat(f.fileno()).st_size
+
+                while offset + HEADER.size <= end:
+                    f.seek(offset)
+                    length, crc, expires = HEADER.unpack(f.read(HEADER.size))
+
+                    if offset + HEADER.size + length > end:
+                        break
+
+                    offset += HEADER.size + length
+                    count += 1
+
+                if offset < end:
+                    log.info("Cutting %d torn bytes off the queue for %s", end - offset, mac)
+                    f.truncate(offset)
+
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            log.warning("Could not read the queue for %s: %s", mac, ex)
+
+        self.__sizes[mac] = (count, offset)
+        return count, offset
+
+    def __read(self, mac):
+        """Returns the (expires, message) of every valid record of a queue."""
+        try:
+            with open(self.__path(mac), "rb") as f:
+                data = f.read()
+        except OSError:
+            return []
+
+        records = []
+        offset = 0
+
+        while offset + HEADER.size <= len(data):
+            length, crc, expires = HEADER.unpack_from(data, offset)
+            start = offset + HEADER.size
+            payload = data[start:start + length]
+
+            if len(payload) < length:
+                break
+
+            offset = start + length
+
+            if zlib.crc32(payload) != crc:
+                log.warning("Skipping a damaged message for %s", mac)
+                continue
+
+            records.append((expires, payload.decode("utf-8", "replace")))
+
+        return records
+
+    def __compact(self, mac):
+        """Rewrite a queue without the messages it would drop, and return
+        the number kept."""
+        records = self.__read(mac)
+        dropped = self.__countDropped(records)
+        kept = [self.__encode(message, expires) for expires, message in records[dropped:]]
+        size = sum(len(record) for record in kept)
+
+        if len(kept) < len(records):
+            log.warning("Queue for %s is full, dropping %d messages",
+                mac, len(records) - len(kept))
+
+        path = self.__path(mac)
+
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(b"".join(kept))
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(path + ".tmp", path)
+            self.__syncDirectory()
+        except OSError as ex:
+            log.warning("Could not compact the queue for %s: %s", mac, ex)
+            self.__sizes.pop(mac, None)
+            return len(records)
+
+        self.__sizes[mac] = (len(kept), size)
+        return len(kept)
+
+    def __syncDirectory(self):
+        """Flush the directory entries of the queue files to disk. Not every
+        platform can open a directory, and those that cannot are skipped."""
+        try:
+            fd = os.open(self.__directory, os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def __delete(self, mac):
+        self.__queued.discard(mac)
+        self.__sizes.pop(mac, None)
+
+        try:
+            os.remove(self.__path(mac))
+        except OSError:
+            pass
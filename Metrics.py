@@ -0,0 +1,354 @@
+# -*- coding: utf-8 *-*
+
+"""
+Counters, gauges and latency histograms for a client, with a snapshot
+and a Prometheus text export.
+
+Metrics are off unless a Client is given a Registry or a metrics port.
+A client without them uses DISABLED, whose counters and histograms do
+nothing, and the timing of hot paths is skipped when isEnabled() is
+False, so turning metrics off costs one call per event.
+
+Counters and histograms are only updated on the engine thread.
+
+
+
+Class Name: Registry
+	Every metric of a client, by name.
+
+Functions:
+	counter					- Returns the Counter with the given name, adding it if needed
+	histogram				- Returns the Histogram with the given name, adding it if needed
+	gauge					- Adds a gauge whose value is read from a function when exported
+	isEnabled				- Returns True
+	snapshot				- Returns a dictionary with the current value of every metric
+	export					- Returns every metric in the Prometheus text format
+
+
+
+Class Name: NullRegistry
+	A Registry whose metrics do nothing, used when metrics are off.
+
+
+
+Class Name: Counter
+	A number that only goes up.
+
+Functions:
+	inc						- Adds to the counter. The default is 1.
+	get						- Returns the value
+
+
+
+Class Name: Histogram
+	Counts observations in buckets of increasing upper bounds. The
+	default bounds suit latencies in seconds.
+
+Functions:
+	observe					- Adds an observation
+	get						- Returns (bucket counts, sum, count). Bucket counts are not cumulative.
+
+
+
+Class Name: ClientMetrics
+	The metrics one client updates, looked up once so the hot paths
+	only touch attributes.
+
+Data:
+	messagesSent			- Messages written to peer connections
+	messagesReceived		- Messages read from peer connections
+	bytesSent				- Bytes written to peer connections
+	bytesReceived			- Bytes read from peer connections
+	discoverySent			- Discovery datagrams sent
+	discoveryReceived		- Discovery datagrams received
+	discoveryInvalid		- Datagrams on the discovery port that were not packets
+	connectFailures			- Connections to peers that could not be opened
+	expiredPeers			- Peers removed because they stopped sending heartbeats
+	messagesStored			- Messages kept on disk for peers that could not be reached
+	messagesForwarded		- Stored messages sent to peers that were found again
+	messageParse			- Seconds spent decoding the data of each read
+	discoveryParse			- Seconds spent decoding each discovery datagram
+	connectTime				- Seconds from starting a connection to matching its hello
+
+Functions:
+	isEnabled				- Returns True if the registry is not a NullRegistry
+	getRegistry				- Returns the Registry
+
+
+
+Class Name: MetricsServer
+	Serves a Registry's export over HTTP on a local port, for a
+	Prometheus scraper or curl. Every request gets the export, whatever
+	its path.
+
+Functions:
+	getPort					- Returns the port that was bound
+	close					- Stops serving
+"""
+
+import bisect
+import logging
+import time
+
+
+log = logging.getLogger("SkyChat.Metrics")
+
+# Clock used to time hot paths
+clock = time.perf_counter
+
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = "skychat_"
+MAX_REQUEST = 8192
+
+
+class Counter:
+
+    __slots__ = ("__value",)
+
+    def __init__(self):
+        self.__value = 0
+
+    def inc(self, amount=1):
+        self.__value += amount
+
+    def get(self):
+        return self.__value
+
+
+class Histogram:
+
+    __slots__ = ("__bounds", "__counts", "__sum", "__count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.__bounds = tuple(bounds)
+        self.__counts = [0] * (len(self.__bounds) + 1)
+        self.__sum = 0.0
+        self.__count = 0
+
+    def getBounds(self):
+        return self.__bounds
+
+    def observe(self, value):
+        self.__counts[bisect.bisect_left(self.__bounds, value)] += 1
+        self.__sum += value
+        self.__count += 1
+
+    def get(self):
+        return list(self.__counts), self.__sum, self.__count
+
+
+class _NullCounter:
+
+    __slots__ = ()
+
+    def inc(self, amount=1):
+        pass
+
+    def get(self):
+        return 0
+
+
+class _NullHistogram:
+
+    __slots__ = ()
+
+    def observe(self, value):
+        pass
+
+    def get(self):
+        return [], 0.0, 0
+
+
+class Registry:
+
+    def __init__(self):
+        # name: (kind, help, metric), in the order they were added
+        self.__metrics = {}
+
+    def isEnabled(self):
+        return True
+
+    def counter(self, name, help=""):
+        return self.__add(name, "counter", help, Counter)
+
+    def histogram(self, name, help="", bounds=LATENCY_BUCKETS):
+        return self.__add(name, "histogram", help, lambda: Histogram(bounds))
+
+    def gauge(self, name, help, function):
+        """Add a gauge whose value is function(), read on every snapshot."""
+        self.__metrics[name] = ("gauge", help, function)
+
+    def __add(self, name, kind, help, make):
+        entry = self.__metrics.get(name)
+
+        if entry is None:
+            entry = (kind, help, make())
+            self.__metrics[name] = entry
+        elif entry[0] != kind:
+            raise ValueError(name + " is already a " + entry[0])
+
+        return entry[2]
+
+    def snapshot(self):
+        """Returns {name: value}. Histograms are {"buckets", "sum", "count"}
+        with one count per bound, plus one for larger values."""
+        values = {}
+
+        for name, (kind, help, metric) in list(self.__metrics.items()):
+            if kind == "gauge":
+                values[name] = _read(name, metric)
+            elif kind == "counter":
+                values[name] = metric.get()
+            else:
+                counts, total, count = metric.get()
+                values[name] = {"buckets": counts, "sum": total, "count": count}
+
+        return values
+
+    def export(self):
+        """Returns every metric in the Prometheus text format."""
+        lines = []
+
+        for name, (kind, help, metric) in list(self.__metrics.items()):
+            name = PREFIX + name
+
+            if help:
+                lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+            if kind == "gauge":
+                lines.append("%s %s" % (name, _number(_read(name, metric))))
+
+            elif kind == "counter":
+                lines.append("%s %s" % (name, _number(metric.get())))
+
+            else:
+                counts, total, count = metric.get()
+                cumulative = 0
+
+                for bound, bucket in zip(metric.getBounds(), counts):
+                    cumulative += bucket
+                    lines.append('%s_bucket{le="%s"} %d' % (name, _number(bound), cumulative))
+
+                lines.append('%s_bucket{le="+Inf"} %d' % (name, count))
+                lines.append("%s_sum %s" % (name, _number(total)))
+                lines.append("%s_count %d" % (name, count))
+
+        return "\n".join(lines) + "\n"
+
+
+class NullRegistry(Registry):
+
+    __counter = _NullCounter()
+    __histogram = _NullHistogram()
+
+    def isEnabled(self):
+        return False
+
+    def counter(self, name, help=""):
+        return self.__counter
+
+    def histogram(self, name, help="", bounds=LATENCY_BUCKETS):
+        return self.__histogram
+
+    def gauge(self, name, help, function):
+        pass
+
+
+def _read(name, function):
+    try:
+        return function()
+    except Exception as ex:
+        log.warning("Could not read gauge %s: %s", name, ex)
+        return 0
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class ClientMetrics:
+
+    def __init__(self, registry):
+        self.__registry = registry
+        self.__enabled = registry.isEnabled()
+
+        self.messagesSent = registry.counter(
+            "messages_sent_total", "Messages written to peer connections")
+        self.messagesReceived = registry.counter(
+            "messages_received_total", "Messages read from peer connections")
+        self.bytesSent = registry.counter(
+            "bytes_sent_total", "Bytes written to peer connections")
+        self.bytesReceived = registry.counter(
+            "bytes_received_total", "Bytes read from peer connections")
+        self.discoverySent = registry.counter(
+            "discovery_packets_sent_total", "Discovery datagrams sent")
+        self.discoveryReceived = registry.counter(
+            "discovery_packets_received_total", "Discovery datagrams received")
+        self.discoveryInvalid = registry.counter(
+            "discovery_packets_invalid_total", "Datagrams that were not discovery packets")
+        self.connectFailures = registry.counter(
+            "connect_failures_total", "Connections to peers that could not be opened")
+        self.expiredPeers = registry.counter(
+            "expired_peers_total", "Peers that stopped sending heartbeats")
+        self.messagesStored = registry.counter(
+            "messages_stored_total", "Messages kept for peers that could not be reached")
+        self.messagesForwarded = registry.counter(
+            "messages_forwarded_total", "Stored messages sent to peers that were found again")
+
+        self.messageParse = registry.histogram(
+            "message_parse_seconds", "Time to decode the data of one read")
+        self.discoveryParse = registry.histogram(
+            "discovery_parse_seconds", "Time to decode one discovery datagram")
+        self.connectTime = registry.histogram(
+            "connect_seconds", "Time from opening a connection to its hello")
+
+    def isEnabled(self):
+        return self.__enabled
+
+    def getRegistry(self):
+        return self.__registry
+
+
+DISABLED = ClientMetrics(NullRegistry())
+
+
+class MetricsServer:
+
+    def __init__(self, engine, registry, port, host="127.0.0.1"):
+        self.__engine = engine
+        self.__registry = registry
+        self.__listener = engine.listen(port, self.__onConnection, host)
+
+    def getPort(self):
+        return self.__listener.getPort()
+
+    def close(self):
+        self.__listener.close()
+
+    def __onConnection(self, connection):
+        request = bytearray()
+
+        def onData(data):
+            request.extend(data)
+
+            # Answer once the request headers are in
+            if b"\r\n\r\n" not in request and b"\n\n" not in request and \
+                    len(request) < MAX_REQUEST:
+                return
+
+            connection.setHandlers(lambda data: None, lambda: None)
+
+            body = self.__registry.export().encode("utf-8")
+            connection.write(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: " + str(len(body)).encode("ascii") + b"\r\n"
+                b"\r\n" + body)
+            connection.close()
+
+        connection.setHandlers(onData, lambda: None)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 *-*
+
+"""
+A cache of the peers a client knew when it last logged out, so the
+friends list is filled as soon as the client starts instead of once the
+segment has answered its announcement.
+
+The cache is one small binary file, rewritten as a whole on logout:
+
+	magic					- 4 bytes, always b"SKPC"
+	version					- 1 byte, CACHE_VERSION
+
+followed by one record for each peer:
+
+	mac						- 8 bytes
+	address					- 4 bytes, IPv4 address the peer was last seen at
+	port					- 2 bytes, port the peer accepts connections on
+	alertPort				- 2 bytes, port the peer's discovery packets came from. 0 if unknown
+	lastSeen				- 8 bytes, time the peer was last heard from, in seconds since the
+							  epoch, as a double
+	status					- 1 byte length followed by UTF-8 text
+	name					- 1 byte length followed by UTF-8 text
+
+All numbers are big-endian. Peers that have not been heard from for
+CACHE_TTL seconds are left out when the cache is read.
+
+Cached peers are shown as unverified until they are heard from again.
+Rather than waiting for them to answer a broadcast, the client sends
+each one a PROBE packet straight to the address it was last seen at,
+which a running client answers right away with a REPLY.
+
+Functions:
+	load					- Returns the CachedPeer of every peer in a cache file that has not
+							  expired. A missing or damaged file gives the peers read so far.
+	save					- Writes the peers of a registry to a cache file
+
+
+
+Class Name: CachedPeer
+	A peer read from the cache. A named tuple with the fields mac, name,
+	status, address, port, alertPort and lastSeen.
+
+
+
+Class Name: Prober
+	Checks that cached peers are still there with unicast probes. All of
+	its functions run on the engine thread.
+
+	At most PROBE_RATE probes are sent each PROBE_INTERVAL, so a large
+	cache does not flood the network on start. A peer that has not
+	answered after PROBE_ATTEMPTS probes is expired.
+
+Data:
+	__engine				- Engine that runs the ticks
+	__probe					- Function called with the MAC of every peer to probe
+	__onExpired				- Function called with the MAC of every peer that did not answer
+	__queue					- (MAC, probes sent) of each peer waiting for a probe, in order
+	__waiting				- MACs of the peers that have not answered yet
+	__timer					- Timer for the next tick, or None
+
+Functions:
+	add						- Starts probing a peer
+	remove					- Stops probing a peer, once it is heard from or gone. Returns True
+							  if it was being probed.
+	stop					- Stops probing every peer
+"""
+
+import collections
+import logging
+import os
+import socket
+import struct
+import time
+
+
+MAGIC = b"SKPC"
+CACHE_VERSION = 1
+
+HEADER = struct.Struct("!4sB")
+RECORD = struct.Struct("!Q4sHHd")
+MAX_TEXT_SIZE = 255
+
+CACHE_TTL = 30 * 24 * 60 * 60
+
+PROBE_INTERVAL = 1.0
+PROBE_RATE = 50
+PROBE_ATTEMPTS = 3
+
+CachedPeer = collections.namedtuple(
+    "CachedPeer",
+    ("mac", "name", "status", "address", "port", "alertPort", "lastSeen"))
+
+log = logging.getLogger("SkyChat.PeerCache")
+
+
+def _encodeText(text):
+    data = (text or "").encode("utf-8")[:MAX_TEXT_SIZE]
+    return bytes((len(data),)) + data
+
+
+def _decodeText(data, offset):
+    length = data[offset]
+    end = offset + 1 + length
+
+    if end > len(data):
+        raise IndexError("text runs past the end of the cache")
+
+    return str(data[offset + 1:end], "utf-8", "ignore"), end
+
+
+def save(path, peers):
+    """Write every peer in peers, which are contacts, to the cache at
+    path."""
+    records = [HEADER.pack(MAGIC, CACHE_VERSION)]
+
+    for peer in peers:
+        try:
+            address = socket.inet_aton(peer.getAddress())
+        except (OSError, TypeError):
+            continue
+
+        alertAddress = peer.getAlertAddress()
+
+        records.append(
+            RECORD.pack(
+                peer.getMAC(),
+                address,
+                peer.getPort(),
+                alertAddress[1] if alertAddress is not None else 0,
+                peer.getLastSeen()) +
+            _encodeText(peer.getStatus()) +
+            _encodeText(peer.getName()))
+
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(b"".join(records))
+        os.replace(path + ".tmp", path)
+    except OSError as ex:
+        log.warning("Could not save the peer cache %s: %s", path, ex)
+
+
+def load(path):
+    """Returns the CachedPeers in the cache at path that have not
+    expired."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    except OSError as ex:
+        log.warning("Could not read the peer cache %s: %s", path, ex)
+        return []
+
+    if len(data) < HEADER.size or HEADER.unpack_from(data)[0] != MAGIC:
+        log.warning("Ignoring %s, which is not a peer cache", path)
+        return []
+
+    oldest = time.time() - CACHE_TTL
+    peers = []
+    offset = HEADER.size
+
+    try:
+        while offset < len(data):
+            mac, address, port, alertPort, lastSeen = RECORD.unpack_from(data, offset)
+            status, offset = _decodeText(data, offset + RECORD.size)
+            name, offset = _decodeText(data, offset)
+
+            if lastSeen >= oldest:
+                peers.append(CachedPeer(
+                    mac, name, status, socket.inet_ntoa(address), port, alertPort, lastSeen))
+
+    except (IndexError, struct.error):
+        log.warning("The peer cache %s is damaged after %d peers", path, len(peers))
+
+    return peers
+
+
+class Prober:
+
+    __timer = None
+
+    def __init__(self, engine, probe, onExpired):
+        self.__engine = engine
+        self.__probe = probe
+        self.__onExpired = onExpired
+        self.__queue = collections.deque()
+        self.__waiting = set()
+
+    def add(self, mac):
+        if mac in self.__waiting:
+            return
+
+        self.__waiting.add(mac)
+        self.__queue.append((mac, 0))
+
+        if self.__timer is None:
+            self.__timer = self.__engine.callLater(0, self.__tick)
+
+    def remove(self, mac):
+        if mac not in self.__waiting:
+            return False
+
+        # Its place in the queue is skipped when it comes up
+        self.__waiting.discard(mac)
+        return True
+
+    def stop(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+        self.__queue.clear()
+        self.__waiting.clear()
+
+    def __tick(self):
+        self.__timer = None
+        sent = 0
+
+        # Peers probed in this tick go to the back, for the next one
+        for i in range(len(self.__queue)):
+            if sent == PROBE_RATE:
+                break
+
+            mac, attempts = self.__queue.popleft()
+
+            if mac not in self.__waiting:
+                continue
+
+            if attempts == PROBE_ATTEMPTS:
+                self.__waiting.discard(mac)
+                self.__onExpired(mac)
+                continue
+
+            self.__probe(mac)
+            self.__queue.append((mac, attempts + 1))
+            sent += 1
+
+        if self.__queue:
+            self.__timer = self.__engine.callLater(PROBE_INTERVAL, self.__tick)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 *-*
+
+"""
+Class Name: PeerRegistry
+	Keeps track of every peer known to a client. Peers are indexed by
+	MAC and by a peer ID, so every lookup, insert and remove takes
+	constant time no matter how many peers are on the network. Peers are
+	not looked up by address, since a peer is identified by the MAC in
+	its hello and not by where it connects from.
+
+	Peer IDs are handed out when a peer is added and are never reused,
+	so the UI can keep them to refer to a peer later.
+
+Data:
+	__byMAC					- Peers keyed by MAC
+	__byId					- Peers keyed by peer ID
+	__nextId				- Peer ID given to the next peer that is added
+
+Functions:
+	add						- Adds a peer, gives it a peer ID and returns the ID
+	remove					- Removes a peer
+	removeByMAC				- Removes the peer with the given MAC and returns it, or None
+	getByMAC				- Returns the peer with the given MAC, or None
+	getById					- Returns the peer with the given peer ID, or None
+"""
+
+
+class PeerRegistry:
+
+    def __init__(self):
+        self.__byMAC = {}
+        self.__byId = {}
+        self.__nextId = 1
+
+    def __len__(self):
+        return len(self.__byId)
+
+    def __iter__(self):
+        return iter(list(self.__byId.values()))
+
+    def __contains__(self, mac):
+        return mac in self.__byMAC
+
+    def add(self, peer):
+        """Add a peer and return its new peer ID."""
+        peerId = self.__nextId
+        self.__nextId += 1
+
+        peer.setId(peerId)
+        self.__byId[peerId] = peer
+        self.__byMAC[peer.getMAC()] = peer
+
+        return peerId
+
+    def remove(self, peer):
+        self.__byId.pop(peer.getId(), None)
+
+        if self.__byMAC.get(peer.getMAC()) is peer:
+            del self.__byMAC[peer.getMAC()]
+
+    def removeByMAC(self, mac):
+        """Remove the peer with the given MAC and return it."""
+        peer = self.__byMAC.get(mac)
+
+        if peer is not None:
+            self.remove(peer)
+
+        return peer
+
+    def getByMAC(self, mac):
+        return self.__byMAC.get(mac)
+
+    def getById(self, peerId):
+        return self.__byId.get(peerId)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 *-*
+
+"""
+Failure detection for peers that disappear without logging out.
+
+Every client broadcasts a HEARTBEAT packet every few seconds. The packet
+holds the sender's heartbeat interval, and a peer that is not heard from
+for MISSED_HEARTBEATS of its intervals is taken to have crashed or left
+the network.
+
+The interval grows with the number of peers on the segment, so the
+segment as a whole sends about HEARTBEAT_RATE heartbeats a second. It
+never more than doubles from one heartbeat to the next, so a peer is
+never expired by a receiver that still expects the shorter interval.
+
+
+
+Class Name: TimingWheel
+	Deadlines for a large number of keys, checked once a tick.
+
+	The wheel is a ring of SLOTS slots, each TICK seconds long. A key is
+	kept in the slot of its deadline, and moving or removing it is a
+	dictionary operation, so refreshing a key costs the same however
+	many keys there are. Each tick only looks at the keys in the slot
+	that has come due.
+
+Data:
+	__slots					- Keys in each slot, keyed by key with their deadlines
+	__slotOf				- Slot that each key is in
+	__cursor				- Slot of the current tick
+	__now					- Time of the current tick
+
+Functions:
+	schedule				- Sets or moves the deadline of a key. Delays are capped to the wheel's span.
+	cancel					- Forgets a key
+	advance					- Moves the wheel to a time and returns the keys that expired
+
+
+
+Class Name: FailureDetector
+	Expires the peers of a client that stop sending. All of its
+	functions run on the engine thread.
+
+Data:
+	__engine				- Engine that runs the ticks
+	__wheel					- TimingWheel with the deadline of every peer
+	__intervals				- Last heartbeat interval each peer sent, keyed by MAC
+	__onExpired				- Function called with the MAC of every expired peer
+	__timer					- Timer for the next tick, or None
+
+Functions:
+	start					- Starts ticking
+	stop					- Stops ticking
+	heard					- Pushes back the deadline of a peer that was just heard from
+	isTracking				- Returns True if a peer has a deadline
+	forget					- Stops tracking a peer
+"""
+
+HEARTBEAT_INTERVAL = 10
+MAX_HEARTBEAT_INTERVAL = 120
+HEARTBEAT_RATE = 50
+MISSED_HEARTBEATS = 3
+
+TICK = 1.0
+SLOTS = 512
+
+
+def heartbeatInterval(peers, previous=None):
+    """Returns the heartbeat interval, in whole seconds, for a client that
+    knows peers others. previous is the interval it last sent."""
+    interval = min(
+        MAX_HEARTBEAT_INTERVAL,
+        max(HEARTBEAT_INTERVAL, int(peers / HEARTBEAT_RATE)))
+
+    if previous is not None:
+        interval = min(interval, 2 * previous)
+
+    return interval
+
+
+class TimingWheel:
+
+    def __init__(self, now, tick=TICK, slots=SLOTS):
+        self.__tick = tick
+        self.__slots = [{} for i in range(slots)]
+        self.__slotOf = {}
+        self.__cursor = 0
+        self.__now = now
+
+    def __len__(self):
+        return len(self.__slotOf)
+
+    def __contains__(self, key):
+        return key in self.__slotOf
+
+    def schedule(self, key, delay):
+        """Expire key after delay seconds, replacing any earlier deadline."""
+        self.cancel(key)
+
+        # A key always lands at least one tick ahead, and within one turn
+        ticks = min(len(self.__slots) - 1, max(1, -int(-delay // self.__tick)))
+        slot = (self.__cursor + ticks) % len(self.__slots)
+
+        self.__slots[slot][key] = self.__now + ticks * self.__tick
+        self.__slotOf[key] = slot
+
+    def cancel(self, key):
+        slot = self.__slotOf.pop(key, None)
+        if slot is not None:
+            del self.__slots[slot][key]
+
+    def advance(self, now):
+        """Move the wheel forward to now and return the expired keys."""
+        expired = []
+
+        while self.__now + self.__tick <= now:
+            self.__now += self.__tick
+            self.__cursor = (self.__cursor + 1) % len(self.__slots)
+
+            slot = self.__slots[self.__cursor]
+            if slot:
+                expired.extend(slot)
+                for key in slot:
+                    del self.__slotOf[key]
+                slot.clear()
+
+        return expired
+
+
+class FailureDetector:
+
+    __timer = None
+
+    def __init__(self, engine, onExpired):
+        self.__engine = engine
+        self.__onExpired = onExpired
+        self.__intervals = {}
+        self.__wheel = None
+
+    def start(self):
+        self.__wheel = TimingWheel(self.__engine.time())
+        self.__timer = self.__engine.callLater(TICK, self.__tick)
+
+    def stop(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+    def heard(self, mac, interval=None):
+        """Push back the deadline of the peer with the given MAC. interval
+        is the heartbeat interval it sent, if the packet held one."""
+        if self.__wheel is None:
+            return
+
+        if interval:
+            self.__intervals[mac] = interval
+
+        # Old clients and peers only listed by others send no interval,
+        # so allow them the longest one until they send a heartbeat
+        interval = self.__intervals.get(mac, MAX_HEARTBEAT_INTERVAL)
+        self.__wheel.schedule(mac, MISSED_HEARTBEATS * interval + TICK)
+
+    def isTracking(self, mac):
+        return self.__wheel is not None and mac in self.__wheel
+
+    def forget(self, mac):
+        self.__intervals.pop(mac, None)
+
+        if self.__wheel is not None:
+            self.__wheel.cancel(mac)
+
+    def __tick(self):
+        self.__timer = self.__engine.callLater(TICK, self.__tick)
+
+        for mac in self.__wheel.advance(self.__engine.time()):
+            self.__intervals.pop(mac, None)
+            self.__onExpired(mac)
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 *-*
+
+"""
+Optional TLS for the connections between peers.
+
+Every client has its own self-signed certificate, made with the openssl
+command the first time TLS is turned on, and kept with its key in the
+client's data directory. Peers are not checked against any authority.
+Instead each peer's certificate is pinned to its MAC, the identity it
+announces in discovery, the first time it is seen, and a peer whose
+certificate later changes is refused.
+
+Both ends of a connection present their certificates. The listening
+end only accepts client certificates it has pinned, and the standard
+ssl module cannot accept an unknown one, so a client fetches the
+certificate of every new peer as soon as discovery finds it: it opens a
+TLS connection to the peer without presenting a certificate, pins the
+one the peer presents, and closes the connection. By the time the two
+peers talk, each knows the other's certificate. If a peer connects
+before its certificate has been fetched, the handshake fails and the
+connection is retried as usual.
+
+Once the hello of a connection says which peer is at the other end, its
+certificate must be the one pinned to that MAC, whichever end opened it.
+
+Reconnecting to a known peer resumes the last TLS session with it, so
+the expensive part of the handshake is only done once.
+
+Discovery packets stay in plain text. TLS must be on for every client
+on the network or for none of them.
+
+Functions:
+	createIdentity			- Returns the paths of this client's certificate and key, making
+							  them with openssl if they do not exist
+	serverName				- Returns the server name used to connect to a peer
+	connectOptions			- Returns the TLS keyword arguments of Transport.connect for a
+							  connection to a peer, which are none without TLS
+	fingerprint				- Returns the SHA-256 fingerprint of a certificate
+
+
+
+Class Name: Tls
+	The TLS identity of a client and the certificates it has pinned.
+	All of its functions run on the engine thread unless they say
+	otherwise.
+
+Data:
+	__engine				- Engine that opens the connections to fetch certificates
+	__pins					- DER certificate of every pinned peer, keyed by MAC
+	__pinsPath				- File the pins are saved to
+	__serverContext			- SSLContext for accepted connections. It trusts every pinned certificate.
+	__clientContext			- SessionContext for connections to peers
+	__probeContext			- SSLContext for fetching certificates, without one of our own
+	__fetching				- MACs whose certificate is being fetched
+	__waiting				- Peers waiting for a free fetch, oldest first
+
+Functions:
+	getServerContext		- Returns the context for the listener (any thread)
+	getClientContext		- Returns the context for connections to peers
+	check					- Returns True if the certificate of a connection is the one pinned
+							  to a MAC, pinning it if there is none yet
+	fetch					- Fetches and pins the certificate of a peer, unless it is pinned
+	isPinned				- Returns True if a certificate is pinned to a MAC
+
+
+
+Class Name: SessionContext
+	A client SSLContext that resumes the last session it had with each
+	server name.
+
+Functions:
+	saveSession				- Keeps the session of a connection for its server name
+"""
+
+import base64
+import collections
+import hashlib
+import logging
+import os
+import ssl
+import subprocess
+
+
+CERTIFICATE = "cert.pem"
+KEY = "key.pem"
+PINS = "pins"
+DAYS = 3650
+MAX_FETCHES = 8
+FETCH_TIMEOUT = 5.0
+
+log = logging.getLogger("SkyChat.Security")
+
+
+def createIdentity(directory, mac):
+    """Returns (certificate path, key path), making a self-signed
+    certificate for mac with openssl if there is none. Raises RuntimeError
+    if it cannot be made."""
+    certificate = os.path.join(directory, CERTIFICATE)
+    key = os.path.join(directory, KEY)
+
+    if os.path.exists(certificate) and os.path.exists(key):
+        return certificate, key
+
+    os.makedirs(directory, exist_ok=True)
+    log.info("Making a TLS certificate in %s", directory)
+
+    try:
+        subprocess.run(
+            ["openssl", "req", "-x509", "-nodes",
+                "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                "-keyout", key, "-out", certificate,
+                "-days", str(DAYS), "-subj", "/CN=skychat-%d" % mac],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise RuntimeError(
+            "Could not make a TLS certificate with openssl. Install openssl, or "
+            "put a certificate and key in %s and %s: %s" % (certificate, key, ex))
+
+    os.chmod(key, 0o600)
+    return certificate, key
+
+
+def serverName(mac):
+    return "skychat-%d" % mac
+
+
+def connectOptions(tls, mac):
+    if tls is None:
+        return {}
+
+    return {"tls": tls.getClientContext(), "serverName": serverName(mac)}
+
+
+def fingerprint(certificate):
+    return hashlib.sha256(certificate).hexdigest()
+
+
+class SessionContext(ssl.SSLContext):
+    """asyncio makes every TLS connection through wrap_bio, which is given
+    the server name but no session, so the session is added here."""
+
+    def __init__(self, protocol):
+        # SSLContext is set up in __new__
+        self.__sessions = {}
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None,
+        session=None):
+
+        if session is None and not server_side:
+            session = self.__sessions.get(server_hostname)
+
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def saveSession(self, tls):
+        if tls.session is not None:
+            self.__sessions[tls.server_hostname] = tls.session
+
+
+class Tls:
+
+    def __init__(self, engine, directory, mac):
+        self.__engine = engine
+        self.__pins = {}
+        self.__pinsPath = os.path.join(directory, PINS)
+        self.__fetching = set()
+        self.__waiting = collections.deque()
+
+        certificate, key = createIdentity(directory, mac)
+
+        self.__serverContext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.__serverContext.load_cert_chain(certificate, key)
+        self.__serverContext.verify_mode = ssl.CERT_OPTIONAL
+
+        # Peers are checked against their pins, not an authority
+        self.__clientContext = SessionContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.__clientContext.check_hostname = False
+        self.__clientContext.verify_mode = ssl.CERT_NONE
+        self.__clientContext.load_cert_chain(certificate, key)
+
+        self.__probeContext = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.__probeContext.check_hostname = False
+        self.__probeContext.verify_mode = ssl.CERT_NONE
+
+        self.__loadPins()
+
+    def __loadPins(self):
+        try:
+            with open(self.__pinsPath) as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+
+        for line in lines:
+            try:
+                mac, certificate = line.split()
+                self.__pins[int(mac)] = base64.b64decode(certificate)
+            except ValueError:
+                log.warning("Skipping an invalid line in %s", self.__pinsPath)
+
+        if self.__pins:
+            self.__serverContext.load_verify_locations(
+                cadata=b"".join(self.__pins.values()))
+
+    def __pin(self, mac, certificate):
+        log.info("Pinning certificate %s to %s", fingerprint(certificate), mac)
+        self.__pins[mac] = certificate
+
+        # New handshakes see the certificate right away
+        self.__serverContext.load_verify_locations(cadata=certificate)
+
+        try:
+            with open(self.__pinsPath, "a") as f:
+                f.write("%d %s\n" % (mac, base64.b64encode(certificate).decode("ascii")))
+        except OSError as ex:
+            log.warning("Could not save the pin for %s: %s", mac, ex)
+
+    def getServerContext(self):
+        return self.__serverContext
+
+    def getClientContext(self):
+        return self.__clientContext
+
+    def isPinned(self, mac):
+        return mac in self.__pins
+
+    def check(self, connection, mac):
+        """Returns True if the certificate of connection is the one pinned
+        to mac. The first certificate seen for a MAC is pinned."""
+        tls = connection.getTls()
+        if tls is None:
+            return False
+
+        certificate = tls.getpeercert(binary_form=True)
+        if certificate is None:
+            log.warning("No certificate from %s", mac)
+            return False
+
+        pinned = self.__pins.get(mac)
+
+        if pinned is None:
+            self.__pin(mac, certificate)
+        elif pinned != certificate:
+            log.warning("Certificate %s of %s does not match its pin %s",
+                fingerprint(certificate), mac, fingerprint(pinned))
+            return False
+
+        if connection.isOutbound():
+            self.__clientContext.saveSession(tls)
+
+        return True
+
+    def fetch(self, peer):
+        """Fetch and pin the certificate of peer, unless it is pinned or
+        being fetched."""
+        mac = peer.getMAC()
+        if mac in self.__pins or mac in self.__fetching:
+            return
+
+        self.__fetching.add(mac)
+
+        if len(self.__fetching) > MAX_FETCHES:
+            self.__waiting.append(peer)
+            return
+
+        self.__startFetch(peer)
+
+    def __startFetch(self, peer):
+        self.__engine.connect(
+            peer.getAddress(),
+            peer.getPort(),
+            lambda connection: self.__fetched(peer, connection),
+            lambda ex: self.__fetchFailed(peer, ex),
+            FETCH_TIMEOUT,
+            tls=self.__probeContext,
+            serverName=serverName(peer.getMAC()))
+
+    def __fetched(self, peer, connection):
+        mac = peer.getMAC()
+        certificate = connection.getTls().getpeercert(binary_form=True)
+        connection.close()
+
+        if certificate is not None and mac not in self.__pins:
+            self.__pin(mac, certificate)
+
+        self.__fetchDone(mac)
+
+    def __fetchFailed(self, peer, ex):
+        log.info("Could not fetch the certificate of %s: %s", peer.getName(), ex)
+        self.__fetchDone(peer.getMAC())
+
+    def __fetchDone(self, mac):
+        self.__fetching.discard(mac)
+
+        if self.__waiting:
+            self.__startFetch(self.__waiting.popleft())
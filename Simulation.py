@@ -0,0 +1,722 @@
+# -*- coding: utf-8 *-*
+
+"""
+An in-memory network for testing SkyChat at scale.
+
+Every host on a SimulatedNetwork gets a SimulatedTransport, which is
+given to a Client in place of an Engine. Nothing touches a real socket
+and time is virtual: the network runs its events in order and jumps the
+clock straight to the next one, so a simulated minute of discovery
+takes as long as the work done in it, not a minute.
+
+Everything runs on the thread that calls run(), runFor() or runUntil().
+Every host draws its random delays and IDs from its transport's
+random(), seeded from the network's seed and the host's address, so the
+same seed gives the same run.
+
+Every host keeps a contact for every other host, so the work grows
+with the square of the number of peers. On one core, discovery among
+500 peers takes about 20 seconds and among 1000 peers about 90, for
+half a second of virtual time. That is slower than real time, so
+networks of ten thousand peers are out of reach of one process.
+
+	python Simulation.py --peers 1000 --latency 0.002 --loss 0.01
+
+
+
+Class Name: SimulatedNetwork
+	A broadcast domain and the virtual clock its hosts share.
+
+	Datagrams to '<broadcast>' reach every host with a socket on the
+	port, and datagrams to a multicast group reach every socket on the
+	port that joined it. Each copy is delivered after latency plus a random part of
+	jitter seconds, so jitter reorders datagrams, and is lost with
+	probability loss. Streams are reliable and ordered, and each write
+	arrives after latency seconds.
+
+Data:
+	__now					- Current virtual time in seconds
+	__events				- Heap of Timers waiting to run
+	__hosts					- Every host's transport, keyed by address
+	__random				- Random number generator for jitter and loss
+	__seed					- Seed that every host's random number generator is made from
+	__stats					- Counts of datagrams and stream bytes
+	__groups				- Sockets that joined each multicast group, keyed by (address, port)
+
+Functions:
+
+	__init__				- Constructor
+
+	Input Params:
+		latency				- Seconds for a datagram or a stream write to arrive
+		jitter				- Largest extra random delay of a datagram
+		loss				- Probability that a datagram is lost
+		seed				- Seed for the random number generator
+		multicast			- False makes joining a multicast group fail, as on networks without it
+
+	addHost					- Adds a host and returns its SimulatedTransport.
+							  Addresses are given out as 10.x.y.z unless one is given.
+	getHost					- Returns the transport of the host with the given address
+	time					- Returns the current virtual time
+	callAt					- Runs a function at a virtual time and returns a Timer
+	run						- Runs events until none are left, or until a virtual time
+	runFor					- Runs events for a number of virtual seconds
+	runUntil				- Runs events until a function returns True. Returns False if timeout passes first
+	getStats				- Returns a dictionary of datagram and stream counts
+
+
+
+Class Name: SimulatedTransport
+	The Transport for one host on a SimulatedNetwork. See Transport.py.
+
+	The host argument of listen and openDatagram is ignored; a host has
+	one address. Streams have no limit on bandwidth, so a connection is
+	always writable. Streams carry no TLS, so listen and connect raise
+	NotImplementedError if they are given a TLS context. Exceptions raised
+	by callbacks are not caught, so they stop the run they happen in.
+
+Functions:
+	getAddress				- Returns this host's address
+	stop					- Closes every socket of this host, as if it left the network
+"""
+
+import argparse
+import errno
+import heapq
+import itertools
+import json
+import random
+import shutil
+import tempfile
+import time as wallclock
+import xml.etree.ElementTree as etree
+
+import Transport
+
+
+BROADCAST = ("<broadcast>", "255.255.255.255")
+FIRST_PORT = 49152
+LAST_PORT = 65535
+
+SENDFILE_CHUNK = 256 * 1024
+
+LATENCY = 0.001
+PEERS = 100
+SECONDS = 60.0
+
+
+class Timer:
+
+    __slots__ = ("when", "callback", "args", "cancelled")
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SimulatedNetwork:
+
+    def __init__(self, latency=LATENCY, jitter=0.0, loss=0.0, seed=0,
+        multicast=True):
+        self.__latency = latency
+        self.__jitter = jitter
+        self.__loss = loss
+        self.__multicast = multicast
+        self.__groups = {}
+        self.__random = random.Random(seed)
+        self.__seed = seed
+        self.__now = 0.0
+        self.__events = []
+        self.__sequence = itertools.count()
+        self.__hosts = {}
+        self.__stats = {
+            "datagramsSent": 0,
+            "datagramsDelivered": 0,
+            "datagramsLost": 0,
+            "streamsOpened": 0,
+            "streamBytes": 0}
+
+    def addHost(self, address=None):
+        """Add a host to the network and return its transport."""
+        if address is None:
+            index = len(self.__hosts) + 1
+            address = "10.%d.%d.%d" % (
+                index >> 16 & 255, index >> 8 & 255, index & 255)
+
+        if address in self.__hosts:
+            raise ValueError("address in use: " + address)
+
+        host = SimulatedTransport(self, address,
+            random.Random("%d %s" % (self.__seed, address)))
+        self.__hosts[address] = host
+        return host
+
+    def getHost(self, address):
+        return self.__hosts.get(address)
+
+    def getLatency(self):
+        return self.__latency
+
+    def getStats(self):
+        return dict(self.__stats)
+
+    def time(self):
+        return self.__now
+
+    def callAt(self, when, callback, *args):
+        """Run callback(*args) at virtual time when. Returns a Timer with a
+        cancel() method."""
+        timer = Timer(max(when, self.__now), callback, args)
+        heapq.heappush(self.__events, (timer.when, next(self.__sequence), timer))
+        return timer
+
+    def run(self, until=None):
+        """Run events in order until none are left or the next one is
+        after until. The clock ends at until if it is given."""
+        events = self.__events
+
+        while events and (until is None or events[0][0] <= until):
+            when, sequence, timer = heapq.heappop(events)
+            if timer.cancelled:
+                continue
+
+            self.__now = when
+            timer.callback(*timer.args)
+
+        if until is not None and until > self.__now:
+            self.__now = until
+
+    def runFor(self, seconds):
+        self.run(self.__now + seconds)
+
+    def runUntil(self, condition, timeout=None):
+        """Run events until condition() returns True. Returns False if the
+        events run out, or timeout virtual seconds pass, first."""
+        deadline = None if timeout is None else self.__now + timeout
+        events = self.__events
+
+        while not condition():
+            if not events or (deadline is not None and events[0][0] > deadline):
+                if deadline is not None:
+                    self.__now = max(self.__now, deadline)
+                return False
+
+            when, sequence, timer = heapq.heappop(events)
+            if timer.cancelled:
+                continue
+
+            self.__now = when
+            timer.callback(*timer.args)
+
+        return True
+
+    def _sendDatagram(self, source, data, addr):
+        address, port = addr
+        self.__stats["datagramsSent"] += 1
+
+        if address in BROADCAST:
+            endpoints = [host._getEndpoint(port) for host in self.__hosts.values()]
+        elif (address, port) in self.__groups:
+            endpoints = list(self.__groups[(address, port)])
+        else:
+            host = self.__hosts.get(address)
+            endpoints = () if host is None else (host._getEndpoint(port),)
+
+        for endpoint in endpoints:
+            if endpoint is None:
+                continue
+
+            if self.__loss and self.__random.random() < self.__loss:
+                self.__stats["datagramsLost"] += 1
+                continue
+
+            delay = self.__latency
+            if self.__jitter:
+                delay += self.__random.uniform(0, self.__jitter)
+
+            self.callAt(self.__now + delay, endpoint._receive, data, source)
+
+    def _join(self, endpoint, address):
+        if not self.__multicast:
+            raise OSError(errno.ENODEV, "multicast is not available")
+
+        key = (address, endpoint.getPort())
+        self.__groups.setdefault(key, set()).add(endpoint)
+
+    def _leave(self, endpoint, address):
+        key = (address, endpoint.getPort())
+        members = self.__groups.get(key)
+
+        if members is not None:
+            members.discard(endpoint)
+            if not members:
+                del self.__groups[key]
+
+    def _delivered(self):
+        self.__stats["datagramsDelivered"] += 1
+
+    def _connect(self, client, host, port, onConnected, onFailed, timeout):
+        """Open a stream from the client transport to (host, port). The
+        server accepts after one latency and the client sees the
+        connection after two, like a TCP handshake."""
+        server = self.__hosts.get(host)
+
+        if server is None:
+            if timeout is not None and onFailed is not None:
+                self.callAt(self.__now + timeout, onFailed,
+                    TimeoutError(errno.ETIMEDOUT, "connection timed out"))
+            return
+
+        def accept():
+            listener = server._getListener(port)
+
+            if listener is None:
+                if onFailed is not None:
+                    self.callAt(self.__now + self.__latency, onFailed,
+                        ConnectionRefusedError(errno.ECONNREFUSED,
+                            "connection refused"))
+                return
+
+            self.__stats["streamsOpened"] += 1
+
+            outbound = SimulatedConnection(client, True)
+            inbound = SimulatedConnection(server, False)
+            outbound._open(inbound, (host, port))
+            inbound._open(outbound, (client.getAddress(), client._ephemeralPort()))
+
+            listener._accept(inbound)
+            self.callAt(self.__now + self.__latency, outbound._connected,
+                onConnected)
+
+        self.callAt(self.__now + self.__latency, accept)
+
+    def _streamBytes(self, count):
+        self.__stats["streamBytes"] += count
+
+
+class SimulatedTransport(Transport.Transport):
+
+    def __init__(self, network, address, rng):
+        self.__network = network
+        self.__address = address
+        self.__random = rng
+        self.__endpoints = {}
+        self.__listeners = {}
+        self.__connections = set()
+        self.__nextPort = FIRST_PORT
+
+    def getAddress(self):
+        return self.__address
+
+    def getNetwork(self):
+        return self.__network
+
+    def start(self):
+        pass
+
+    def stop(self):
+        """Close every socket of this host."""
+        for connection in list(self.__connections):
+            connection.close()
+
+        for endpoint in list(self.__endpoints.values()):
+            endpoint.close()
+
+        for listener in list(self.__listeners.values()):
+            listener.close()
+
+    def inEngineThread(self):
+        return True
+
+    def callSoon(self, callback, *args):
+        self.__network.callAt(self.__network.time(), callback, *args)
+
+    def callLater(self, delay, callback, *args):
+        return self.__network.callAt(
+            self.__network.time() + delay, callback, *args)
+
+    def time(self):
+        return self.__network.time()
+
+    def random(self):
+        return self.__random
+
+    def listen(self, port, onConnection, host='', tls=None):
+        if tls is not None:
+            raise NotImplementedError("TLS is not simulated")
+
+        port = self.__bind(self.__listeners, port)
+        listener = SimulatedListener(self, port, onConnection)
+        self.__listeners[port] = listener
+        return listener
+
+    def openDatagram(self, port, onDatagram, host='', reuse=False):
+        port = self.__bind(self.__endpoints, port)
+        endpoint = SimulatedEndpoint(self, port, onDatagram)
+        self.__endpoints[port] = endpoint
+        return endpoint
+
+    def connect(self, host, port, onConnected, onFailed=None, timeout=None, tls=None,
+        serverName=None):
+        if tls is not None:
+            raise NotImplementedError("TLS is not simulated")
+
+        self.__network._connect(self, host, port, onConnected, onFailed, timeout)
+
+    def __bind(self, table, port):
+        if not port:
+            port = self._ephemeralPort(table)
+        elif port in table:
+            raise OSError(errno.EADDRINUSE, "address in use")
+
+        return port
+
+    def _ephemeralPort(self, table=None):
+        for i in range(LAST_PORT - FIRST_PORT + 1):
+            port = self.__nextPort
+            self.__nextPort = port + 1 if port < LAST_PORT else FIRST_PORT
+
+            if table is None or port not in table:
+                return port
+
+        raise OSError(errno.EADDRNOTAVAIL, "no free ports")
+
+    def _getEndpoint(self, port):
+        return self.__endpoints.get(port)
+
+    def _getListener(self, port):
+        return self.__listeners.get(port)
+
+    def _removeEndpoint(self, endpoint):
+        if self.__endpoints.get(endpoint.getPort()) is endpoint:
+            del self.__endpoints[endpoint.getPort()]
+
+    def _removeListener(self, listener):
+        if self.__listeners.get(listener.getPort()) is listener:
+            del self.__listeners[listener.getPort()]
+
+    def _addConnection(self, connection):
+        self.__connections.add(connection)
+
+    def _removeConnection(self, connection):
+        self.__connections.discard(connection)
+
+
+class SimulatedConnection(Transport.Connection):
+
+    __other = None
+    __peerAddress = None
+    __onData = None
+    __onClose = None
+    __closed = False
+    __lost = False
+
+    def __init__(self, transport, outbound):
+        self.__transport = transport
+        self.__network = transport.getNetwork()
+        self.__outbound = outbound
+        self.__pending = []
+        self.__lastArrival = 0.0
+
+    def _open(self, other, peerAddress):
+        self.__other = other
+        self.__peerAddress = peerAddress
+        self.__transport._addConnection(self)
+
+    def _connected(self, onConnected):
+        if not self.__lost:
+            onConnected(self)
+
+    def setHandlers(self, onData, onClose):
+        self.__onData = onData
+        self.__onClose = onClose
+
+        pending, self.__pending = self.__pending, []
+        for data in pending:
+            onData(data)
+
+        if self.__lost:
+            onClose()
+
+    def setWritableHandler(self, onWritable):
+        pass
+
+    def isWritable(self):
+        return True
+
+    def getPeerAddress(self):
+        return self.__peerAddress
+
+    def getTls(self):
+        return None
+
+    def isOutbound(self):
+        return self.__outbound
+
+    def isClosed(self):
+        return self.__closed
+
+    def write(self, data):
+        if self.__closed or not data:
+            return
+
+        self.__network._streamBytes(len(data))
+        self.__network.callAt(self.__arrival(), self.__other._receive, bytes(data))
+
+    def sendfile(self, file, offset, count, onDone):
+        """Send the file a chunk at a time, so memory use does not grow
+        with count."""
+        if count <= 0:
+            self.__network.callAt(self.__network.time(), onDone, None)
+            return
+
+        if self.__closed:
+            self.__network.callAt(self.__network.time(), onDone,
+                ConnectionError("connection is closed"))
+            return
+
+        file.seek(offset)
+        data = file.read(min(count, SENDFILE_CHUNK))
+
+        if not data:
+            self.__network.callAt(self.__network.time(), onDone,
+                EOFError("file is shorter than expected"))
+            return
+
+        self.write(data)
+
+        # Carry on once this chunk has arrived, as a full socket would
+        self.__network.callAt(self.__lastArrival, self.sendfile,
+            file, offset + len(data), count - len(data), onDone)
+
+    def close(self):
+        if self.__closed:
+            return
+
+        self.__closed = True
+        self.__network.callAt(self.__network.time(), self._lose)
+        self.__network.callAt(self.__arrival(), self.__other._lose)
+
+    def __arrival(self):
+        """Returns when the next write arrives. Writes never overtake each
+        other."""
+        self.__lastArrival = max(
+            self.__network.time() + self.__network.getLatency(),
+            self.__lastArrival)
+        return self.__lastArrival
+
+    def _receive(self, data):
+        if self.__closed:
+            return
+
+        if self.__onData is None:
+            self.__pending.append(data)
+        else:
+            self.__onData(data)
+
+    def _lose(self):
+        if self.__lost:
+            return
+
+        if not self.__closed:
+            # The other end closed; anything we write now goes nowhere
+            self.__closed = True
+            self.__network.callAt(self.__arrival(), self.__other._lose)
+
+        self.__lost = True
+        self.__transport._removeConnection(self)
+
+        if self.__onClose is not None:
+            self.__onClose()
+
+
+class SimulatedEndpoint(Transport.DatagramEndpoint):
+
+    __closed = False
+
+    def __init__(self, transport, port, onDatagram):
+        self.__transport = transport
+        self.__network = transport.getNetwork()
+        self.__port = port
+        self.__onDatagram = onDatagram
+        self.__groups = set()
+
+    def getPort(self):
+        return self.__port
+
+    def sendto(self, data, addr):
+        if not self.__closed:
+            self.__network._sendDatagram(
+                (self.__transport.getAddress(), self.__port), bytes(data), addr)
+
+    def joinGroup(self, address):
+        self.__network._join(self, address)
+        self.__groups.add(address)
+
+    def leaveGroup(self, address):
+        self.__network._leave(self, address)
+        self.__groups.discard(address)
+
+    def close(self):
+        self.__closed = True
+        self.__transport._removeEndpoint(self)
+
+        for address in list(self.__groups):
+            self.leaveGroup(address)
+
+    def _receive(self, data, source):
+        if not self.__closed:
+            self.__network._delivered()
+            self.__onDatagram(data, source)
+
+
+class SimulatedListener(Transport.Listener):
+
+    __closed = False
+
+    def __init__(self, transport, port, onConnection):
+        self.__transport = transport
+        self.__port = port
+        self.__onConnection = onConnection
+
+    def getPort(self):
+        return self.__port
+
+    def close(self):
+        self.__closed = True
+        self.__transport._removeListener(self)
+
+    def _accept(self, connection):
+        self.__onConnection(connection)
+
+
+def _startOldClient(network, mac, errors):
+    """Start a host that listens like the clients from before the binary
+    discovery format, which decode every datagram on the discovery port
+    as UTF-8 and parse the contacts and commands in it. Every datagram
+    that one of them could not read is counted in errors[0]."""
+    import Discovery
+    import SkyChat
+
+    host = network.addHost()
+    announce = Discovery.encodeLegacy(Discovery.ANNOUNCE, mac, "old%d" % mac, "Online")
+    known = set()
+
+    def onDatagram(data, addr):
+        try:
+            text = data.decode()
+            if "<Contact" in text:
+                other = int(etree.fromstring(text).get("MAC"))
+
+                # Answer every new contact, as they did
+                if other != mac and other not in known:
+                    known.add(other)
+                    endpoint.sendto(announce, (addr[0], SkyChat.broadcastPort))
+
+            elif "<control" in text:
+                etree.fromstring(text)
+        except (UnicodeDecodeError, etree.ParseError, TypeError, ValueError):
+            errors[0] += 1
+
+    endpoint = host.openDatagram(SkyChat.broadcastPort, onDatagram)
+    endpoint.sendto(announce, ('<broadcast>', SkyChat.broadcastPort))
+
+
+def simulate(peers=PEERS, latency=LATENCY, jitter=0.0, loss=0.0, seed=0,
+    seconds=SECONDS, oldClients=0):
+    """Start peers Clients on a SimulatedNetwork and run it until every
+    client knows every other one, or for seconds virtual seconds. Returns
+    the results as a dictionary. oldClients hosts that listen like clients
+    from before the binary format are started after the clients, and the
+    results count the datagrams they could not read."""
+    import SkyChat
+
+    network = SimulatedNetwork(latency, jitter, loss, seed)
+    dataDir = tempfile.mkdtemp()
+    clients = []
+    errors = [0]
+
+    # Count the peers every client knows, rather than asking the clients
+    # after every event
+    known = [0]
+
+    def found(peer):
+        known[0] += 1
+
+    def lost(peer):
+        known[0] -= 1
+
+    start = wallclock.perf_counter()
+
+    try:
+        for i in range(peers):
+            contact = SkyChat.Contact(name="peer%d" % i, mac=i + 1)
+            clients.append(SkyChat.Client(
+                contact,
+                found,
+                lambda peer: None,
+                lost,
+                engine=network.addHost(),
+                dataDir=dataDir))
+
+        for i in range(oldClients):
+            _startOldClient(network, peers + i + 1, errors)
+
+        discovered = network.runUntil(
+            lambda: known[0] == peers * (peers - 1 + oldClients),
+            seconds)
+
+        results = {
+            "peers": peers,
+            "discovered": discovered,
+            "virtualSeconds": network.time(),
+            "wallSeconds": wallclock.perf_counter() - start,
+            "knownPeers": min(len(c.getPeers()) for c in clients)}
+        results.update(network.getStats())
+
+        for client in clients:
+            client.logout()
+        network.run()
+
+        if oldClients:
+            results["oldClients"] = oldClients
+            results["oldClientErrors"] = errors[0]
+
+        return results
+
+    finally:
+        shutil.rmtree(dataDir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SkyChat network simulation")
+    parser.add_argument("--peers", type=int, default=PEERS,
+        help="number of clients to start")
+    parser.add_argument("--latency", type=float, default=LATENCY,
+        help="seconds for a packet to arrive")
+    parser.add_argument("--jitter", type=float, default=0.0,
+        help="largest extra random delay of a datagram, in seconds")
+    parser.add_argument("--loss", type=float, default=0.0,
+        help="probability that a datagram is lost")
+    parser.add_argument("--seed", type=int, default=0,
+        help="seed for the random number generator")
+    parser.add_argument("--seconds", type=float, default=SECONDS,
+        help="virtual seconds to run for at most")
+    parser.add_argument("--old-clients", type=int, default=0,
+        help="hosts that listen like clients from before the binary format")
+
+    args = parser.parse_args(argv)
+
+    results = simulate(args.peers, args.latency, args.jitter, args.loss,
+        args.seed, args.seconds, args.old_clients)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
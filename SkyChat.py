@@ -4,16 +4,47 @@
 Class Name: Client
 	This class handles finding, and connecting to,
 	all other chat clients on the network.
+
+	All sockets are served by a single Transport: an Engine event loop
+	on a real network, or a SimulatedTransport in tests, so no thread is
+	created per contact. The callbacks given to the constructor are
+	called on the engine thread.
 	
 Data:
-	__peers 				- Keeps track of all peers currently on the network.
+	__peers 				- Registry of all peers currently on the network, indexed by MAC, address and peer ID.
 	__myInfo				- The current user's information to be sent to other clients
-	__broadcastPort			- Port that all broadcast messages will be sent and received on
-	__messagePort			- Port that all connections with other clients will be established on
+	__engine				- Transport that serves every socket used by this client
+	__dataDir				- Directory that conversation logs are saved in
+	__alertSocket			- The one UDP socket used to send and receive discovery packets
+	__discovery				- DiscoveryScheduler that sends every discovery packet
+	__presence				- FailureDetector that expires peers that stop sending heartbeats
+	__metrics				- ClientMetrics updated by this client and its peers
+	__metricsServer			- MetricsServer on the metrics port, or None
+	__connections			- ConnectionManager that opens and accepts peer connections
+	__groups				- GroupManager that runs this client's group conversations
+	__groupSocket			- UDP socket for group multicast, or None if it could not be opened
+	__transfers				- TransferManager that sends and receives files
+	__store					- MessageStore that keeps messages for peers that cannot be reached
+	__tls					- Security.Tls that peer connections are secured with, or None
+	__prober				- PeerCache.Prober that checks the peers read from the peer cache
+	__directory				- Directory.DirectoryClient that keeps this client in a directory, or None
+	__hub					- Hub.HubLink that peer connections run over, or None to connect to peers directly
+	__listed				- MACs of the peers the directory lists
 	__newPeer				- Callback function to be used when a new peer has been found
 	
 Accessor Functions:
 	getPeers				- Returns the list of known peers
+	getPeer					- Returns the peer with the given peer ID
+	findPeer				- Returns the peer with the given MAC
+	getGroups				- Returns the list of groups this client is in
+	getGroup				- Returns the group with the given ID
+	getTransfers			- Returns the file transfers that have not finished
+	getMetrics				- Returns the metrics Registry. Its snapshot() and export() are
+							  only consistent when called from the engine thread.
+	
+Mutator Functions:
+	setStatus				- Changes this user's status and broadcasts it
+	createGroup				- Creates a group conversation with the given peers and invites them
 	
 Functions:
 	
@@ -22,62 +53,108 @@ Functions:
 	Input Params:
 		contactInfo			- Information about this client's user
 		newPeer				- Function to be called when a new peer is found on the network
+		newConversation		- Function to be called when a peer opens a connection to this client
+		deletePeer			- Function to be called with the peer when a peer logs out, or
+							  stops sending heartbeats
+		engine				- Transport to run on. Default is a new Engine owned by this client
+		dataDir				- Directory to save data in. Default is dataDirectory
+		updatePeer			- Function to be called when a known peer changes its name or status
+		connectTimeout		- Seconds to wait for a connection to a peer to open
+		newMessage			- Function to be called with (peer, message) for every message received
+		alertPort			- UDP port for discovery packets. Default is broadcastPort
+		connectionPort		- TCP port for connections from peers. Default is messagePort. 0 picks a free port
+		discoveryTargets	- (address, port) pairs that announcements are sent to.
+							  Default is the broadcast address on alertPort
+		newGroup			- Function to be called with the Group when this client is invited to one
+		groupPort			- UDP port for group multicast. Default is multicastPort
+		newTransfer			- Function to be called with the FileTransfer when a peer offers a file.
+							  Offers are declined if it is None.
+		metrics				- Metrics.Registry to count in. Default is none, unless metricsPort is set
+		metricsPort			- Local TCP port to serve the metrics on in the Prometheus text format.
+							  Default is not to serve them. 0 picks a free port
+		directory			- (host, port) of a Directory.DirectoryServer to register with and
+							  find peers in, as well as on the LAN. Default is the LAN alone
+		tls					- True to run peer connections over TLS, with certificates pinned to
+							  the peers' MACs. Every client on the network must use the same
+							  setting. Needs openssl the first time. See Security.py.
+		hub					- (host, port) of a Hub.Hub to reach peers through, over one connection,
+							  instead of connecting to each of them. Every client on the network
+							  must use the same setting. Cannot be used with tls.
 		
 	Output Params: 			- None
 	
-	Save contactInfo and newPeer
+	Save contactInfo and the callbacks
 	
-	Create a thread to listen for TCP connection requests
+	Listen for TCP connection requests on the engine
 	
-	Create a thread to listen for UDP broadcasts
+	Listen for UDP broadcasts on the engine
 	
-	Send UDP broadcast to let other clients know about this one.
+	Add the peers saved in the peer cache at the last logout, as
+	unverified, and probe each of them
 	
+	Send UDP broadcast to let other clients know about this one,
+	after a short random delay.
+
+	Messages to a peer that cannot be reached are kept in a MessageStore
+	under the data directory. When the peer is heard from again, they are
+	sent to it in one write over one connection. They survive a restart.
+
+	Start sending heartbeats, and expiring peers that stop sending them.
 	
 	
 	
-	__connectionListener	- Listens on __messagePort for new connection requests
 	
-	Input Params:			- None
-	Output Params:			- None
+	__connectionListener	- Called by the engine for every accepted connection
 	
-	Create a TCP socket and bind it to the port number in __messagePort
+	Input Params:
+		connection			- The new Connection
+	Output Params:			- None
 	
-	while true:
-		wait for a connection request and accept it
+	hand the connection to the connection manager, which gives it to
+	the contact named in its hello, or to the transfer manager if it
+	carries a file
+		
 		
-		add the new connection to the matching contact in __peers
+	__controlListener		- Called by a contact for every control frame it receives
+	
+	give group packets to the group manager and file packets to the
+	transfer manager
 		
 		
-	__alertBroadcast		- Sends a UDP message to the given address to let them know about this client
+	__alertListener			- Called by the engine for every UDP notification
 	
 	Input Params:
-		addr				- Address to send the message to. Default is the special '<broadcast>' address
+		data				- The received datagram
+		addr				- Address the datagram was sent from
 	Output Params:			- None
 	
-	Create a new UDP socket
-	
-	Send contact information for this client on the UDP socket.
-	
-	
-	
-	__alertListener			- Listens for UDP notifications of new clients
+	decode the discovery packet in data
 	
-	Input Params:			- None
-	Output Params:			- None
-	
-	Create a UDP socket bound to __broadcastPort
-	
-	while true:
-		listen for data on the port
+	if data is not from this client:
+		if the packet is a logout:
+			remove the contact from __peers
+			call the __deletePeer callback function
+		
+		else if the packet lists several peers:
+			add or update each of them
 		
-		when data is received parse the contact information from it
+		else if data is from a new contact:
+			give the new contact its conversation history
+			add new contact to __peers
+			call the __newPeer callback function
+			if the packet is not a reply:
+				queue a reply on the discovery scheduler
 		
-		if data is not from this client:
-			if data is from a new contact:
-				add new contact to the __peers list
-				send contact information back to the new contact
-				call the __newPeer callback function
+		else:
+			update the contact's address, name and status
+
+		push back the deadline of the sender, unless it is an old client
+
+
+	__expirePeer			- Called by the failure detector with the MAC of a silent peer
+
+	remove the contact from __peers
+	call the __deletePeer callback function
 				
 				
 				
@@ -86,21 +163,72 @@ Class Name: Contact
 	This class represents a peer client on the network
 	
 Data:
-	__messagePort			- Port that all connections with other clients will be established on
-	__connection			- Socket that all communications will be made through
-	__thrListen				- Thread that will be used to listen for incoming messages
+	__manager				- ConnectionManager that opens this contact's connection
+	__connection			- Connection that all communications will be made through
+	__outbox				- Messages waiting for the connection to be established
+	__store					- MessageStore that messages are kept in while this contact cannot be reached
+	__history				- Recent messages from this contact, backed by a log on disk
+	__conversation			- Sync.Conversation with the sequence numbers of this conversation
+	__sentUpTo				- Number of the last message sent on this connection, or None until
+							  the peer's sync request says where to start
+	__ackSent				- Number of the last message acknowledged on this connection
 	__msgCallback			- Callback function that will be used when a new message is received from this contact
 	__status				- This contact's current status
 	__name					- Display name for this contact
+	__metrics				- ClientMetrics that messages and bytes are counted in
+	__verified				- False for a contact read from the peer cache that has not been heard from yet
+	__lastSeen				- Time this contact was last heard from, in seconds since the epoch
+	__alertAddress			- (address, port) its last discovery packet came from, or None
+	__writableListener		- Function called with (contact, writable) when the connection stops or
+							  starts taking messages, or None
 	
 Mutator Functions:
-	setMessageCallback		- Sets the callback function to be used when a new message is received
-	setConnection			- Sets the socket to listen for new connections on and starts a thread to listen to it
+	setMessageCallback		- Sets the function called with (message, position) when a new message
+							  is received. If replay is given, it is first called with the last
+							  page of the history as a list of (position, message) pairs. This
+							  happens on the engine thread, so no message is missed or given twice.
+	setMessageListener		- Sets a function called with (contact, message) for every message received
+	setControlListener		- Sets a function called with (contact, payload) for every control frame received
+	setWritableListener		- Sets a function called with (contact, False) when the connection is
+							  too far behind to take more messages, and (contact, True) when it
+							  has caught up
+	setConnection			- Sets the connection to listen to for new messages
+	setConnectionManager	- Sets the ConnectionManager used to open new connections
+	setHistory				- Sets the History that received messages are saved to
+	setConversation			- Sets the Sync.Conversation that sent messages are numbered and saved in
+	setTransferManager		- Sets the TransferManager used to send files
+	setMetrics				- Sets the ClientMetrics that messages and bytes are counted in
+	setMessageStore			- Sets the MessageStore that messages are kept in while this contact
+							  cannot be reached
+	setName					- Sets the display name
+	setStatus				- Sets this contact's current status
+	setPort					- Sets the port this contact accepts connections on
+	setVerified				- Sets whether this contact has been heard from since the client started
+	setLastSeen				- Sets the time this contact was last heard from
+	setAlertAddress			- Sets the (address, port) its discovery packets come from
 	
 Accessor Functions:
 	getName					- Returns the display name
 	getStatus				- Returns this contact's current status
-	getData					- Returns an xml representation of this contact
+	getData					- Returns an xml representation of this contact, for old clients
+	getPacket				- Returns the binary discovery packet for this contact.
+							  Packets are cached until the name, status or port changes.
+	getHistory				- Returns this contact's History
+	getConversation			- Returns this contact's Sync.Conversation
+	readHistory				- Returns up to count (position, message) pairs from before a position
+	getConnection			- Returns the open connection, or None
+	hasOutbox				- Returns True if messages are waiting for a connection
+	hasUnacked				- Returns True if sent messages have not been acknowledged by the peer
+	getOutboxSize			- Returns the number of messages waiting for a connection
+	isConnected				- Returns True if a connection is open
+	isSynced				- Returns True once the peer has said how far it has read on the
+							  open connection
+	isWritable				- Returns False while the connection is too far behind to take more
+							  messages. Messages sent meanwhile wait in the outbox.
+	isVerified				- Returns False if this contact came from the peer cache and has not
+							  been heard from yet
+	getLastSeen				- Returns the time this contact was last heard from
+	getAlertAddress			- Returns the (address, port) its discovery packets come from, or None
 	
 Functions:
 
@@ -116,30 +244,66 @@ Functions:
 	
 	
 	
-	sendMessage				- Sends a message to this client
+	sendControl				- Sends a control frame to this client. Does not block.
+	
+	sendFile				- Offers a file to this client and returns its FileTransfer. Does not block.
+							  Raises OSError if the file cannot be read.
+	
+	forward					- Sends messages that were kept in the message store, in one write
+							  once connected. Must be called from the engine thread.
+	
+	dropOutbox				- Gives up on the messages waiting for a connection. Chat messages
+							  are moved to the message store, if there is one, and the rest are
+							  dropped. Must be called from the engine thread.
+	
+	sendMessage				- Sends a message to this client. Does not block.
 	
 	Input Params:
 		message				- The message to be sent
 		
+	number the message, save it to the sent log and queue it
+	
 	If a connection has not been established:
-		create a new connection
-		call setConnection with the new connection
+		ask the connection manager to open a new connection
+		the manager calls setConnection once the connection is open,
+		which sends a sync request
+		the peer's sync request says where to start sending
 		
-	send message on TCP connection
+	send queued messages on TCP connection as length-prefixed frames,
+	while fewer than Sync.WINDOW are unacknowledged and the connection
+	is writable. Once it is writable again the rest are sent. A peer
+	that stops reading altogether is disconnected by the engine, and
+	the unacknowledged messages are sent again on a new connection.
 	
 	
 	
 	
-	__listen				- Listens for new messages on a TCP connection
+	__onData				- Called by the engine when data arrives on the connection
+	
+	decode every complete frame in the data
+	
+	for each message:
+		if it is a control frame:
+			call the control listener with it
+		else:
+			add the message to the history
+			call messageCallback with the received message
+	
+	
+	
+	__onClose				- Called by the engine when the connection closes
+	
+	if messages have not been acknowledged:
+		reconnect to send them again, keeping the message callback
+	else:
+		call messageCallback with '<close />'
 	
-	while true:
-		Listen for a message and get it when available
-		
-		if message is empty:
-			close the connection
-			return
-			
-		call messageCallback with the received message
+	
+	
+	closeConnection			- Closes the connection. The message callback is kept.
+	
+	detach					- Stops calling the message callback. Called when the window showing
+							  the conversation closes.
 	
 """
 
@@ -147,160 +311,584 @@ __author__ = "Benjamin Force"
 __email__ = "benforce@gmail.com"
 __version__ = 1.0
 
-import threading
+import collections
+import os
 import socket
+import time
 import xml.etree.ElementTree as etree
 from uuid import getnode
-import select
 import sys
+import Directory
+import Discovery
+import Engine
+import Connections
+import Framing
+import Groups
+import History
+import Hub
+import Metrics
+import MessageStore
+import PeerCache
+import Transfers
+import PeerRegistry
+import Presence
+import Security
+import Sync
+import logging
 
 
 broadcastPort = 8497
 messagePort = 42111
+multicastPort = 8499
+PEER_CACHE = "peers.cache"
+dataDirectory = os.path.join(os.path.expanduser("~"), ".skychat")
+
+log = logging.getLogger("SkyChat")
+
+# Also send discovery packets in the XML format used by old clients.
+# Turned on automatically once an old client is seen on the network.
+legacyDiscovery = False
 
 
 class Client:
 
-    __peers = []
     __myInfo = None
     __newPeer = None
     __deletePeer = None
+    __updatePeer = None
+    __newMessage = None
     __online = True
+    __metricsServer = None
+    __tls = None
+    __directory = None
+    __hub = None
+
+    def __init__(self, contactInfo, newPeer, newConversation, deletePeer,
+        engine=None, dataDir=None, updatePeer=None,
+        connectTimeout=Connections.CONNECT_TIMEOUT, newMessage=None,
+        alertPort=None, connectionPort=None, discoveryTargets=None,
+        newGroup=None, groupPort=None, newTransfer=None, metrics=None,
+        metricsPort=None, tls=False, directory=None, hub=None):
 
-    def __init__(self, contactInfo, newPeer, newConversation, deletePeer):
+        if tls and hub is not None:
+            raise ValueError("TLS cannot be used through a hub")
 
         self.__myInfo = contactInfo
         self.__newPeer = newPeer
         self.__newConversation = newConversation
         self.__deletePeer = deletePeer
+        self.__updatePeer = updatePeer
+        self.__newMessage = newMessage
+        self.__peers = PeerRegistry.PeerRegistry()
 
-        # Start TCP connection listener thread
-        self.__connectionThread = \
-        threading.Thread(target=self.__connectionListener)
+        if dataDir is None:
+            dataDir = dataDirectory
 
-        self.__connectionThread.start()
+        self.__dataDir = os.path.join(dataDir, str(contactInfo.getMAC()))
 
-        # Start UDP listener thread
-        self.__listenThread = threading.Thread(target=self.__alertListener)
-        self.__listenThread.start()
+        # Read before anything starts, so the friends list fills at once
+        cached = PeerCache.load(os.path.join(self.__dataDir, PEER_CACHE))
+
+        if alertPort is None:
+            alertPort = broadcastPort
+
+        if connectionPort is None:
+            connectionPort = messagePort
+
+        if discoveryTargets is None:
+            discoveryTargets = [('<broadcast>', alertPort)]
+
+        if groupPort is None:
+            groupPort = multicastPort
+
+        self.__ownsEngine = engine is None
+        if self.__ownsEngine:
+            engine = Engine.Engine()
+
+        self.__engine = engine
+        self.__engine.start()
+
+        if metrics is None and metricsPort is not None:
+            metrics = Metrics.Registry()
+
+        if metrics is None:
+            self.__metrics = Metrics.DISABLED
+        else:
+            self.__metrics = Metrics.ClientMetrics(metrics)
+            self.__addGauges(metrics)
+
+        self.__store = MessageStore.MessageStore(
+            os.path.join(self.__dataDir, "outbox"))
+
+        if tls:
+            self.__tls = Security.Tls(
+                self.__engine,
+                os.path.join(self.__dataDir, "tls"),
+                self.__myInfo.getMAC())
+
+        # Peers opening streams through the hub look like accepted
+        # connections
+        if hub is not None:
+            self.__hub = Hub.HubLink(
+                self.__engine,
+                hub,
+                self.__myInfo,
+                self.__connectionListener)
+
+        self.__connections = Connections.ConnectionManager(
+            self.__engine,
+            self.__myInfo,
+            self.__peers,
+            self.__newConversation,
+            connectTimeout,
+            metrics=self.__metrics,
+            tls=self.__tls,
+            hub=self.__hub)
+
+        # Listen for TCP connection requests
+        self.__connectionServer = self.__engine.listen(
+            connectionPort,
+            self.__connectionListener,
+            tls=self.__tls.getServerContext() if self.__tls is not None else None)
+
+        # Announce the port that was actually bound, in case it was 0
+        self.__myInfo.setPort(self.__connectionServer.getPort())
+
+        # Listen for UDP broadcasts
+        try:
+            self.__alertSocket = self.__engine.openDatagram(
+                alertPort,
+                self.__alertListener)
+        except socket.error:
+            log.error("Only one client per system allowed!")
+            sys.exit()
+
+        # All discovery packets are sent on the listening socket
+        self.__discovery = Discovery.DiscoveryScheduler(
+            self.__engine,
+            self.__alertSocket,
+            self.__myInfo,
+            self.__peers,
+            discoveryTargets,
+            legacyDiscovery,
+            self.__metrics)
+
+        self.__transfers = Transfers.TransferManager(
+            self.__engine,
+            self.__myInfo,
+            newTransfer,
+            connectTimeout,
+            self.__tls,
+            self.__hub)
+        self.__connections.setFileHandler(self.__transfers.onConnection)
+
+        self.__groups = Groups.GroupManager(
+            self.__engine,
+            self.__myInfo,
+            self.__peers,
+            groupPort,
+            self.__dataDir,
+            newGroup)
+
+        # Every client on this system shares the group port, so groups
+        # fall back to relaying if it cannot be bound
+        try:
+            self.__groupSocket = self.__engine.openDatagram(
+                groupPort,
+                self.__groups.onDatagram,
+                reuse=True)
+            self.__groups.setEndpoint(self.__groupSocket)
+        except socket.error as ex:
+            log.info("Group multicast is not available: %s", ex)
+            self.__groupSocket = None
+
+        # Expire peers that crash or leave without logging out
+        self.__presence = Presence.FailureDetector(
+            self.__engine,
+            self.__expirePeer)
+
+        # Check the cached peers with probes instead of waiting for the
+        # segment to answer the announcement
+        self.__prober = PeerCache.Prober(
+            self.__engine,
+            self.__probe,
+            self.__expireCached)
+        self.__engine.callSoon(self.__warmStart, cached, alertPort)
+
+        # Peers the LAN cannot reach are found through the directory
+        self.__listed = set()
+        if directory is not None:
+            self.__directory = Directory.DirectoryClient(
+                self.__engine,
+                directory,
+                self.__myInfo,
+                self.__foundInDirectory,
+                self.__lostFromDirectory)
+            self.__engine.callSoon(self.__directory.start)
+
+        if self.__hub is not None:
+            self.__engine.callSoon(self.__hub.start)
 
         # Send UDP broadcast lettting other clients know that the
         # user has connected
-        self.__alertBroadcast()
+        self.__engine.callSoon(self.__discovery.start)
+        self.__engine.callSoon(self.__presence.start)
+
+        if metricsPort is not None:
+            self.__metricsServer = Metrics.MetricsServer(
+                self.__engine,
+                metrics,
+                metricsPort)
+            log.info("Serving metrics on port %d", self.__metricsServer.getPort())
 
     def getPeers(self):
         """Gets a list of all connected peers."""
-        return self.__peers
+        return list(self.__peers)
+
+    def getPeer(self, peerId):
+        """Gets a peer by the peer ID it was given when discovered."""
+        return self.__peers.getById(peerId)
+
+    def findPeer(self, mac):
+        """Gets a peer by MAC."""
+        return self.__peers.getByMAC(mac)
+
+    def getEngine(self):
+        return self.__engine
+
+    def getGroups(self):
+        return self.__groups.getGroups()
+
+    def getGroup(self, groupId):
+        return self.__groups.getGroup(groupId)
+
+    def getTransfers(self):
+        return self.__transfers.getTransfers()
+
+    def getMetrics(self):
+        return self.__metrics.getRegistry()
+
+    def __addGauges(self, metrics):
+        metrics.gauge("peers", "Known peers", lambda: len(self.__peers))
+        metrics.gauge("connections_active", "Open peer connections",
+            lambda: sum(1 for peer in self.__peers if peer.isConnected()))
+        metrics.gauge("outbox_messages", "Messages waiting for a connection",
+            lambda: sum(peer.getOutboxSize() for peer in self.__peers))
+        metrics.gauge("transfers_active", "File transfers that have not finished",
+            lambda: len(self.__transfers.getTransfers()))
+
+    def createGroup(self, name, peers):
+        """Create a group conversation with peers and invite them."""
+        return self.__groups.createGroup(name, peers)
+
+    def setStatus(self, status):
+        """Change this user's status and let everyone know."""
+        self.__myInfo.setStatus(status)
+        self.__discovery.send(Discovery.STATUS)
+
+        if self.__directory is not None:
+            self.__directory.update()
 
     def logout(self):
         """Send an alert to let everyone know that this client is offline."""
 
-        print("Sending logout message.")
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
-
-        sock.sendto(self.__logoutCommand(),
-        ('<broadcast>', broadcastPort))
+        log.info("Sending logout message.")
+        self.__discovery.send(Discovery.LOGOUT)
 
         self.__online = False
 
-    def __logoutCommand(self):
-        """Returns a string that will be broadcast to let other clients
-        know that this user is now offline."""
-        return str('<control sender="' +
-            str(self.__myInfo.getMAC()) +
-            '" command="logout" />').encode()
+        self.__engine.callSoon(self.__discovery.stop)
+        self.__engine.callSoon(self.__presence.stop)
+        self.__engine.callSoon(self.__prober.stop)
+        self.__engine.callSoon(self.__saveCache)
 
-    def __connectionListener(self):
-        """Listens on the protocol port for connection requests."""
-        self.__connectionSocket = socket.socket(socket.AF_INET,
-        socket.SOCK_STREAM)
+        if self.__directory is not None:
+            self.__engine.callSoon(self.__directory.stop)
 
-        self.__connectionSocket.setsockopt(socket.SOL_SOCKET,
-        socket.SO_REUSEADDR, True)
+        if self.__hub is not None:
+            self.__engine.callSoon(self.__hub.stop)
 
-        self.__connectionSocket.bind(('', messagePort))
-        self.__connectionSocket.listen(5)
+        self.__connectionServer.close()
+        self.__alertSocket.close()
 
-        while self.__online:
-            newSock, (addr, port) = self.__connectionSocket.accept()
+        if self.__metricsServer is not None:
+            self.__metricsServer.close()
 
-            print("New connection from", addr)
+        if self.__groupSocket is not None:
+            self.__groupSocket.close()
 
-            # Find the contact that sent the request and give it the
-            # connection
-            for p in self.__peers:
+        if self.__ownsEngine:
+            self.__engine.stop()
 
-                if(p.getAddress() == addr):
-                    self.__newConversation(p)
-                    p.setConnection(newSock)
+    def __connectionListener(self, connection):
+        """Called by the engine for every accepted connection request."""
+        addr = connection.getPeerAddress()[0]
 
-    def __alertBroadcast(self, addr='<broadcast>'):
-        """Send an alert to let everyone know that this client is online."""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        log.debug("New connection from %s", addr)
 
-        sock.sendto(self.__myInfo.getData(),
-        (addr, broadcastPort))
+        # The contact that sent the request is found from its hello
+        self.__connections.accept(connection)
 
-    def __alertListener(self):
-        """Listen for UDP broadcasts."""
+    def __controlListener(self, contact, payload):
+        """Called by a contact for every control frame it receives."""
+        if payload.startswith(Groups.GROUP):
+            self.__groups.onControl(contact, payload)
 
-        # Setup the socket to listen for connections.
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        elif payload.startswith(Transfers.FILE):
+            self.__transfers.onControl(contact, payload)
 
-        try:
-            sock.bind(('', broadcastPort))
-        except socket.error:
-            print("Only one client per system allowed!")
-            sys.exit()
+    def __alertListener(self, data, addr):
+        """Called by the engine for every UDP broadcast received."""
+
+        if not self.__online:
+            return
+
+        source = addr
+        addr = addr[0]
+
+        metrics = self.__metrics
+        metrics.discoveryReceived.inc()
+
+        if metrics.isEnabled():
+            started = Metrics.clock()
+            packet = Discovery.decodePacket(data, messagePort)
+            metrics.discoveryParse.observe(Metrics.clock() - started)
+        else:
+            packet = Discovery.decodePacket(data, messagePort)
+
+        if packet is None:
+            metrics.discoveryInvalid.inc()
+            return
+
+        # Ignore this instance's own broadcasts
+        if packet.mac == self.__myInfo.getMAC():
+            return
 
-        while self.__online:
-            newContact, (addr, port) = sock.recvfrom(1024)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("New broadcast received: %s", packet)
 
-            print("New broadcast received:", newContact.decode())
-            if "<Contact" in newContact.decode():
-                newContact = ParseContact(newContact)
-                newContact.setAddress(addr)
+        # Once an old client is seen, also talk to the segment in XML
+        if packet.legacy:
+            self.__discovery.setLegacy(True)
 
-                # Ignore this instance's own broadcast
-                if(newContact.getMAC() != self.__myInfo.getMAC()):
+        self.__discovery.heard(packet)
 
-                    # Make sure this is a new contact
-                    isNewContact = True
-                    for p in self.__peers:
-                        if(p.getMAC() == newContact.getMAC()):
-                            isNewContact = False
-                            break
+        if packet.kind == Discovery.LOGOUT:
+            log.info("Contact logging off: %s", packet.mac)
+            self.__removePeer(packet.mac)
+            return
 
-                    if(isNewContact is True):
-                        self.__peers.append(newContact)
+        # Old clients never send heartbeats, so they are never expired
+        if not packet.legacy:
+            self.__presence.heard(packet.mac, packet.interval)
 
-                        # Send our contact info back
-                        self.__alertBroadcast(newContact.getAddress())
+        if packet.kind == Discovery.PEERS:
+            for record in packet.peers:
+                if record.mac != self.__myInfo.getMAC():
+                    self.__foundPeer(record, record.address or addr)
 
-                        # Use the callback to handle the new contact
-                        self.__newPeer(newContact)
+        else:
+            isNew = self.__foundPeer(packet, addr)
+
+            # A peer checking its cached list is answered right away.
+            # Otherwise send our contact info back, unless this already
+            # was a reply.
+            if packet.kind == Discovery.PROBE:
+                self.__discovery.send(Discovery.REPLY, source, False)
+            elif isNew and packet.kind != Discovery.REPLY:
+                self.__discovery.replyTo(source, packet.legacy)
+
+            # The peer is back: send what was kept while it was away. A
+            # peer that has just announced itself may not know this client
+            # yet and would turn the connection away, so wait for its
+            # reply or its next heartbeat.
+            if packet.kind != Discovery.ANNOUNCE:
+                self.__forward(packet.mac)
+
+        self.__heardFrom(packet, source)
+
+    def __heardFrom(self, packet, source):
+        """Note that the sender of packet is there, which verifies it if
+        it came from the peer cache."""
+        peer = self.__peers.getByMAC(packet.mac)
+        if peer is None:
+            return
 
-            elif "<control" in newContact.decode():
+        peer.setLastSeen(time.time())
+
+        # Old clients send from a throwaway socket
+        if source is not None and not packet.legacy:
+            peer.setAlertAddress(source)
+
+        if not peer.isVerified():
+            log.info("Cached contact is back: %s", peer.getName())
+            peer.setVerified(True)
+            self.__prober.remove(packet.mac)
+
+            if self.__updatePeer is not None:
+                self.__updatePeer(peer)
+
+    def __warmStart(self, cached, alertPort):
+        """Add the peers read from the peer cache, as unverified, and
+        start probing them."""
+        for record in cached:
+            if record.mac == self.__myInfo.getMAC() or record.mac in self.__peers:
+                continue
+
+            peer = self.__addPeer(
+                record.mac, record.name, record.status, record.port, record.address)
+            peer.setVerified(False)
+            peer.setLastSeen(record.lastSeen)
+            peer.setAlertAddress((record.address, record.alertPort or alertPort))
+
+            self.__prober.add(record.mac)
+            self.__newPeer(peer)
+
+        if cached:
+            log.info("Read %d contacts from the peer cache", len(cached))
+
+    def __probe(self, mac):
+        peer = self.__peers.getByMAC(mac)
+        if peer is not None:
+            self.__discovery.send(Discovery.PROBE, peer.getAlertAddress(), False)
+
+    def __expireCached(self, mac):
+        """Called by the prober for a cached peer that never answered."""
+        peer = self.__peers.getByMAC(mac)
+        if peer is not None and not peer.isVerified():
+            log.info("Cached contact did not answer: %s", peer.getName())
+            self.__removePeer(mac)
+
+    def __saveCache(self):
+        PeerCache.save(os.path.join(self.__dataDir, PEER_CACHE), self.__peers)
+
+    def __forward(self, mac):
+        peer = self.__peers.getByMAC(mac)
+        if peer is None:
+            return
 
-                index = -1
-                root = etree.fromstring(newContact.decode())
-                mac = int(root.get("sender"))
-                print("Contact logging off:", str(mac))
-                for pIndex in range(0, len(self.__peers)):
-                    if mac == self.__peers[pIndex].getMAC():
-                        print("Found contact")
-                        index = pIndex
-                        break
+        # Messages already on their way are given back if they fail again
+        if self.__store.has(mac) and not peer.hasOutbox():
+            messages = self.__store.take(mac)
+            log.info("Forwarding %d stored messages to %s", len(messages), peer.getName())
+            peer.forward(messages)
+
+        # Messages the peer never acknowledged are resent once connected
+        elif peer.hasUnacked() and not peer.isConnected():
+            self.__connections.connect(peer)
+
+    def __foundInDirectory(self, packet):
+        """Called by the directory client for every peer it lists."""
+        self.__listed.add(packet.mac)
+
+        # The directory says when it leaves, so it is not expired
+        self.__foundPeer(packet, packet.address, expire=False)
+        self.__heardFrom(packet, None)
+        self.__forward(packet.mac)
+
+    def __lostFromDirectory(self, mac):
+        self.__listed.discard(mac)
+
+        # Peers still heard on the LAN stay
+        if mac in self.__peers and not self.__presence.isTracking(mac):
+            log.info("Contact left the directory: %s", mac)
+            self.__removePeer(mac)
+
+    def __expirePeer(self, mac):
+        """Called by the failure detector for a peer that stopped sending
+        heartbeats."""
+        # The directory still lists it, though the LAN lost it
+        if mac in self.__listed:
+            return
 
-                if index == -1:
-                    return
+        log.info("Contact timed out: %s", mac)
+        self.__metrics.expiredPeers.inc()
+        self.__removePeer(mac)
 
-                self.__peers.pop(index)
-                self.__deletePeer(index)
+    def __removePeer(self, mac):
+        self.__presence.forget(mac)
+        self.__prober.remove(mac)
+        self.__listed.discard(mac)
+
+        peer = self.__peers.removeByMAC(mac)
+        if peer is None:
+            return
+
+        peer.dropOutbox()
+        peer.closeConnection()
+        peer.getHistory().close()
+        peer.getConversation().close()
+        self.__deletePeer(peer)
+
+    def __addPeer(self, mac, name, status, port, addr):
+        """Add a new contact to the registry and return it."""
+        newContact = Contact(
+            name=name,
+            status=status,
+            mac=mac)
+
+        newContact.setPort(port)
+        newContact.setAddress(addr)
+        newContact.setConnectionManager(self.__connections)
+        newContact.setMessageListener(self.__newMessage)
+        newContact.setControlListener(self.__controlListener)
+        newContact.setTransferManager(self.__transfers)
+        newContact.setMetrics(self.__metrics)
+        newContact.setMessageStore(self.__store)
+        newContact.setConversation(Sync.Conversation(os.path.join(
+            self.__dataDir,
+            "sync",
+            str(mac))))
+        newContact.setHistory(History.History(os.path.join(
+            self.__dataDir,
+            "history",
+            str(mac) + ".log")))
+        self.__peers.add(newContact)
+
+        return newContact
+
+    def __foundPeer(self, packet, addr, expire=True):
+        """Add or update the peer described by a discovery packet. Returns
+        True if the peer is new. A new peer is expired if it is not heard
+        from, unless expire is False."""
+        peer = self.__peers.getByMAC(packet.mac)
+
+        # Make sure this is a new contact
+        if peer is None:
+            newContact = self.__addPeer(
+                packet.mac, packet.name, packet.status, packet.port, addr)
+
+            # Peers only listed by others are expired unless they are
+            # heard from themselves
+            if expire and not packet.legacy:
+                self.__presence.heard(packet.mac)
+
+            # Get its certificate before either end connects
+            if self.__tls is not None:
+                self.__tls.fetch(newContact)
+
+            # Use the callback to handle the new contact
+            self.__newPeer(newContact)
+            return True
+
+        # A known contact may have moved or changed its name or status
+        if peer.getAddress() != addr:
+            peer.setAddress(addr)
+
+        peer.setPort(packet.port)
+
+        # Try again if its certificate could not be fetched
+        if self.__tls is not None:
+            self.__tls.fetch(peer)
+
+        if peer.getName() != packet.name or peer.getStatus() != packet.status:
+            peer.setName(packet.name)
+            peer.setStatus(packet.status)
+
+            if self.__updatePeer is not None:
+                self.__updatePeer(peer)
+
+        return False
 
 
 def ParseContact(data):
@@ -311,51 +899,241 @@ def ParseContact(data):
 
 class Contact:
 
-    __mac = None
-    __connection = None
-    __thrListen = None
-    __msgCallback = None
-    __status = "Offline"
-    __name = "Unknown"
-    __history = []
-    __address = None
+    __slots__ = (
+        "__mac",
+        "__id",
+        "__manager",
+        "__connection",
+        "__decoder",
+        "__outbox",
+        "__store",
+        "__history",
+        "__conversation",
+        "__sentUpTo",
+        "__ackSent",
+        "__msgCallback",
+        "__listener",
+        "__control",
+        "__transfers",
+        "__status",
+        "__name",
+        "__address",
+        "__port",
+        "__packets",
+        "__metrics",
+        "__verified",
+        "__lastSeen",
+        "__alertAddress",
+        "__writableListener")
 
     def __init__(self, name="Unknown", status="Online", mac=None):
 
         self.__status = status
         self.__name = name
+        self.__id = None
+        self.__manager = None
+        self.__connection = None
+        self.__decoder = None
+        self.__outbox = collections.deque()
+        self.__store = None
+        self.__history = History.History()
+        self.__conversation = Sync.Conversation()
+        self.__sentUpTo = None
+        self.__ackSent = 0
+        self.__msgCallback = None
+        self.__listener = None
+        self.__control = None
+        self.__transfers = None
+        self.__address = None
+        self.__port = messagePort
+        self.__packets = None
+        self.__metrics = Metrics.DISABLED
+        self.__verified = True
+        self.__lastSeen = time.time()
+        self.__alertAddress = None
+        self.__writableListener = None
 
         if(mac is None):
             self.__mac = getnode()
         else:
             self.__mac = mac
 
-    def getData(self):
-        root = etree.Element("Contact", attrib={
-            "Name": self.__name,
-            "Status": self.__status,
-            "MAC": str(self.__mac)})
+    def getData(self, kind=Discovery.ANNOUNCE):
+        """Returns the XML packet that old clients use for this contact."""
+        return self.__getPacket(kind, True)
+
+    def getPacket(self, kind=Discovery.ANNOUNCE):
+        """Returns the discovery packet for this contact."""
+        return self.__getPacket(kind, False)
+
+    def __getPacket(self, kind, legacy):
+        # Packets are built once and reused until this contact changes
+        if self.__packets is None:
+            self.__packets = {}
 
-        return etree.tostring(root)
+        packet = self.__packets.get((kind, legacy))
 
-    def setMessageCallback(self, callback):
+        if packet is None:
+            if legacy:
+                packet = Discovery.encodeLegacy(
+                    kind, self.__mac, self.__name, self.__status)
+            else:
+                packet = Discovery.encodePacket(
+                    kind, self.__mac, self.__port, self.__name, self.__status)
+
+            self.__packets[(kind, legacy)] = packet
+
+        return packet
+
+    def setMessageCallback(self, callback, replay=None, count=History.PAGE_SIZE):
+        if replay is None:
+            self.__msgCallback = callback
+        elif self.__manager is None:
+            self.__replay(callback, replay, count)
+        else:
+            self.__manager.getEngine().callSoon(
+                self.__replay, callback, replay, count)
+
+    def __replay(self, callback, replay, count):
+        # Only the last page is read, however long the history is
+        replay(self.__history.readBefore(None, count))
         self.__msgCallback = callback
 
-        # send the entire message history
-        for msg in self.__history:
-            self.__msgCallback(msg)
+    def setMessageListener(self, listener):
+        """Set a function called with (contact, message) for every message
+        received. Unlike the message callback it is never cleared."""
+        self.__listener = listener
 
-    def setConnection(self, connection):
-        """Set the connection to listen to."""
-        print("Setting contact connection.")
-        # If a connection is already open, then keep it
-        if(self.__connection is not None):
-            return
+    def setControlListener(self, listener):
+        """Set a function called with (contact, payload) for every control
+        frame received."""
+        self.__control = listener
+
+    def setWritableListener(self, listener):
+        """Set a function called with (contact, writable) when the
+        connection stops or starts taking messages."""
+        self.__writableListener = listener
+
+    def setTransferManager(self, transfers):
+        self.__transfers = transfers
+
+    def setMetrics(self, metrics):
+        self.__metrics = metrics
+
+    def setMessageStore(self, store):
+        self.__store = store
+
+    def setConnectionManager(self, manager):
+        self.__manager = manager
+
+    def setHistory(self, history):
+        self.__history = history
+
+    def getHistory(self):
+        return self.__history
+
+    def setConversation(self, conversation):
+        self.__conversation = conversation
+
+    def getConversation(self):
+        return self.__conversation
+
+    def readHistory(self, position=None, count=History.PAGE_SIZE):
+        return self.__history.readBefore(position, count)
+
+    def setConnection(self, connection, decoder=None, frames=()):
+        """Set the connection to listen to, replacing any open connection.
+        decoder holds data already read from the connection and frames are
+        messages already decoded from it. Must be called from the engine
+        thread."""
+        log.debug("Setting connection to %s", self.__name)
+        old = self.__connection
+
+        if decoder is None:
+            decoder = Framing.FrameDecoder(decode=Framing.decodeText)
 
         self.__connection = connection
+        self.__decoder = decoder
+
+        if old is not None:
+            old.setHandlers(lambda data: None, lambda: None)
+            old.close()
+
+        connection.setHandlers(
+            self.__onData,
+            lambda: self.__onClose(connection))
+        connection.setWritableHandler(
+            lambda writable: self.__onWritable(connection, writable))
+
+        # Tell the peer how far we have read, so it sends only the gap.
+        # Chat messages wait for its own request to say where to start.
+        self.__sentUpTo = None
+        self.__ackSent = self.__conversation.getReceived()
+        self.__write([Sync.encodeSync(self.__ackSent)])
+
+        # Send the control frames that were queued while connecting
+        self.__flush()
+
+        self.__receive(frames)
+
+    def getConnection(self):
+        return self.__connection
+
+    def hasOutbox(self):
+        """Returns True if messages are waiting for a connection."""
+        return len(self.__outbox) > 0
+
+    def hasUnacked(self):
+        return self.__conversation.hasUnacked()
 
-        self.__thrListen = threading.Thread(target=self.__listen)
-        self.__thrListen.start()
+    def getOutboxSize(self):
+        return len(self.__outbox)
+
+    def isConnected(self):
+        return self.__connection is not None and not self.__connection.isClosed()
+
+    def isSynced(self):
+        return self.isConnected() and self.__sentUpTo is not None
+
+    def isWritable(self):
+        return self.__connection is None or self.__connection.isWritable()
+
+    def dropOutbox(self):
+        """Give up on the messages waiting for a connection. Chat messages
+        are kept in the message store until this contact is found again."""
+        outbox, self.__outbox = self.__outbox, collections.deque()
+
+        # Control frames only make sense to the connection they were for
+        if self.__store is not None:
+            messages = [message for message in outbox
+                if Sync.isMessage(message) or not message.startswith(Framing.CONTROL)]
+            stored = self.__store.append(self.__mac, messages)
+            self.__metrics.messagesStored.inc(stored)
+        else:
+            stored = 0
+
+        if stored:
+            log.info("Storing %d messages to %s", stored, self.__name)
+
+        if len(outbox) > stored:
+            log.info("Dropping %d messages to %s", len(outbox) - stored, self.__name)
+
+    def forward(self, messages):
+        """Send messages that were kept while this contact could not be
+        reached. Must be called from the engine thread."""
+        if not messages:
+            return
+
+        # Messages stored before they were numbered are numbered now
+        self.__outbox.extend(message if Sync.isMessage(message) else
+            Sync.encodeMessage(self.__conversation.record(message), message)
+            for message in messages)
+        self.__metrics.messagesForwarded.inc(len(messages))
+
+        if self.__connection is None:
+            self.__manager.connect(self)
+        else:
+            self.__pump()
 
     def setAddress(self, value):
         self.__address = value
@@ -366,64 +1144,331 @@ class Contact:
     def getMAC(self):
         return self.__mac
 
+    def setId(self, value):
+        self.__id = value
+
+    def getId(self):
+        return self.__id
+
+    def setPort(self, value):
+        if value != self.__port:
+            self.__port = value
+            self.__packets = None
+
+    def getPort(self):
+        return self.__port
+
+    def setName(self, value):
+        if value != self.__name:
+            self.__name = value
+            self.__packets = None
+
     def getName(self):
         return self.__name
 
+    def setStatus(self, value):
+        if value != self.__status:
+            self.__status = value
+            self.__packets = None
+
+    def getStatus(self):
+        return self.__status
+
+    def setVerified(self, value):
+        self.__verified = value
+
+    def isVerified(self):
+        return self.__verified
+
+    def setLastSeen(self, value):
+        self.__lastSeen = value
+
+    def getLastSeen(self):
+        return self.__lastSeen
+
+    def setAlertAddress(self, value):
+        self.__alertAddress = value
+
+    def getAlertAddress(self):
+        return self.__alertAddress
+
     def sendMessage(self, message):
+        """Send a message to this contact without blocking the caller."""
+        self.__manager.getEngine().callSoon(self.__sendMessage, message)
+
+    def sendControl(self, payload):
+        """Send a control frame to this contact without blocking the
+        caller."""
+        self.sendMessage(Framing.CONTROL + payload)
+
+    def sendFile(self, path):
+        """Offer the file at path to this contact without blocking the
+        caller."""
+        return self.__transfers.sendFile(self, path)
+
+    def __sendMessage(self, message):
+        # Chat messages are numbered and saved, and go out as the window
+        # allows
+        if not message.startswith(Framing.CONTROL):
+            number = self.__conversation.record(message)
+            self.__outbox.append(Sync.encodeMessage(number, message))
+
+            if self.__connection is None:
+                self.__manager.connect(self)
+            else:
+                self.__pump()
+            return
+
         # If no connection is availble, open one
         if(self.__connection is None):
-            newConnection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            newConnection.connect((self.__address, messagePort))
-            self.setConnection(newConnection)
+            self.__outbox.append(message)
+            self.__manager.connect(self)
+            return
 
-        print("Sending message: ", message)
-        self.__connection.send(message.encode())
+        # Wait for a connection that is behind to catch up
+        if not self.__connection.isWritable():
+            self.__outbox.append(message)
+            return
 
-    def __listen(self):
+        log.debug("Sending message to %s: %s", self.__name, message)
+        self.__write([message])
 
-        while not (self.__connection is None):
-            # Wait for data to be available
-            try:
-                rlist, wlist, elist = select.select(
-                    [self.__connection],
-                    [],
-                    [self.__connection],
-                    5)
+    def __flush(self):
+        """Send the control frames waiting in the outbox in one write."""
+        control = [message for message in self.__outbox if not Sync.isMessage(message)]
+        if not control:
+            return
 
-            except:
-                break
+        self.__outbox = collections.deque(
+            message for message in self.__outbox if Sync.isMessage(message))
 
-            # A message is available
-            if(len(rlist) > 0):
-                try:
-                    buff = self.__connection.recv(1024)
+        log.debug("Sending %d waiting frames to %s", len(control), self.__name)
+        self.__write(control)
 
-                    if (len(buff.strip()) == 0) or (buff == '<close />'):
-                        self.__msgCallback("<close />")
-                        break
+    def __pump(self):
+        """Send as many chat messages as the window allows, in one write.
+        Messages sent on an earlier connection that the peer has not
+        acknowledged are sent again from the sent log."""
+        if self.__sentUpTo is None or self.__connection is None or \
+                not self.__connection.isWritable():
+            return
 
-                    print(self.__name + ": " + buff.decode())
-                    self.__history.append(buff.decode())
-                    if not (self.__msgCallback is None):
-                        self.__msgCallback(self.__history[-1])
+        conversation = self.__conversation
+        limit = conversation.getAcked() + Sync.WINDOW
+        outbox = self.__outbox
 
-                except socket.error as ex:
-                    print("An error occured.", ex)
-                    break
+        # Messages already sent, or acknowledged, leave the outbox
+        while outbox and self.__number(outbox[0]) <= self.__sentUpTo:
+            outbox.popleft()
 
-            if(len(elist) > 0):
+        first = self.__number(outbox[0]) if outbox else conversation.getLastSent() + 1
+
+        batch = [Sync.encodeMessage(number, text) for number, text, sent in
+            conversation.readAfter(self.__sentUpTo, min(first - 1, limit))]
+
+        if batch:
+            log.info("Resending %d messages to %s", len(batch), self.__name)
+            self.__sentUpTo = min(first - 1, limit)
+
+        while outbox:
+            number = self.__number(outbox[0])
+            if number > limit:
                 break
 
-        print("clearing socket")
-        self.closeConnection()
+            batch.append(outbox.popleft())
+            self.__sentUpTo = number
+
+        if batch:
+            self.__write(batch)
+
+    def __number(self, message):
+        return Sync.decodeMessage(message[len(Framing.CONTROL):])[0]
+
+    def __write(self, messages):
+        """Write messages to the connection in one write."""
+        data = b"".join(Framing.encodeText(message) for message in messages)
+        self.__connection.write(data)
+        self.__metrics.messagesSent.inc(len(messages))
+        self.__metrics.bytesSent.inc(len(data))
+
+    def __onSync(self, payload):
+        """The peer has said how far it has read: send it the rest."""
+        try:
+            sequence = Sync.decodeSequence(payload)
+        except ValueError:
+            log.warning("Invalid sync request from %s", self.__name)
+            return
+
+        self.__conversation.acknowledge(sequence)
+        self.__sentUpTo = sequence
+        self.__dropExpired()
+        self.__pump()
+
+    def __dropExpired(self):
+        """Give up on the unacknowledged messages that the message store
+        would not keep, instead of resending them, and tell the peer not
+        to wait for them. The whole unacknowledged backlog counts towards
+        the store's limits."""
+        if self.__store is None:
+            return
+
+        conversation = self.__conversation
+        unacked = conversation.readAfter(self.__sentUpTo)
+        dropped = self.__store.countDropped(
+            [(sent, text) for number, text, sent in unacked])
+
+        # Only resends are given up on, not messages still in the outbox
+        first = self.__number(self.__outbox[0]) if self.__outbox else None
+        if first is not None:
+            dropped = min(dropped, len([entry for entry in unacked if entry[0] < first]))
+
+        if not dropped:
+            return
+
+        sequence = unacked[dropped - 1][0]
+        log.warning("Giving up on %d unacknowledged messages to %s", dropped, self.__name)
+
+        conversation.acknowledge(sequence)
+        conversation.save()
+        self.__sentUpTo = sequence
+        self.__write([Sync.encodeSkip(sequence)])
+
+    def __onAck(self, payload):
+        try:
+            sequence = Sync.decodeSequence(payload)
+        except ValueError:
+            log.warning("Invalid ack from %s", self.__name)
+            return
+
+        self.__conversation.acknowledge(sequence)
+
+        if self.__sentUpTo is not None and sequence > self.__sentUpTo:
+            self.__sentUpTo = sequence
+
+        self.__pump()
+
+    def __onData(self, buff):
+        metrics = self.__metrics
+        metrics.bytesReceived.inc(len(buff))
+
+        try:
+            if metrics.isEnabled():
+                started = Metrics.clock()
+                messages = self.__decoder.feed(buff)
+                metrics.messageParse.observe(Metrics.clock() - started)
+            else:
+                messages = self.__decoder.feed(buff)
+
+        except (Framing.FrameError, UnicodeDecodeError) as ex:
+            log.warning("Invalid message from %s: %s", self.__name, ex)
+            self.__connection.close()
+            return
+
+        self.__receive(messages)
+
+    def __receive(self, messages):
+        self.__metrics.messagesReceived.inc(len(messages))
+
+        for message in messages:
+            if not message.startswith(Framing.CONTROL):
+                self.__deliver(message)
+                continue
+
+            payload = message[len(Framing.CONTROL):]
+
+            if payload.startswith(Sync.MESSAGE):
+                self.__onMessage(payload)
+
+            elif payload.startswith(Sync.ACK):
+                self.__onAck(payload)
+
+            elif payload.startswith(Sync.SYNC):
+                self.__onSync(payload)
+
+            elif payload.startswith(Sync.SKIP):
+                self.__onSkip(payload)
+
+            elif self.__control is not None:
+                self.__control(self, payload)
+
+        # One cumulative ack covers everything read in this batch
+        received = self.__conversation.getReceived()
+        if received > self.__ackSent and self.isConnected():
+            self.__ackSent = received
+            self.__write([Sync.encodeAck(received)])
+
+        self.__conversation.save()
+
+    def __onSkip(self, payload):
+        try:
+            sequence = Sync.decodeSequence(payload)
+        except ValueError:
+            log.warning("Invalid skip from %s", self.__name)
+            return
+
+        for text in self.__conversation.skip(sequence):
+            self.__deliver(text)
+
+    def __onMessage(self, payload):
+        try:
+            sequence, text = Sync.decodeMessage(payload)
+        except ValueError:
+            log.warning("Invalid message from %s", self.__name)
+            return
+
+        # Duplicates give nothing, and a message that fills a gap gives
+        # the ones held behind it too
+        for text in self.__conversation.receive(sequence, text):
+            self.__deliver(text)
+
+    def __deliver(self, message):
+        log.debug("%s: %s", self.__name, message)
+        position = self.__history.append(message)
+        if not (self.__msgCallback is None):
+            self.__msgCallback(message, position)
+        if not (self.__listener is None):
+            self.__listener(self, message)
+
+    def __onWritable(self, connection, writable):
+        if connection is not self.__connection:
+            return
+
+        # Send what waited while the connection was behind
+        if writable:
+            self.__flush()
+            self.__pump()
+
+        if self.__writableListener is not None:
+            self.__writableListener(self, writable)
+
+    def __onClose(self, connection):
+        # A connection that was replaced is no longer ours to clear
+        if connection is not self.__connection:
+            return
+
+        log.debug("Connection to %s closed", self.__name)
         self.__connection = None
 
-    def closeConnection(self):
-        print("closeConnection")
+        # Reconnect to resend what the peer has not acknowledged. The
+        # message callback stays, so an open window keeps getting messages
+        # once the connection is back.
+        if self.__manager is not None and (self.hasOutbox() or self.hasUnacked()):
+            self.__manager.reconnect(self)
+
+        elif not (self.__msgCallback is None):
+            self.__msgCallback("<close />", None)
 
+    def closeConnection(self):
         if not (self.__connection is None):
-            print("closing socket")
+            log.debug("Closing connection to %s", self.__name)
             self.__connection.close()
 
-        print("clearing message callback")
+    def detach(self):
+        """Stop calling the message callback, once the window showing this
+        conversation has closed."""
         self.__msgCallback = None
+
+
+if __name__ == "__main__":
+    import Daemon
+    Daemon.main()
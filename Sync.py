@@ -0,0 +1,358 @@
+# -*- coding: utf-8 *-*
+
+"""
+Sequence numbers, acknowledgements and history sync for the
+conversation with one peer.
+
+Every chat message sent to a peer is numbered, from 1, and saved with its
+number to a sent log. On a connection it is a control frame:
+
+	msg <sequence> <text>
+
+Both ends of a new connection start by sending how far they have read:
+
+	sync <sequence>
+
+meaning every message up to that number has arrived. The other end
+answers by sending what it has after that number from its sent log, so
+catching up costs the size of the gap however long the conversation is.
+The sent log is read backwards from its end, and only as far back as the
+gap goes.
+
+After that, the receiver acknowledges what it has read with
+
+	ack <sequence>
+
+once for every batch of data read from the connection, not once per
+message. Acks are cumulative: one ack covers every message up to its
+number. Up to WINDOW messages may be sent and not yet acknowledged, so
+many messages are in flight at once and the sender only waits when the
+receiver falls a whole window behind. Messages past the window wait in
+the contact's outbox.
+
+Unacknowledged messages stay in the sent log, with the time each was
+first sent. When a connection closes with some of them, the contact
+connects again, and the sync request of the new connection tells the
+sender where to start resending. The sent log is the only thing that
+retries messages, but the retries follow the message store's policy:
+unacknowledged messages that have expired, or that are past its limits,
+are given up on instead of resent, and the receiver is told with
+
+	skip <sequence>
+
+meaning it will never get the messages up to that number, so it stops
+waiting for them. Messages that arrive twice are dropped by their number. Messages that arrive
+ahead of a gap are held until the gap is filled, up to MAX_HELD of
+them. Past that, the gap is given up on and the held messages are
+delivered.
+
+Plain text frames without a number, from older clients, are still shown
+but are not synced or acknowledged.
+
+Functions:
+	encodeMessage			- Returns the control frame for a numbered message
+	encodeSync				- Returns the control frame for a sync request
+	encodeAck				- Returns the control frame for an acknowledgement
+	encodeSkip				- Returns the control frame for messages that were given up on
+	decodeMessage			- Returns (sequence, text) from the payload of a msg frame
+	decodeSequence			- Returns the sequence from the payload of a sync, ack or skip
+							  frame
+	isMessage				- Returns True if a frame is a numbered chat message
+
+
+
+Class Name: Conversation
+	The sequence numbers of the conversation with one peer. All of its
+	functions run on the engine thread.
+
+	The numbers are saved to a small state file, which is only read the
+	first time they are needed, so known peers that are never talked to
+	cost no disk reads.
+
+Data:
+	__log					- ConversationLog of sent messages, or None to keep them in memory
+	__sent					- The last SENT_SIZE sent messages as (sequence, text, sent)
+	__lastSent				- Number of the last message sent, or None until it is read
+	__received				- Number of the last message received in order
+	__acked					- Number of the last message the peer acknowledged
+	__held					- Messages received ahead of a gap, keyed by number
+	__state					- Path of the file that the numbers are saved to, or None
+	__loaded				- True once the state file has been read
+	__changed				- True if the numbers have changed since they were saved
+
+Functions:
+	record					- Numbers a message to send, saves it, and returns its number
+	readAfter				- Returns the sent (sequence, text, sent) messages after a number,
+							  oldest first
+	skipTo					- Makes the next message sent come after a number
+	acknowledge				- Notes that the peer has every message up to a number
+	getLastSent				- Returns the number of the last message sent
+	getReceived				- Returns the number of the last message received in order
+	getAcked				- Returns the number of the last message acknowledged
+	hasUnacked				- Returns True if some sent messages have not been acknowledged
+	receive					- Takes a received message and returns the texts that can now be
+							  shown, in order
+	skip					- Stops waiting for the messages up to a number and returns the
+							  texts that can now be shown, in order
+	save					- Saves the numbers, if they changed
+	close					- Closes the files
+"""
+
+import collections
+import logging
+import os
+import struct
+import time
+
+import Framing
+import History
+
+
+SYNC = "sync "
+ACK = "ack "
+MESSAGE = "msg "
+SKIP = "skip "
+
+WINDOW = 256
+SYNC_BATCH = 500
+MAX_HELD = 1024
+SENT_SIZE = 1000
+
+# received, acked
+STATE = struct.Struct("!QQ")
+
+log = logging.getLogger("SkyChat.Sync")
+
+
+def encodeMessage(sequence, text):
+    return "%s%s%d %s" % (Framing.CONTROL, MESSAGE, sequence, text)
+
+
+def encodeSync(sequence):
+    return "%s%s%d" % (Framing.CONTROL, SYNC, sequence)
+
+
+def encodeAck(sequence):
+    return "%s%s%d" % (Framing.CONTROL, ACK, sequence)
+
+
+def encodeSkip(sequence):
+    return "%s%s%d" % (Framing.CONTROL, SKIP, sequence)
+
+
+def decodeMessage(payload):
+    """Returns (sequence, text). Raises ValueError if the payload is not
+    a msg frame."""
+    sequence, text = payload[len(MESSAGE):].split(" ", 1)
+    return int(sequence), text
+
+
+def decodeSequence(payload):
+    """Returns the number of a sync, ack or skip payload. Raises ValueError if
+    it has none."""
+    return int(payload.split(" ", 1)[1])
+
+
+def isMessage(frame):
+    return frame.startswith(Framing.CONTROL + MESSAGE)
+
+
+class Conversation:
+
+    __log = None
+    __state = None
+    __lastSent = None
+    __received = 0
+    __acked = 0
+    __loaded = False
+    __changed = False
+
+    def __init__(self, path=None):
+        """Keep the sent log at path + ".log" and the numbers at path +
+        ".seq". None keeps everything in memory."""
+        self.__held = {}
+        self.__sent = collections.deque(maxlen=SENT_SIZE)
+
+        if path is None:
+            self.__lastSent = 0
+            self.__loaded = True
+            return
+
+        self.__log = History.ConversationLog(path + ".log")
+        self.__state = path + ".seq"
+
+    def __load(self):
+        if self.__loaded:
+            return
+
+        self.__loaded = True
+
+        try:
+            with open(self.__state, "rb") as f:
+                self.__received, self.__acked = STATE.unpack(f.read(STATE.size))
+        except (OSError, struct.error):
+            pass
+
+    def getLastSent(self):
+        if self.__lastSent is None:
+            # Only the last record is read to find the number
+            records = self.__log.readRecords(None, 1)
+            self.__lastSent = self.__sequence(records[0][1])[0] if records else 0
+
+        return self.__lastSent
+
+    def getReceived(self):
+        self.__load()
+        return self.__received
+
+    def getAcked(self):
+        self.__load()
+        return self.__acked
+
+    def hasUnacked(self):
+        """Returns True if some sent messages have not been acknowledged.
+        Reads nothing for a conversation that has never sent anything."""
+        if self.__lastSent is None and self.__log.size() == 0:
+            self.__lastSent = 0
+
+        return self.getLastSent() > 0 and self.getLastSent() > self.getAcked()
+
+    def acknowledge(self, sequence):
+        """Note that the peer has every message up to sequence."""
+        self.__load()
+        self.skipTo(sequence)
+
+        if sequence > self.__acked:
+            self.__acked = sequence
+            self.__changed = True
+
+    def skipTo(self, sequence):
+        """Make the next message sent come after sequence. Used when the
+        peer has seen more than this end remembers sending."""
+        if sequence > self.getLastSent():
+            log.info("Skipping sent messages up to %d", sequence)
+            self.__lastSent = sequence
+
+    def record(self, text):
+        sequence = self.getLastSent() + 1
+        sent = time.time()
+        self.__lastSent = sequence
+        self.__sent.append((sequence, text, sent))
+
+        if self.__log is not None:
+            self.__log.append("%d@%d %s" % (sequence, sent, text))
+
+        return sequence
+
+    def readAfter(self, sequence, last=None):
+        """Returns the sent (sequence, text, sent) messages after sequence
+        and up to last, oldest first, where sent is the time the message
+        was first sent. Only the gap is read."""
+        if last is None or last > self.getLastSent():
+            last = self.getLastSent()
+
+        if last <= sequence:
+            return []
+
+        # Recent messages are still in memory
+        if self.__log is None or (self.__sent and self.__sent[0][0] <= sequence + 1):
+            return [entry for entry in self.__sent if sequence < entry[0] <= last]
+
+        records = []
+        offset = None
+
+        # Walk back from the end of the log until the gap is covered
+        while True:
+            page = self.__log.readRecords(offset, SYNC_BATCH)
+            if not page:
+                break
+
+            entries = [self.__sequence(message) for start, message in page]
+            records[:0] = [entry for entry in entries if sequence < entry[0] <= last]
+
+            if entries[0][0] <= sequence:
+                break
+
+            offset = page[0][0]
+
+        return records
+
+    def __sequence(self, record):
+        sequence, text = record.split(" ", 1)
+        sequence, at, sent = sequence.partition("@")
+
+        # Records from before send times were saved count as sent now
+        return int(sequence), text, float(sent) if at else time.time()
+
+    def receive(self, sequence, text):
+        """Take a received message, and return the texts that can now be
+        shown, in order."""
+        self.__load()
+
+        if sequence <= self.__received or sequence in self.__held:
+            return []
+
+        if sequence > self.__received + 1:
+            self.__held[sequence] = text
+
+            if len(self.__held) <= MAX_HELD:
+                return []
+
+            # The gap is not going to be filled
+            log.warning("Giving up on messages %d to %d",
+                self.__received + 1, min(self.__held) - 1)
+            self.__received = min(self.__held) - 1
+            text = self.__held.pop(self.__received + 1)
+
+        self.__received += 1
+
+        # The message may fill a gap in front of held ones
+        return [text] + self.__release()
+
+    def skip(self, sequence):
+        """Stop waiting for the messages up to sequence, which the peer has
+        given up on, and return the texts that can now be shown, in order."""
+        self.__load()
+
+        if sequence <= self.__received:
+            return []
+
+        log.info("Peer gave up on messages %d to %d", self.__received + 1, sequence)
+        self.__received = sequence
+
+        # Messages that did arrive ahead of the gap are still shown
+        texts = [self.__held.pop(number) for number in sorted(self.__held)
+            if number <= sequence]
+
+        return texts + self.__release()
+
+    def __release(self):
+        """Returns the held messages that now follow on in order."""
+        texts = []
+
+        while self.__received + 1 in self.__held:
+            self.__received += 1
+            texts.append(self.__held.pop(self.__received))
+
+        self.__changed = True
+        return texts
+
+    def save(self):
+        if not self.__changed or self.__state is None:
+            return
+
+        self.__changed = False
+        self.__load()
+
+        try:
+            os.makedirs(os.path.dirname(self.__state) or ".", exist_ok=True)
+            with open(self.__state, "wb") as f:
+                f.write(STATE.pack(self.__received, self.__acked))
+        except OSError as ex:
+            log.warning("Could not save %s: %s", self.__state, ex)
+
+    def close(self):
+        self.save()
+
+        if self.__log is not None:
+            self.__log.close()
@@ -0,0 +1,643 @@
+# -*- coding: utf-8 *-*
+
+"""
+File transfer between contacts.
+
+Offers, answers and results travel as control frames starting with FILE
+on the contacts' chat connection. The file itself goes over a separate
+connection, opened by the sender with a file hello, so a large file
+never holds up chat messages:
+
+	{"k": "offer", "id": ID, "name": file name, "size": bytes, "sha256": hex digest}
+	{"k": "accept", "id": ID, "offset": bytes}		- Send the file from offset on a new file connection
+	{"k": "decline", "id": ID}
+	{"k": "cancel", "id": ID}						- Either end has given up on the transfer
+	{"k": "done", "id": ID, "ok": bool}				- The receiver has checked the file
+
+The sender streams the file with Connection.sendfile, which uses
+os.sendfile where the platform has it, CHUNK bytes at a time. The
+receiver writes the data into a preallocated <path>.part file through a
+memory-mapped window of WINDOW bytes, and hashes it as it arrives, so
+memory use does not grow with the file. When the whole file has arrived
+its SHA-256 is compared with the offer, and <path>.part is renamed to
+path.
+
+If the file connection drops, the receiver asks for the rest with a new
+accept from the number of bytes it already has, up to MAX_RESUMES times.
+
+
+
+Class Name: TransferManager
+	Runs every file transfer of one client. All of its functions run on
+	the engine thread unless they say otherwise.
+
+Data:
+	__engine				- Engine that runs the transfers
+	__myInfo				- This client's own contact
+	__transfers				- Every transfer that has not finished, keyed by (MAC, ID)
+	__newTransfer			- Callback used when a contact offers a file
+	__tls					- Security.Tls that file connections are opened with, or None
+	__hub					- Hub.HubLink that file connections are opened through, or None
+
+Functions:
+	sendFile				- Offers a file to a contact and returns its FileTransfer (any thread)
+	getTransfers			- Returns the transfers that have not finished
+	onControl				- Handles a file control frame from a contact
+	onConnection			- Handles a file connection accepted by the ConnectionManager
+
+
+
+Class Name: FileTransfer
+	One file being sent or received.
+
+Functions:
+	getId					- Returns the transfer ID
+	getContact				- Returns the contact at the other end
+	getName					- Returns the file name
+	getSize					- Returns the file size in bytes
+	getPath					- Returns the path of the file on this side
+	getTransferred			- Returns the number of bytes sent or received so far
+	getState				- Returns the state: one of the state constants below
+	getError				- Returns the reason a transfer failed, or None
+	isOutbound				- Returns True if this side is sending the file
+	setListener				- Sets a function called with the transfer on progress and state changes.
+							  It is called on the engine thread.
+	accept					- Accepts an offered file and saves it at path (any thread)
+	decline					- Declines an offered file (any thread)
+	cancel					- Stops the transfer (any thread)
+
+
+
+Class Name: FileWriter
+	Writes a file of known size in order through a memory-mapped window.
+
+Functions:
+	seek					- Moves to an offset in the file
+	write					- Writes data at the current offset
+	close					- Flushes and closes the file
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+
+import Connections
+import Framing
+import Security
+
+
+FILE = "file "
+
+OFFER = "offer"
+ACCEPT = "accept"
+DECLINE = "decline"
+CANCEL = "cancel"
+DONE = "done"
+
+# States of a FileTransfer
+HASHING = "hashing"
+OFFERED = "offered"
+WAITING = "waiting"
+SENDING = "sending"
+RECEIVING = "receiving"
+COMPLETE = "complete"
+DECLINED = "declined"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+FINISHED = (COMPLETE, DECLINED, CANCELLED, FAILED)
+
+CHUNK = 4 * 1024 * 1024
+WINDOW = 64 * 1024 * 1024
+HASH_BLOCK = 1024 * 1024
+PROGRESS_STEP = 1024 * 1024
+RESUME_DELAY = 1.0
+MAX_RESUMES = 5
+
+log = logging.getLogger("SkyChat.Transfers")
+
+
+def _encode(packet):
+    return FILE + json.dumps(packet, separators=(",", ":"))
+
+
+class TransferManager:
+
+    def __init__(self, engine, myInfo, newTransfer=None,
+        connectTimeout=Connections.CONNECT_TIMEOUT, tls=None, hub=None):
+
+        self.__engine = engine
+        self.__myInfo = myInfo
+        self.__newTransfer = newTransfer
+        self.__connectTimeout = connectTimeout
+        self.__tls = tls
+        self.__hub = hub
+        self.__transfers = {}
+
+    def getEngine(self):
+        return self.__engine
+
+    def getTransfers(self):
+        return list(self.__transfers.values())
+
+    def sendFile(self, contact, path):
+        """Offer the file at path to contact. Raises OSError if the file
+        cannot be read."""
+        size = os.path.getsize(path)
+        file = open(path, "rb")
+
+        transfer = FileTransfer(self, self.__engine.random().getrandbits(63), contact,
+            os.path.basename(path), size, True, path)
+        transfer._file = file
+
+        self.__engine.callSoon(self.__startHash, transfer, hashlib.sha256())
+        return transfer
+
+    def __startHash(self, transfer, hasher):
+        self.__transfers[transfer.getKey()] = transfer
+        self.__hash(transfer, hasher, 0)
+
+    def __hash(self, transfer, hasher, offset):
+        """Hash the file one block per turn of the engine, so chat keeps
+        flowing while a large file is hashed."""
+        if transfer.getState() != HASHING:
+            return
+
+        try:
+            transfer._file.seek(offset)
+            block = transfer._file.read(HASH_BLOCK)
+        except OSError as ex:
+            self.__fail(transfer, ex)
+            return
+
+        if block:
+            hasher.update(block)
+            self.__engine.callSoon(self.__hash, transfer, hasher, offset + len(block))
+            return
+
+        transfer._checksum = hasher.hexdigest()
+        transfer._setState(WAITING)
+        transfer.getContact().sendControl(_encode({
+            "k": OFFER,
+            "id": transfer.getId(),
+            "name": transfer.getName(),
+            "size": transfer.getSize(),
+            "sha256": transfer._checksum}))
+
+    def onControl(self, contact, payload):
+        """Handle a file control frame received from contact."""
+        try:
+            packet = json.loads(payload[len(FILE):])
+            kind = packet["k"]
+            key = (contact.getMAC(), int(packet["id"]))
+        except (ValueError, KeyError, TypeError) as ex:
+            log.warning("Invalid file packet from %s: %s", contact.getName(), ex)
+            return
+
+        transfer = self.__transfers.get(key)
+
+        if kind == OFFER:
+            self.__offered(contact, packet, key)
+
+        elif transfer is None:
+            return
+
+        elif kind == ACCEPT and transfer.isOutbound():
+            self.__accepted(transfer, packet.get("offset", 0))
+
+        elif kind == DECLINE and transfer.isOutbound():
+            self.__finish(transfer, DECLINED)
+
+        elif kind == CANCEL:
+            self.__finish(transfer, CANCELLED)
+
+        elif kind == DONE and transfer.isOutbound():
+            if packet.get("ok"):
+                transfer._setTransferred(transfer.getSize(), True)
+                self.__finish(transfer, COMPLETE)
+            else:
+                self.__fail(transfer, ValueError("checksum mismatch"))
+
+    def __offered(self, contact, packet, key):
+        try:
+            name = os.path.basename(str(packet["name"]))
+            size = int(packet["size"])
+            checksum = str(packet["sha256"])
+        except (KeyError, ValueError, TypeError) as ex:
+            log.warning("Invalid file offer from %s: %s", contact.getName(), ex)
+            return
+
+        if key in self.__transfers or size < 0:
+            return
+
+        transfer = FileTransfer(self, key[1], contact, name, size, False)
+        transfer._checksum = checksum
+        transfer._setState(OFFERED)
+        self.__transfers[key] = transfer
+
+        if self.__newTransfer is None:
+            self._decline(transfer)
+        else:
+            self.__newTransfer(transfer)
+
+    def _accept(self, transfer, path):
+        if transfer.getState() != OFFERED:
+            return
+
+        try:
+            transfer._writer = FileWriter(path + ".part", transfer.getSize())
+        except OSError as ex:
+            self.__fail(transfer, ex)
+            return
+
+        transfer._path = path
+        transfer._hasher = hashlib.sha256()
+        transfer._setState(RECEIVING)
+        self.__resume(transfer)
+
+    def __resume(self, transfer):
+        """Ask the sender for everything from the bytes already received."""
+        if transfer.getState() != RECEIVING:
+            return
+
+        if transfer._connection is not None:
+            transfer._connection.close()
+            transfer._connection = None
+
+        # Data from a new connection starts where this accept says
+        transfer._writer.seek(transfer.getTransferred())
+
+        if transfer.getTransferred() == transfer.getSize():
+            self.__verify(transfer)
+            return
+
+        transfer.getContact().sendControl(_encode({
+            "k": ACCEPT,
+            "id": transfer.getId(),
+            "offset": transfer.getTransferred()}))
+
+    def _decline(self, transfer):
+        if transfer.getState() == OFFERED:
+            transfer.getContact().sendControl(
+                _encode({"k": DECLINE, "id": transfer.getId()}))
+            self.__finish(transfer, DECLINED)
+
+    def _cancel(self, transfer):
+        if transfer.getState() not in FINISHED:
+            transfer.getContact().sendControl(
+                _encode({"k": CANCEL, "id": transfer.getId()}))
+            self.__finish(transfer, CANCELLED)
+
+    def __accepted(self, transfer, offset):
+        if transfer.getState() not in (WAITING, SENDING):
+            return
+
+        try:
+            offset = int(offset)
+        except (ValueError, TypeError):
+            offset = -1
+
+        if not 0 <= offset <= transfer.getSize():
+            self.__fail(transfer, ValueError("bad offset %r" % offset))
+            return
+
+        if transfer._connection is not None:
+            transfer._connection.close()
+            transfer._connection = None
+
+        # A connection that opens later still starts from the latest offset
+        transfer._offset = offset
+        transfer._setState(SENDING)
+        transfer._setTransferred(offset, True)
+        self.__connect(transfer, 0)
+
+    def __connect(self, transfer, attempts):
+        contact = transfer.getContact()
+
+        if self.__hub is not None:
+            self.__hub.connect(
+                contact.getMAC(),
+                lambda connection: self.__connected(transfer, connection),
+                lambda ex: self.__connectFailed(transfer, attempts, ex))
+            return
+
+        self.__engine.connect(
+            contact.getAddress(),
+            contact.getPort(),
+            lambda connection: self.__connected(transfer, connection),
+            lambda ex: self.__connectFailed(transfer, attempts, ex),
+            self.__connectTimeout,
+            **Security.connectOptions(self.__tls, contact.getMAC()))
+
+    def __connectFailed(self, transfer, attempts, ex):
+        if transfer.getState() != SENDING or transfer._connection is not None:
+            return
+
+        if attempts >= MAX_RESUMES:
+            transfer._error = ex
+            self._cancel(transfer)
+            return
+
+        self.__engine.callLater(
+            RESUME_DELAY * 2 ** attempts,
+            self.__connect, transfer, attempts + 1)
+
+    def __connected(self, transfer, connection):
+        if transfer.getState() != SENDING or transfer._connection is not None:
+            connection.close()
+            return
+
+        transfer._connection = connection
+
+        # The hello is the only frame; everything after it is the file
+        connection.write(Framing.encodeText(
+            "%s%d %d" % (Connections.FILE_HELLO, self.__myInfo.getMAC(), transfer.getId())))
+        connection.setHandlers(
+            lambda data: None,
+            lambda: self.__closed(transfer, connection))
+
+        self.__sendChunk(transfer, connection, transfer._offset)
+
+    def __sendChunk(self, transfer, connection, offset):
+        if transfer.getState() != SENDING or transfer._connection is not connection:
+            return
+
+        transfer._setTransferred(offset)
+
+        count = min(CHUNK, transfer.getSize() - offset)
+        if count == 0:
+            return
+
+        connection.sendfile(transfer._file, offset, count,
+            lambda ex: self.__sent(transfer, connection, offset + count, ex))
+
+    def __sent(self, transfer, connection, offset, ex):
+        # The receiver asks for the rest if the connection broke
+        if ex is None:
+            self.__sendChunk(transfer, connection, offset)
+
+    def onConnection(self, contact, connection, transferId, data):
+        """Take over a file connection for the transfer it names."""
+        transfer = self.__transfers.get((contact.getMAC(), transferId))
+
+        if transfer is None or transfer.isOutbound() or \
+                transfer.getState() != RECEIVING or transfer._connection is not None:
+            connection.close()
+            return
+
+        transfer._connection = connection
+        connection.setHandlers(
+            lambda data: self.__received(transfer, connection, data),
+            lambda: self.__closed(transfer, connection))
+
+        if data:
+            self.__received(transfer, connection, data)
+
+    def __received(self, transfer, connection, data):
+        if transfer._connection is not connection:
+            return
+
+        received = transfer.getTransferred() + len(data)
+
+        if received > transfer.getSize():
+            self.__fail(transfer, ValueError("more data than offered"))
+            return
+
+        try:
+            transfer._writer.write(data)
+        except OSError as ex:
+            self.__fail(transfer, ex)
+            return
+
+        transfer._hasher.update(data)
+        transfer._setTransferred(received)
+
+        if received == transfer.getSize():
+            self.__verify(transfer)
+
+    def __verify(self, transfer):
+        transfer._writer.close()
+        ok = transfer._hasher.hexdigest() == transfer._checksum
+
+        transfer.getContact().sendControl(
+            _encode({"k": DONE, "id": transfer.getId(), "ok": ok}))
+
+        if not ok:
+            self.__fail(transfer, ValueError("checksum mismatch"))
+            return
+
+        try:
+            os.replace(transfer.getPath() + ".part", transfer.getPath())
+        except OSError as ex:
+            self.__fail(transfer, ex)
+            return
+
+        transfer._setTransferred(transfer.getSize(), True)
+        self.__finish(transfer, COMPLETE)
+
+    def __closed(self, transfer, connection):
+        if transfer._connection is not connection:
+            return
+
+        transfer._connection = None
+
+        if transfer.isOutbound() or transfer.getState() != RECEIVING:
+            return
+
+        if transfer._resumes >= MAX_RESUMES:
+            transfer._error = ConnectionError("file connection lost")
+            self._cancel(transfer)
+            return
+
+        transfer._resumes += 1
+        self.__engine.callLater(
+            RESUME_DELAY * 2 ** (transfer._resumes - 1),
+            self.__resume,
+            transfer)
+
+    def __fail(self, transfer, ex):
+        log.warning("File transfer of %s failed: %s", transfer.getName(), ex)
+        transfer._error = ex
+        self.__finish(transfer, FAILED)
+
+    def __finish(self, transfer, state):
+        if transfer.getState() in FINISHED:
+            return
+
+        self.__transfers.pop(transfer.getKey(), None)
+
+        if transfer._connection is not None:
+            transfer._connection.close()
+            transfer._connection = None
+
+        if transfer._file is not None:
+            transfer._file.close()
+            transfer._file = None
+
+        if transfer._writer is not None:
+            transfer._writer.close()
+
+            # Keep nothing of a file that will not be finished
+            if state != COMPLETE:
+                try:
+                    os.remove(transfer.getPath() + ".part")
+                except OSError:
+                    pass
+
+        transfer._setState(state)
+
+
+class FileTransfer:
+
+    _file = None
+    _writer = None
+    _hasher = None
+    _connection = None
+    _checksum = None
+    _error = None
+    _offset = 0
+    _resumes = 0
+
+    __listener = None
+    __reported = 0
+
+    def __init__(self, manager, transferId, contact, name, size, outbound,
+        path=None):
+
+        self.__manager = manager
+        self.__id = transferId
+        self.__contact = contact
+        self.__name = name
+        self.__size = size
+        self.__outbound = outbound
+        self._path = path
+        self.__state = HASHING
+        self.__transferred = 0
+
+    def getId(self):
+        return self.__id
+
+    def getKey(self):
+        return (self.__contact.getMAC(), self.__id)
+
+    def getContact(self):
+        return self.__contact
+
+    def getName(self):
+        return self.__name
+
+    def getSize(self):
+        return self.__size
+
+    def getPath(self):
+        return self._path
+
+    def getTransferred(self):
+        return self.__transferred
+
+    def getState(self):
+        return self.__state
+
+    def getError(self):
+        return self._error
+
+    def isOutbound(self):
+        return self.__outbound
+
+    def setListener(self, listener):
+        self.__listener = listener
+
+    def accept(self, path):
+        """Accept the offered file and save it at path."""
+        self.__manager.getEngine().callSoon(self.__manager._accept, self, path)
+
+    def decline(self):
+        self.__manager.getEngine().callSoon(self.__manager._decline, self)
+
+    def cancel(self):
+        self.__manager.getEngine().callSoon(self.__manager._cancel, self)
+
+    def _setState(self, state):
+        self.__state = state
+        self.__notify()
+
+    def _setTransferred(self, count, force=False):
+        self.__transferred = count
+
+        # Only report progress every PROGRESS_STEP bytes
+        if force or count - self.__reported >= PROGRESS_STEP or \
+                count == self.__size:
+            self.__notify()
+
+    def __notify(self):
+        self.__reported = self.__transferred
+
+        if self.__listener is not None:
+            self.__listener(self)
+
+
+class FileWriter:
+
+    __map = None
+    __mapStart = 0
+    __mapEnd = 0
+
+    def __init__(self, path, size):
+        self.__size = size
+        self.__offset = 0
+        self.__file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "r+b")
+
+        try:
+            self.__file.truncate(size)
+
+            # Reserve the disk space up front where the platform can
+            if size > 0 and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(self.__file.fileno(), 0, size)
+        except OSError:
+            self.__file.close()
+            raise
+
+    def seek(self, offset):
+        self.__offset = offset
+
+    def write(self, data):
+        with memoryview(data) as view:
+            while len(view) > 0:
+                if not self.__mapStart <= self.__offset < self.__mapEnd:
+                    self.__remap()
+
+                count = min(len(view), self.__mapEnd - self.__offset)
+                start = self.__offset - self.__mapStart
+
+                self.__map[start:start + count] = view[:count]
+                self.__offset += count
+                view = view[count:]
+
+    def __remap(self):
+        """Map the WINDOW bytes of the file that hold the current offset."""
+        if self.__offset >= self.__size:
+            raise OSError("write past the end of the file")
+
+        self.__unmap()
+
+        start = self.__offset - self.__offset % mmap.ALLOCATIONGRANULARITY
+        length = min(WINDOW, self.__size - start)
+
+        self.__map = mmap.mmap(self.__file.fileno(), length, offset=start)
+        self.__mapStart = start
+        self.__mapEnd = start + length
+
+    def __unmap(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+            self.__mapStart = self.__mapEnd = 0
+
+    def close(self):
+        if self.__file.closed:
+            return
+
+        self.__unmap()
+        self.__file.close()
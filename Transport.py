@@ -0,0 +1,196 @@
+# -*- coding: utf-8 *-*
+
+"""
+The interface between SkyChat and the network.
+
+Client, Contact and everything under them only reach the network and
+the clock through a Transport, so they run unchanged on real sockets
+(Engine.Engine) or on an in-memory network (Simulation.SimulatedNetwork).
+
+Every callback a transport makes happens on its own thread, called the
+transport thread. Functions that may be called from other threads say
+so below.
+
+
+
+Class Name: Transport
+
+Functions:
+	start					- Starts serving the network
+	stop					- Closes every connection and stops serving the network
+	inEngineThread			- Returns True when called from the transport thread
+	callSoon				- Runs a function on the transport thread (any thread)
+	callLater				- Runs a function after delay seconds and returns a handle with a cancel() method
+	time					- Returns the current time of the transport clock in seconds
+	random					- Returns the random.Random that delays and IDs are drawn from, so a
+							  simulated run can be repeated
+	listen					- Starts accepting TCP connections and returns a Listener
+
+	Input Params:
+		port				- Port to listen on. 0 picks a free port
+		onConnection		- Function called with a Connection for every accepted connection
+		host				- Interface to bind to. Default is all interfaces
+		tls					- ssl.SSLContext to serve TLS with. None is plain TCP
+
+	openDatagram			- Opens a UDP socket and returns a DatagramEndpoint
+
+	Input Params:
+		port				- Port to bind to. 0 picks a free port
+		onDatagram			- Function called with (data, (address, port)) for every datagram
+		host				- Interface to bind to. Default is all interfaces
+		reuse				- Let other sockets bind the same port, as multicast receivers must
+
+	connect					- Opens a TCP connection without blocking the caller (any thread)
+
+	Input Params:
+		host, port			- Address to connect to
+		onConnected			- Function called with the new Connection
+		onFailed			- Function called with the error if the connection could not be made
+		timeout				- Seconds to wait before giving up. None waits forever
+		tls					- ssl.SSLContext to open a TLS connection with. None is plain TCP
+		serverName			- Server name sent in the TLS handshake
+
+listen and openDatagram raise OSError if the port is in use.
+
+
+
+Class Name: Connection
+	A reliable, ordered byte stream.
+
+	Writes never block. Data that the other end has not read yet is
+	buffered, and a connection stops being writable once too much of it
+	is waiting, so senders can hold back until it drains. A transport
+	may close a connection whose other end stops reading altogether.
+
+Functions:
+	setHandlers				- Sets the functions called with received data and when the stream closes.
+							  Data that arrived before the handlers were set is delivered right away.
+	setWritableHandler		- Sets a function called with False when the connection stops being
+							  writable, and with True when it is writable again
+	isWritable				- Returns False while too much written data is waiting to be sent
+	write					- Queues data to be sent (any thread)
+	sendfile				- Sends count bytes of a binary file from offset, then calls
+							  onDone with None or with the error (any thread)
+	close					- Closes the stream (any thread)
+	getPeerAddress			- Returns the (address, port) of the other end
+	getTls					- Returns the ssl.SSLObject of a TLS connection, or None
+	isOutbound				- Returns True if this end opened the connection
+	isClosed				- Returns True once the stream has been closed
+
+
+
+Class Name: DatagramEndpoint
+	A UDP socket. Datagrams may be lost or reordered.
+
+Functions:
+	sendto					- Sends a datagram to (address, port). address may be '<broadcast>'
+							  or a multicast group (any thread)
+	joinGroup				- Receives datagrams sent to a multicast group address.
+							  Raises OSError if multicast is not available.
+	leaveGroup				- Stops receiving datagrams sent to a multicast group address
+	close					- Closes the socket (any thread)
+	getPort					- Returns the port the socket is bound to
+
+
+
+Class Name: Listener
+	A listening TCP socket.
+
+Functions:
+	close					- Stops accepting connections (any thread)
+	getPort					- Returns the port the socket is bound to
+"""
+
+
+class Transport:
+
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def inEngineThread(self):
+        raise NotImplementedError
+
+    def callSoon(self, callback, *args):
+        raise NotImplementedError
+
+    def callLater(self, delay, callback, *args):
+        raise NotImplementedError
+
+    def time(self):
+        raise NotImplementedError
+
+    def random(self):
+        raise NotImplementedError
+
+    def listen(self, port, onConnection, host='', tls=None):
+        raise NotImplementedError
+
+    def openDatagram(self, port, onDatagram, host='', reuse=False):
+        raise NotImplementedError
+
+    def connect(self, host, port, onConnected, onFailed=None, timeout=None, tls=None,
+        serverName=None):
+        raise NotImplementedError
+
+
+class Connection:
+
+    def setHandlers(self, onData, onClose):
+        raise NotImplementedError
+
+    def setWritableHandler(self, onWritable):
+        raise NotImplementedError
+
+    def isWritable(self):
+        raise NotImplementedError
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def sendfile(self, file, offset, count, onDone):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def getPeerAddress(self):
+        raise NotImplementedError
+
+    def getTls(self):
+        raise NotImplementedError
+
+    def isOutbound(self):
+        raise NotImplementedError
+
+    def isClosed(self):
+        raise NotImplementedError
+
+
+class DatagramEndpoint:
+
+    def sendto(self, data, addr):
+        raise NotImplementedError
+
+    def joinGroup(self, address):
+        raise NotImplementedError
+
+    def leaveGroup(self, address):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def getPort(self):
+        raise NotImplementedError
+
+
+class Listener:
+
+    def close(self):
+        raise NotImplementedError
+
+    def getPort(self):
+        raise NotImplementedError
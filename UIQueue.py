@@ -0,0 +1,136 @@
+# -*- coding: utf-8 *-*
+
+"""
+Class Name: UIQueue
+	Carries events from the engine thread to the Tk thread.
+
+	Tk widgets may only be touched from the thread running mainloop, but
+	the client's callbacks run on the engine thread. They post events
+	here instead, and the Tk thread applies them.
+
+	An event is a handler and an item. The Tk thread takes every waiting
+	event at once, up to MAX_BATCH, and calls each handler once with the
+	list of its items, in the order the handlers were first posted to. A
+	burst of messages therefore becomes one widget update instead of one
+	per message.
+
+	Posting never calls Tk. Where Tk can watch a file descriptor, the
+	first event of a burst writes a byte to a pipe that Tk is watching,
+	so the queue is drained as soon as the Tk thread is free. Elsewhere
+	the Tk thread checks the queue every POLL_INTERVAL milliseconds.
+
+Data:
+	__widget				- Widget whose Tk interpreter drains the queue
+	__events				- (handler, item) pairs waiting for the Tk thread
+	__lock					- Guards __events and __scheduled
+	__scheduled				- True once the Tk thread has been woken for the waiting events
+	__pipe					- (read, write) descriptors used to wake the Tk thread, or None
+
+Functions:
+	post					- Queues an item for a handler (any thread)
+	drain					- Applies the waiting events (Tk thread)
+	close					- Stops watching the pipe and closes it
+"""
+
+import collections
+import os
+import threading
+import tkinter
+
+
+MAX_BATCH = 1000
+POLL_INTERVAL = 50
+
+
+class UIQueue:
+
+    __pipe = None
+    __closed = False
+
+    def __init__(self, widget):
+        self.__widget = widget
+        self.__events = collections.deque()
+        self.__lock = threading.Lock()
+        self.__scheduled = False
+
+        try:
+            read, write = os.pipe()
+        except OSError:
+            read = write = None
+
+        if read is not None:
+            try:
+                os.set_blocking(read, False)
+                os.set_blocking(write, False)
+                widget.tk.createfilehandler(read, tkinter.READABLE, self.__onWake)
+                self.__pipe = (read, write)
+
+            # Tk on Windows cannot watch descriptors
+            except (AttributeError, OSError, tkinter.TclError):
+                os.close(read)
+                os.close(write)
+
+        if self.__pipe is None:
+            self.__poll()
+
+    def post(self, handler, item=None):
+        """Queue item to be given to handler on the Tk thread."""
+        with self.__lock:
+            self.__events.append((handler, item))
+
+            if self.__scheduled:
+                return
+
+            self.__scheduled = True
+
+        if self.__pipe is not None:
+            try:
+                os.write(self.__pipe[1], b"\0")
+
+            # A full pipe already wakes the Tk thread
+            except (BlockingIOError, OSError):
+                pass
+
+    def __onWake(self, fd, mask):
+        try:
+            os.read(fd, 4096)
+        except OSError:
+            pass
+
+        self.drain()
+
+    def __poll(self):
+        if self.__closed:
+            return
+
+        self.drain()
+        self.__widget.after(POLL_INTERVAL, self.__poll)
+
+    def drain(self):
+        """Apply the waiting events. Must be called from the Tk thread."""
+        with self.__lock:
+            count = min(len(self.__events), MAX_BATCH)
+            events = [self.__events.popleft() for i in range(count)]
+
+            more = len(self.__events) > 0
+            self.__scheduled = more
+
+        batches = {}
+        for handler, item in events:
+            batches.setdefault(handler, []).append(item)
+
+        for handler, items in batches.items():
+            handler(items)
+
+        # Let Tk redraw and handle input before the rest of a flood
+        if more and not self.__closed:
+            self.__widget.after_idle(self.drain)
+
+    def close(self):
+        self.__closed = True
+
+        if self.__pipe is not None:
+            self.__widget.tk.deletefilehandler(self.__pipe[0])
+            os.close(self.__pipe[0])
+            os.close(self.__pipe[1])
+            self.__pipe = None
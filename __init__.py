@@ -1,7 +1,11 @@
 from tkinter import *
+import logging
 import sys
 from FriendsList import *
 
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("SkyChat.UI")
+
 # Create the root window
 root = Tk()
 fList = FriendsList(root)
@@ -11,13 +15,13 @@ def onClose():
     """Callback function used to logout the client whenever the main
     window is closed."""
 
-    print("logging out")
+    log.info("logging out")
     fList.logout()
 
-    print("destroying window")
+    log.info("destroying window")
     root.destroy()
 
-    print("exiting")
+    log.info("exiting")
     sys.exit()
 
 root.protocol("WM_DELETE_WINDOW", onClose)